@@ -1,11 +1,18 @@
 import os
+from functools import lru_cache
 from typing import Tuple
 
 from flask import Flask, request
-from twilio.rest import Client as TwilioClient
 from twilio.twiml.messaging_response import MessagingResponse
 
-twilio_client = TwilioClient(os.getenv('TWILIO_SID'), os.getenv('TWILIO_TOKEN'))
+from commands import ADD, commands, digits
+
+
+@lru_cache(maxsize=None)
+def twilio_client():
+    from twilio.rest import Client as TwilioClient
+    return TwilioClient(os.getenv('TWILIO_SID'), os.getenv('TWILIO_TOKEN'))
+
 
 app = Flask(__name__)
 app.config.from_object(__name__)
@@ -15,14 +22,14 @@ sitters = {}
 @app.route('/bot', methods=['POST'])
 def bot():
     from_ = request.values.get('From')
-    body = request.values.get('Body').lower()
+    command = commands.classify(request.values.get('Body'))
     response = 'I wasn\'t sure what to do with your input. '
 
-    if has_phone_num(body):
+    if command.intent == ADD:
 
         try:
-            sitter_name, sitter_num = add_sitter(body)
-        except (AssertionError, ValueError):
+            sitter_name, sitter_num = add_sitter(command.args['name'], command.args['num'])
+        except ValueError:
             response = 'Sorry, did you mean to add a sitter?  Please try again.'
         else:
             response = f'Okay, I added {sitter_name.title()} to sitters, with phone # {sitter_num}.  '
@@ -33,23 +40,11 @@ def bot():
     return str(resp)
 
 
-def has_phone_num(string):
-    return len([char for char in string if char.isnumeric()]) == 10
-
-
-def add_sitter(body: str) -> Tuple[str, str]:
-    name, *num_parts = body.split(' ')
-
-    num_only = ''.join(char
-                       for num in num_parts
-                       for char in num if char.isnumeric())
-
+def add_sitter(name: str, num: str) -> Tuple[str, str]:
     lowercase_name = name.lower()
     sitter = sitters.get(lowercase_name)
 
-    assert len(num_only) == 10
-
-    phone_number = f'+1{num_only}'
+    phone_number = f'+1{digits(num)}'
     sitters[lowercase_name] = {'num':  phone_number,
                                'name': lowercase_name}
 
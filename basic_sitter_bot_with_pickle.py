@@ -1,19 +1,27 @@
 import os
-import pickle
-from typing import Tuple
+from functools import lru_cache
+from typing import List, Tuple
 
 from flask import Flask, request
-from twilio.rest import Client as TwilioClient
 from twilio.twiml.messaging_response import MessagingResponse
 
+from commands import ADD, REMOVE, commands, digits
+from journal import JournaledDict
+
 MY_CELL = os.getenv('MY_CELL')
 BOOKER_NUM = os.getenv('MY_TWILIO_NUM')
 
-twilio_client = TwilioClient(os.getenv('TWILIO_SID'), os.getenv('TWILIO_TOKEN'))
 
-sitters = {}
-if os.path.exists('sitters.p'):
-    sitters = pickle.load(open('sitters.p', 'rb'))
+@lru_cache(maxsize=None)
+def twilio_client():
+    from twilio.rest import Client as TwilioClient
+    return TwilioClient(os.getenv('TWILIO_SID'), os.getenv('TWILIO_TOKEN'))
+
+
+@lru_cache(maxsize=None)
+def load_sitters() -> JournaledDict:
+    # every change is journaled as it happens, so a crash mid-write can't leave sitters.p truncated
+    return JournaledDict('sitters.p')
 
 app = Flask(__name__)
 app.config.from_object(__name__)
@@ -21,23 +29,31 @@ app.config.from_object(__name__)
 @app.route('/bot', methods=['POST'])
 def bot():
     from_ = request.values.get('From')
-    body = request.values.get('Body').lower()
+    body = request.values.get('Body')
+    command = commands.classify(body)
     response = 'I wasn\'t sure what to do with your input. '
 
-    if has_phone_num(body):
+    if len(body.strip().splitlines()) > 1:
+
+        added, rejected = add_sitters(body)
+        response = f'Okay, I added {len(added)} sitters: {", ".join(name.title() for name in added)}.'
+        if rejected:
+            response += f'  I couldn\'t add: {"; ".join(rejected)}.'
+
+    elif command.intent == ADD:
 
         try:
-            sitter_name, sitter_num = add_sitter(body)
-        except (AssertionError, ValueError):
+            sitter_name, sitter_num = add_sitter(command.args['name'], command.args['num'])
+        except ValueError:
             response = 'Sorry, did you mean to add a sitter?  Please try again.'
         else:
             response = f'Okay, I added {sitter_name.title()} to sitters, with phone # {sitter_num}.  '
-            print(sitters)
+            print(load_sitters())
 
-    elif any(remove_word in body for remove_word in ['remove', 'delete']):
+    elif command.intent == REMOVE:
 
         try:
-            sitter_name = remove_sitter(body)
+            sitter_name = remove_sitter(command.args['name'])
         except KeyError:
             response = 'No such sitter. Please write "delete [sitter\'s first name]."'
         else:
@@ -48,48 +64,47 @@ def bot():
     return str(resp)
 
 
-def has_phone_num(string):
-    return len([char for char in string if char.isnumeric()]) == 10
+def add_sitter(name: str, num: str) -> Tuple[str, str]:
+    lowercase_name, sitter = make_sitter(name, num)
+    load_sitters()[lowercase_name] = sitter
+    return name, sitter['num']
 
 
-def add_sitter(body: str) -> Tuple[str, str]:
-    name, *num_parts = body.split(' ')
+def add_sitters(body: str) -> Tuple[List[str], List[str]]:
+    # one sitter per line, written out as one journal entry rather than one per sitter; lines that aren't a name
+    # and number are handed back so the reply can say which
+    sitters, rejected = [], []
+    for line in body.splitlines():
+        command = commands.classify(line)
+        if command.intent == ADD:
+            sitters.append(make_sitter(command.args['name'], command.args['num']))
+        elif line.strip():
+            rejected.append(line.strip())
+    load_sitters().put_many(sitters)
+    return [lowercase_name for lowercase_name, _ in sitters], rejected
 
-    num_only = ''.join(char
-                       for num in num_parts
-                       for char in num if char.isnumeric())
 
+def make_sitter(name: str, num: str) -> Tuple[str, dict]:
     lowercase_name = name.lower()
-    sitter = sitters.get(lowercase_name)
+    phone_number = f'+1{digits(num)}'
+    return lowercase_name, {'num':  phone_number,
+                            'name': lowercase_name}
 
-    assert len(num_only) == 10
 
-    phone_number = f'+1{num_only}'
-    sitters[lowercase_name] = {'num':  phone_number,
-                               'name': lowercase_name}
-    persist_sitters()
-
-    return name, phone_number
-
-
-def remove_sitter(body: str) -> str:
-    sitter_first_name = body.split(' ')[1]
+def remove_sitter(sitter_first_name: str) -> str:
+    sitters = load_sitters()
     sitter = sitters.get(sitter_first_name)
     if sitter is None:
         raise KeyError
     del sitters[sitter_first_name]
-    persist_sitters()
     return sitter_first_name
 
 
-def persist_sitters():
-    pickle.dump(sitters, open('sitters.p', 'wb'))
-
-
 if __name__ == '__main__':
+    sitters = load_sitters()
     if sitters:
         sitter_list = 'Your sitters are ' + ' and '.join(
             f'{sitter_name.title()}' for sitter_name in sitters) + '.'
-        twilio_client.api.account.messages.create(to=MY_CELL, from_=BOOKER_NUM, body=sitter_list)
+        twilio_client().api.account.messages.create(to=MY_CELL, from_=BOOKER_NUM, body=sitter_list)
         print(sitter_list)
     app.run(debug=True, port=8000, use_reloader=False)
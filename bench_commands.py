@@ -0,0 +1,43 @@
+import json
+import os
+import time
+
+from commands import ADD, BOOK, REMOVE, UNKNOWN, commands
+
+ROUNDS = int(os.getenv('COMMANDS_ROUNDS', '20000'))
+
+# roughly what the bot sees: mostly sitters' replies, then bookings, with the odd roster change or stray text
+SAMPLES = ['yes', 'no', 'y', 'n', '2', 'Yes!', 'tomorrow 6pm to 10pm', 'friday 5:30pm - 11pm', 'sat noon to midnight',
+           '10/24 6-10pm', 'annie 212-555-1234', 'add bob (212) 555 0000', 'remove annie', 'delete bob', 'list',
+           'thanks!', 'who is coming tonight?', 'cancel friday 6pm to 10pm']
+
+
+def legacy_classify(body: str) -> tuple:
+    # the substring and per-character checks the bots used before the command table, and how they got at the arguments
+    body = body.lower()
+    if len([char for char in body if char.isnumeric()]) == 10:
+        name, *num_parts = body.split(' ')
+        return ADD, name, ''.join(char for num in num_parts for char in num if char.isnumeric())
+    if any(remove_word in body for remove_word in ['remove', 'delete']):
+        return REMOVE, body.split(' ')[1]
+    if body.strip() in ['yes', 'no', 'n', 'y'] or body.strip().isnumeric():
+        return UNKNOWN, body.strip()
+    return BOOK, body
+
+
+def per_second(classify, rounds: int = ROUNDS) -> float:
+    start = time.perf_counter()
+    for _ in range(rounds):
+        for body in SAMPLES:
+            classify(body)
+    return rounds * len(SAMPLES) / (time.perf_counter() - start)
+
+
+if __name__ == '__main__':
+    commands.classify('')  # compiles the table
+    print(json.dumps({'intents': {body: commands.classify(body).intent for body in SAMPLES},
+                      # texts that would go on to the comparatively slow date parser
+                      'sent_to_parser': {'command_table': sum(commands.classify(body).intent == BOOK for body in SAMPLES),
+                                         'legacy_checks': sum(legacy_classify(body)[0] == BOOK for body in SAMPLES)},
+                      'command_table_per_second': round(per_second(commands.classify)),
+                      'legacy_checks_per_second': round(per_second(legacy_classify))}, indent=2))
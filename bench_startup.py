@@ -0,0 +1,42 @@
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+
+STARTUP_TARGET_MS = float(os.getenv('STARTUP_TARGET_MS', '250'))
+RUNS = int(os.getenv('STARTUP_RUNS', '7'))
+MODULES = ['sitter_bot', 'sitter_bot_book_forever_simple']
+
+# import the module and build the app, timed from inside the child so interpreter startup isn't counted
+STARTUP_SNIPPET = '''
+import time
+start = time.perf_counter()
+import {module}
+{module}.create_app()
+print((time.perf_counter() - start) * 1000)
+'''
+
+
+def time_startup(module: str, runs: int = RUNS) -> list:
+    here = os.path.dirname(os.path.abspath(__file__))
+    timings = []
+    with tempfile.TemporaryDirectory() as directory:
+        env = {**os.environ, 'PYTHONPATH': here, 'SITTER_BOT_DB': os.path.join(directory, 'bench.db')}
+        env.pop('SITTER_BOT_PREWARM', None)
+        for _ in range(runs):
+            output = subprocess.run([sys.executable, '-c', STARTUP_SNIPPET.format(module=module)],
+                                    cwd=directory, env=env, check=True, capture_output=True, text=True).stdout
+            timings.append(float(output.strip().splitlines()[-1]))
+    return timings
+
+
+if __name__ == '__main__':
+    results = {}
+    for module in MODULES:
+        timings = time_startup(module)
+        results[module] = {'median_ms': round(statistics.median(timings), 1), 'max_ms': round(max(timings), 1),
+                           'target_ms': STARTUP_TARGET_MS}
+    print(json.dumps(results, indent=2))
+    sys.exit(0 if all(result['median_ms'] <= STARTUP_TARGET_MS for result in results.values()) else 1)
@@ -0,0 +1,176 @@
+import argparse
+import datetime
+import importlib
+import json
+import os
+import sys
+import tempfile
+import time
+from concurrent.futures import Future
+from typing import Callable, List, Optional
+
+from records import Booking, Offer, Sitter
+
+MY_CELL = '+15550000000'
+
+os.environ.setdefault('MY_CELL', MY_CELL)
+os.environ.setdefault('MY_TWILIO_NUM', '+15559999999')
+os.environ.setdefault('TWILIO_COUNTRY_CODE', '1')
+
+
+def sitter_name(idx: int) -> str:
+    # names can't contain digits or the bot would read them as part of the phone number
+    name = ''
+    idx += 1
+    while idx:
+        idx, remainder = divmod(idx - 1, 26)
+        name = chr(ord('a') + remainder) + name
+    return f'sitter{name}'
+
+
+def sitter_num(idx: int) -> str:
+    return f'{idx:010d}'
+
+
+def booking_request(idx: int, today: datetime.date) -> str:
+    day = today + datetime.timedelta(days=1 + idx // 600 % 300)
+    return f'{day.month}/{day.day} {1 + idx // 60 % 10}:{idx % 60:02d}pm to 11:30pm'
+
+
+def percentile(timings: List[float], pct: float) -> float:
+    ordered = sorted(timings)
+    return ordered[min(len(ordered) - 1, int(round(pct / 100 * (len(ordered) - 1))))]
+
+
+def summarize(timings: List[float]) -> dict:
+    total = sum(timings)
+    return {'requests': len(timings),
+            'p50_ms': round(percentile(timings, 50) * 1000, 3),
+            'p99_ms': round(percentile(timings, 99) * 1000, 3),
+            'per_second': round(len(timings) / total, 1) if total else None}
+
+
+def timed(fn: Callable, args_list: list) -> List[float]:
+    timings = []
+    for args in args_list:
+        start = time.perf_counter()
+        fn(*args)
+        timings.append(time.perf_counter() - start)
+    return timings
+
+
+def stub_sms(bot) -> None:
+    def deliver(to: str, body: str, from_: str = None, attempts: int = 1,
+                ready: Callable[[], bool] = None) -> Optional[dict]:
+        if ready is not None and not ready():
+            return None
+        return {'sid': 'SMbench', 'to': to, 'body': body, 'from': from_}
+
+    def send(to: str, body: str, from_: str = None) -> Future:
+        future = Future()
+        future.set_result(deliver(to, body, from_))
+        return future
+    bot.sms.deliver = deliver
+    bot.sms.send = send
+
+
+def bench_bot_num(size: int) -> str:
+    return f'+1444{size:07d}'
+
+
+def seed(bot, size: int, today: datetime.date) -> None:
+    # each size gets its own household, so webhooks are routed by their To number like in production
+    bot_num = bench_bot_num(size)
+    bot.tenants.register(bot_num, MY_CELL)
+    now = datetime.datetime.now()
+    with bot.tenants.activate(bot_num) as tenant, tenant.store.transaction():
+        for idx in range(size):
+            name = sitter_name(idx)
+            tenant.sitters[name] = Sitter(name, f'+1{sitter_num(idx)}')
+        for idx in range(size):
+            # every booking has one outstanding offer so replies have something to accept
+            key = bot.parse_booking_request(booking_request(idx, today))
+            tenant.bookings[key] = Booking({sitter_name(idx): Offer(now)}, requested_at=now)
+
+
+def drain(bot) -> List[float]:
+    timings = []
+    while True:
+        start = time.perf_counter()
+        if not bot.scheduler.run_once(block=False):
+            return timings
+        timings.append(time.perf_counter() - start)
+
+
+def run(bot, size: int, requests: int) -> dict:
+    today = datetime.date.today()
+    seed(bot, size, today)
+    client = bot.create_app().test_client()
+    requests = min(requests, size)
+
+    def text(from_: str, body: str) -> None:
+        response = client.post('/bot', data={'From': from_, 'To': bench_bot_num(size), 'Body': body})
+        assert response.status_code == 200, response.data
+
+    new_sitters = [(MY_CELL, f'{sitter_name(size + idx)} {sitter_num(size + idx)}') for idx in range(requests)]
+    results = {'add': summarize(timed(text, new_sitters))}
+    results['remove'] = summarize(timed(text, [(MY_CELL, f'remove {sitter_name(size + idx)}')
+                                               for idx in range(requests)]))
+    drain(bot)
+
+    results['book'] = summarize(timed(text, [(MY_CELL, booking_request(size + idx, today))
+                                             for idx in range(requests)]))
+    results['scheduler_tick'] = summarize(drain(bot) or [0.0])
+
+    results['accept'] = summarize(timed(text, [(f'+1{sitter_num(idx)}', 'yes') for idx in range(requests)]))
+    drain(bot)
+    return results
+
+
+def regressions(results: dict, baseline: dict, tolerance: float) -> List[str]:
+    found = []
+    for size, flows in results['sizes'].items():
+        for flow, stats in flows.items():
+            before = baseline.get('sizes', {}).get(size, {}).get(flow)
+            if before and stats['p99_ms'] > before['p99_ms'] * tolerance:
+                found.append(f'{flow} at {size}: p99 {stats["p99_ms"]}ms vs {before["p99_ms"]}ms')
+    return found
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description='Replay synthetic Twilio webhooks against a bot and time them.')
+    parser.add_argument('--module', default='sitter_bot')
+    parser.add_argument('--sizes', default='10,1000,100000', help='comma-separated sitter/booking counts')
+    parser.add_argument('--requests', type=int, default=200, help='requests replayed per flow and size')
+    parser.add_argument('--output', help='write the JSON results here as well as to stdout')
+    parser.add_argument('--baseline', help='earlier --output file to compare p99 latencies against')
+    parser.add_argument('--tolerance', type=float, default=1.5, help='allowed p99 slowdown vs the baseline')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as directory:
+        os.environ.setdefault('SITTER_BOT_DB', os.path.join(directory, 'import.db'))
+        os.environ['SITTER_BOT_TENANTS_DB'] = os.path.join(directory, 'tenants.db')
+        os.environ['SITTER_BOT_TENANTS_DIR'] = os.path.join(directory, 'tenants')
+        bot = importlib.import_module(args.module)
+        stub_sms(bot)
+        results = {'module': args.module, 'requests_per_flow': args.requests, 'sizes': {}}
+        for size in [int(size) for size in args.sizes.split(',')]:
+            results['sizes'][str(size)] = run(bot, size, args.requests)
+
+    output = json.dumps(results, indent=2)
+    print(output)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            found = regressions(results, json.load(f), args.tolerance)
+        for regression in found:
+            print(f'regression: {regression}', file=sys.stderr)
+        return 1 if found else 0
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,93 @@
+import re
+from typing import Dict, List, NamedTuple, Optional, Tuple
+
+ADD = 'add'
+REMOVE = 'remove'
+BOOK = 'book'
+LIST = 'list'
+STATUS = 'status'
+UPCOMING = 'upcoming'
+RECUR = 'recur'
+CANCEL = 'cancel'
+HOURS = 'hours'
+BUSY = 'busy'
+FREE = 'free'
+YES = 'yes'
+NO = 'no'
+CHOICE = 'choice'
+UNKNOWN = 'unknown'
+
+# letters, with hyphens or apostrophes joining runs of them, e.g. anna-maria or o'neil
+NAME = r"[^\W\d_]+(?:[-'][^\W\d_]+)*"
+# exactly ten digits, however they're punctuated
+PHONE_NUM = r'\(?(?:\d[ ().-]*){9}\d'
+COUNTRY_PREFIX = r'(?:\+?1[ .-]*)?'
+# owner queries answer a page at a time, e.g. "upcoming 2"
+PAGE = r'(?: (?:page |p)?(?P<page>\d{1,3}))?'
+# anything mentioning a day or a time might be a booking; the date parser decides whether it really is
+WHEN = r'(?:\d|\b(?:today|tonight|tomorrow|tmrw|tmw|noon|midnight|mon|tue|wed|thu|fri|sat|sun))'
+NON_DIGITS = re.compile(r'\D')
+
+
+class Command(NamedTuple):
+    intent: str
+    args: Dict[str, Optional[str]]
+
+
+class CommandTable:
+
+    def __init__(self, commands: List[Tuple[str, str]] = ()):
+        self._commands = list(commands)
+        self._regex = None
+        self._args: Dict[str, Tuple[str, List[str], List[str]]] = {}
+
+    def add(self, intent: str, pattern: str, before: str = None) -> None:
+        # earlier commands win when a text matches more than one
+        idx = next((idx for idx, (other, _) in enumerate(self._commands) if other == before), len(self._commands))
+        self._commands.insert(idx, (intent, pattern))
+        self._regex = None
+
+    def _compile(self) -> None:
+        # every command becomes one branch of a single alternation, so a text is classified and its arguments
+        # pulled out in one match; group names are prefixed because they have to be unique across branches
+        branches, self._args = [], {}
+        for idx, (intent, pattern) in enumerate(self._commands):
+            args = re.findall(r'\(\?P<(\w+)>', pattern)
+            pattern = re.sub(r'\(\?P<(\w+)>', rf'(?P<c{idx}_\1>', pattern)
+            branches.append(f'(?P<c{idx}>{pattern})')
+            self._args[f'c{idx}'] = (intent, args, [f'c{idx}_{arg}' for arg in args])
+        self._regex = re.compile('|'.join(branches))
+
+    def classify(self, body: str) -> Command:
+        if self._regex is None:
+            self._compile()
+        match = self._regex.fullmatch(' '.join(body.lower().split()))
+        if match is None:
+            return Command(UNKNOWN, {})
+        # the branch's own group closes after any groups inside it, so it is always the last one matched
+        intent, args, groups = self._args[match.lastgroup]
+        if not args:
+            return Command(intent, {})
+        return Command(intent, dict(zip(args, map(match.group, groups))))
+
+
+def digits(text: str) -> str:
+    return NON_DIGITS.sub('', text)
+
+
+commands = CommandTable([
+    (YES, r'(?:yes|y)[.!]*'),
+    (NO, r'(?:no|n)[.!]*'),
+    (CHOICE, r'(?P<choice>\d{1,2})'),
+    (ADD, rf'(?:add )?(?P<name>{NAME})\b[ ,:-]*{COUNTRY_PREFIX}(?P<num>{PHONE_NUM})'),
+    (REMOVE, rf'(?:remove|delete)(?: (?P<name>{NAME}))?.*'),
+    (LIST, rf'(?:list(?: sitters)?|sitters){PAGE}'),
+    (STATUS, rf'(?:status|pending){PAGE}'),
+    (UPCOMING, rf'(?:upcoming|schedule|booked){PAGE}'),
+    (RECUR, r'(?:(?P<stop>stop|cancel) )?(?:every|each) (?P<when>.+)'),
+    (CANCEL, r'cancel(?: (?P<when>.+))?'),
+    (HOURS, r'(?:my )?hours(?: (?P<when>.+))?'),
+    (BUSY, r'(?:busy|blackout|unavailable|away)(?: (?P<when>.+))?'),
+    (FREE, r'(?:free|available)(?: (?P<when>.+))?'),
+    (BOOK, rf'(?=.*?{WHEN})(?P<when>.+)'),
+])
@@ -0,0 +1,159 @@
+import datetime
+import re
+import threading
+from functools import lru_cache
+from typing import Optional, Tuple
+
+WEEKDAYS = ['mon', 'tue', 'wed', 'thu', 'fri', 'sat', 'sun']
+
+DAY = r'(?P<day>today|tonight|tomorrow|tmrw|tmw' \
+      r'|(?:(?P<relative>this|next) )?(?P<weekday>mon|tues?|wed(?:nes)?|thu(?:rs?)?|fri|sat(?:ur)?|sun)(?:day)?' \
+      r'|(?P<month>\d{1,2})/(?P<date>\d{1,2}))'
+TIME = r'(?:(?P<{0}hour>\d{{1,2}})(?::(?P<{0}minute>\d{{2}}))? ?(?P<{0}meridiem>[ap])\.?m?\.?|(?P<{0}word>noon|midnight)' \
+       r'|(?P<{0}bare>\d{{1,2}})(?::(?P<{0}bare_minute>\d{{2}}))?)'
+BOOKING_PATTERN = re.compile(
+    rf'^(?:on )?{DAY},?(?: (?:at|from))? {TIME.format("start_")} ?(?:to|-|until|till|til) ?{TIME.format("end_")}$')
+WHOLE_DAY_PATTERN = re.compile(rf'^(?:on |all day )?{DAY}(?: all day)?$')
+# "every tuesday", "every tuesdays" or just "tuesdays": the plural is dropped so the rest parses like a one-off booking
+RECURRING_PREFIX = re.compile(r'^(?:(?:every|each) )?(?:(\w+day)s\b)?')
+
+_cache_lock = threading.Lock()
+_cache_date = None
+
+
+@lru_cache(maxsize=None)
+def calendar():
+    import parsedatetime as pdt
+    return pdt.Calendar()
+
+
+def normalize(body: str) -> str:
+    return ' '.join(body.lower().replace('–', '-').split())
+
+
+def parse_booking_window(body: str, today: datetime.date = None) -> Tuple[datetime.datetime, datetime.datetime]:
+    global _cache_date
+    today = today or datetime.date.today()
+    with _cache_lock:
+        # entries are keyed on the date anyway; clearing at rollover just keeps yesterday's from piling up
+        if today != _cache_date:
+            _parse.cache_clear()
+            _cache_date = today
+    return _parse(normalize(body), today)
+
+
+def parse_day_or_window(body: str, today: datetime.date = None) -> Tuple[datetime.datetime, datetime.datetime]:
+    # a day on its own means all of it
+    today = today or datetime.date.today()
+    match = WHOLE_DAY_PATTERN.match(normalize(body))
+    day = parse_day(match.groupdict(), today) if match is not None else None
+    if day is None:
+        return parse_booking_window(body, today)
+    start = datetime.datetime.combine(day, datetime.time.min)
+    return start, start + datetime.timedelta(days=1)
+
+
+def parse_recurring_window(body: str, today: datetime.date = None) -> Tuple[datetime.datetime, datetime.datetime]:
+    # the window is the first occurrence from today on, which has to name a weekday to say when the next ones are
+    today = today or datetime.date.today()
+    phrase = RECURRING_PREFIX.sub(lambda match: match.group(1) or '', normalize(body), count=1)
+    match = BOOKING_PATTERN.match(phrase)
+    start_and_end = parse_common_phrase(phrase, today) if match is not None and match['weekday'] else None
+    if start_and_end is None:
+        raise ValueError(f'could not find a weekday and times in "{body}"')
+    return start_and_end
+
+
+@lru_cache(maxsize=1024)
+def _parse(phrase: str, today: datetime.date) -> Tuple[datetime.datetime, datetime.datetime]:
+    start_and_end = parse_common_phrase(phrase, today)
+    if start_and_end is None:
+        start_and_end = parse_with_parsedatetime(phrase, today)
+    return start_and_end
+
+
+def parse_common_phrase(phrase: str, today: datetime.date) -> Optional[Tuple[datetime.datetime, datetime.datetime]]:
+    match = BOOKING_PATTERN.match(phrase)
+    if match is None:
+        return None
+    parts = match.groupdict()
+
+    day = parse_day(parts, today)
+    start, end = parse_time(parts, 'start_'), parse_time(parts, 'end_')
+    if day is None or start is None or end is None:
+        return None
+
+    if start[2] is None and end[2] is None:
+        if parts['day'] != 'tonight':
+            return None
+        start = start[:2] + ('p',)
+
+    # a missing am/pm is whichever gives the shorter booking: "10 to 2pm" is 10am, "6pm to 1" is 1am
+    start_datetime, end_datetime = min(
+        (window(day, start[:2] + (start_meridiem,), end[:2] + (end_meridiem,))
+         for start_meridiem in ([start[2]] if start[2] else ['a', 'p'])
+         for end_meridiem in ([end[2]] if end[2] else ['a', 'p'])),
+        key=lambda start_and_end: start_and_end[1] - start_and_end[0])
+    return start_datetime, end_datetime
+
+
+def window(day: datetime.date, start: tuple, end: tuple) -> Tuple[datetime.datetime, datetime.datetime]:
+    start_datetime = datetime.datetime.combine(day, to_time(*start))
+    end_datetime = datetime.datetime.combine(day, to_time(*end))
+    if end_datetime <= start_datetime:
+        end_datetime += datetime.timedelta(days=1)
+    return start_datetime, end_datetime
+
+
+def parse_day(parts: dict, today: datetime.date) -> Optional[datetime.date]:
+    day = parts['day']
+    if day in ['today', 'tonight']:
+        return today
+    if day in ['tomorrow', 'tmrw', 'tmw']:
+        return today + datetime.timedelta(days=1)
+    if parts['weekday'] is not None:
+        days_ahead = (WEEKDAYS.index(parts['weekday'][:3]) - today.weekday()) % 7
+        if parts['relative'] == 'next' and days_ahead == 0:
+            days_ahead = 7
+        return today + datetime.timedelta(days=days_ahead)
+    try:
+        date = datetime.date(today.year, int(parts['month']), int(parts['date']))
+    except ValueError:
+        return None
+    return date if date >= today else date.replace(year=today.year + 1)
+
+
+def parse_time(parts: dict, prefix: str) -> Optional[Tuple[int, int, Optional[str]]]:
+    if parts[f'{prefix}word'] == 'noon':
+        return 12, 0, 'p'
+    if parts[f'{prefix}word'] == 'midnight':
+        return 12, 0, 'a'
+    if parts[f'{prefix}hour'] is not None:
+        hour, minute, meridiem = parts[f'{prefix}hour'], parts[f'{prefix}minute'], parts[f'{prefix}meridiem']
+    else:
+        hour, minute, meridiem = parts[f'{prefix}bare'], parts[f'{prefix}bare_minute'], None
+    hour, minute = int(hour), int(minute or 0)
+    if not 1 <= hour <= 12 or minute > 59:
+        return None
+    return hour, minute, meridiem
+
+
+def to_time(hour: int, minute: int, meridiem: str) -> datetime.time:
+    return datetime.time(hour % 12 + (12 if meridiem == 'p' else 0), minute)
+
+
+def parse_with_parsedatetime(phrase: str, today: datetime.date) -> Tuple[datetime.datetime, datetime.datetime]:
+    start_string, end_string = phrase.split(' to ')
+    # parse relative to the start of the day so the result only depends on the cache key
+    source_time = datetime.datetime.combine(today, datetime.time.min)
+    cal = calendar()
+    start_datetime, start_status = cal.parseDT(start_string, sourceTime=source_time)
+    if not start_status:
+        raise ValueError(f'could not find a date in "{start_string}"')
+    end_datetime, end_status = cal.parseDT(end_string, sourceTime=start_datetime)
+    if not end_status:
+        raise ValueError(f'could not find an end time in "{end_string}"')
+    end_datetime = datetime.datetime.combine(start_datetime.date(), end_datetime.time())
+    if end_datetime <= start_datetime:
+        end_datetime += datetime.timedelta(days=1)
+    return start_datetime, end_datetime
@@ -0,0 +1,63 @@
+import argparse
+import itertools
+import json
+import random
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs
+
+# run this and point the bots at it with TWILIO_API_URL=http://localhost:8001
+
+message_ids = itertools.count(1)
+messages = []
+# statuses to answer with before accepting anything, e.g. [429, 503], plus a random share of failures after that
+failures = []
+failure_rate = 0.0
+FAILURE_STATUSES = [429, 500, 503]
+
+
+class FakeTwilioHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def do_POST(self):
+        length = int(self.headers.get('Content-Length', 0))
+        form = {k: v[0] for k, v in parse_qs(self.rfile.read(length).decode()).items()}
+        if not self.path.endswith('/Messages.json') or 'To' not in form:
+            return self._reply(400, {'message': 'expected a Messages.json POST with To, From and Body'})
+        status = failures.pop(0) if failures else None
+        if status is None and random.random() < failure_rate:
+            status = random.choice(FAILURE_STATUSES)
+        if status is not None:
+            print(f'{form["To"]} <- {status}')
+            return self._reply(status, {'code': status, 'message': 'simulated failure'},
+                               {'Retry-After': '1'} if status == 429 else {})
+        message = {'sid': f'SM{next(message_ids):032d}', 'to': form['To'], 'from': form.get('From'),
+                   'body': form.get('Body'), 'status': 'queued'}
+        messages.append(message)
+        print(f'{message["to"]} <- {message["body"]}')
+        self._reply(201, message)
+
+    def _reply(self, status: int, payload: dict, headers: dict = None):
+        body = json.dumps(payload).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def serve(port: int = 8001) -> ThreadingHTTPServer:
+    return ThreadingHTTPServer(('localhost', port), FakeTwilioHandler)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Accept Twilio Messages.json posts locally, optionally failing some.')
+    parser.add_argument('port', type=int, nargs='?', default=8001)
+    parser.add_argument('--failure-rate', type=float, default=0.0, help='share of requests answered with 429 or 5xx')
+    args = parser.parse_args()
+    failure_rate = args.failure_rate
+    serve(args.port).serve_forever()
@@ -0,0 +1,130 @@
+import argparse
+import datetime
+import os
+import random
+import statistics
+import sys
+from typing import List, NamedTuple, Optional, Tuple
+
+from records import Booking, Offer, OfferStatus
+
+WAVE_SIZE = int(os.getenv('OFFER_WAVE_SIZE', '3'))
+TIMEOUT_GROWTH = float(os.getenv('OFFER_TIMEOUT_GROWTH', '1.5'))
+
+
+class FanOutPolicy(NamedTuple):
+    wave_size: int = WAVE_SIZE
+    first_timeout: datetime.timedelta = datetime.timedelta(minutes=1)
+    timeout_growth: float = TIMEOUT_GROWTH
+    max_timeout: Optional[datetime.timedelta] = None
+
+    def timeout(self, wave: int) -> datetime.timedelta:
+        timeout = self.first_timeout * self.timeout_growth ** wave
+        return min(timeout, self.max_timeout) if self.max_timeout is not None else timeout
+
+
+SERIAL = FanOutPolicy(wave_size=1, timeout_growth=1)
+BROADCAST = FanOutPolicy(wave_size=sys.maxsize, timeout_growth=1)
+
+
+def wave_deadline(booking: Booking, policy: FanOutPolicy) -> Optional[datetime.datetime]:
+    # when the next wave is due, or None if nobody in the latest wave is still deciding
+    latest = booking.waves() - 1
+    started_at = [offer.offered_at for offer in booking.offers.values() if offer.wave == latest and offer.is_open]
+    if not started_at:
+        return None
+    return max(started_at) + policy.timeout(latest)
+
+
+def start_wave(booking: Booking, names: List[str], now: datetime.datetime) -> None:
+    wave = booking.waves()
+    for name in names:
+        booking.offers[name] = Offer(now, wave)
+
+
+def cancel_open_offers(booking: Booking) -> List[str]:
+    cancelled = booking.open_offers()
+    for name in cancelled:
+        booking.offers[name].status = OfferStatus.CANCELLED
+    return cancelled
+
+
+class SimulatedSitter(NamedTuple):
+    p_yes: float
+    p_silent: float
+    mean_latency: float
+
+
+def simulate_once(policy: FanOutPolicy, roster: List[SimulatedSitter], rng: random.Random) -> Tuple[float, int]:
+    # minutes until someone said yes (inf if nobody did) and texts sent, counting cancellations
+    now, wave, next_sitter = 0.0, 0, 0
+    replies = []
+    while next_sitter < len(roster):
+        offered = roster[next_sitter:next_sitter + policy.wave_size]
+        next_sitter += len(offered)
+        wave_replies = []
+        for sitter in offered:
+            if rng.random() < sitter.p_silent:
+                wave_replies.append((float('inf'), False))
+            else:
+                wave_replies.append((now + rng.expovariate(1 / sitter.mean_latency), rng.random() < sitter.p_yes))
+        replies += wave_replies
+        first_yes = min((at for at, yes in replies if yes), default=float('inf'))
+        all_declined_at = max(at for at, _ in wave_replies)
+        next_wave_at = min(now + policy.timeout(wave).total_seconds() / 60, all_declined_at)
+        if first_yes <= next_wave_at:
+            break
+        now, wave = next_wave_at, wave + 1
+    booked_at = min((at for at, yes in replies if yes), default=float('inf'))
+    cancellations = sum(1 for at, _ in replies if at > booked_at) if booked_at < float('inf') else 0
+    return booked_at, len(replies) + cancellations
+
+
+def simulate(policy: FanOutPolicy, roster: List[SimulatedSitter], runs: int = 2000,
+             give_up_after: datetime.timedelta = datetime.timedelta(hours=2), seed: int = 0) -> dict:
+    rng = random.Random(seed)
+    limit = give_up_after.total_seconds() / 60
+    results = [simulate_once(policy, roster, rng) for _ in range(runs)]
+    booked = sorted(at for at, _ in results if at <= limit)
+    return {'texts_per_booking': round(statistics.mean(texts for _, texts in results), 1),
+            'median_minutes': round(statistics.median(booked), 1) if booked else None,
+            'p90_minutes': round(booked[int(0.9 * (len(booked) - 1))], 1) if booked else None,
+            'unbooked_pct': round(100 * (1 - len(booked) / runs), 1)}
+
+
+def synthetic_roster(size: int, rng: random.Random) -> List[SimulatedSitter]:
+    return [SimulatedSitter(p_yes=rng.uniform(0.1, 0.7), p_silent=rng.uniform(0, 0.4),
+                            mean_latency=rng.uniform(2, 60)) for _ in range(size)]
+
+
+def roster_from_store(path: str) -> List[SimulatedSitter]:
+    from ranking import acceptance_rate, median_latency
+    from store import Store
+
+    roster = []
+    for _, stats in Store(path).sitter_stats.ranked_items():
+        replies = stats['yes'] + stats['no'] + stats['timeouts']
+        roster.append(SimulatedSitter(p_yes=acceptance_rate(stats),
+                                      p_silent=stats['timeouts'] / replies if replies else 0.2,
+                                      mean_latency=median_latency(stats) / 60))
+    return roster
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Compare texts sent and time-to-book across fan-out policies.')
+    parser.add_argument('--db', help='take sitters\' reply behaviour from this household\'s recorded stats')
+    parser.add_argument('--sitters', type=int, default=30, help='size of the synthetic roster when --db is not given')
+    parser.add_argument('--runs', type=int, default=2000)
+    parser.add_argument('--timeout-minutes', type=float, default=10, help='first wave\'s timeout')
+    args = parser.parse_args()
+
+    first_timeout = datetime.timedelta(minutes=args.timeout_minutes)
+    roster_ = roster_from_store(args.db) if args.db else synthetic_roster(args.sitters, random.Random(1))
+    if not args.db:
+        roster_.sort(key=lambda sitter: sitter.p_yes * (1 - sitter.p_silent) / sitter.mean_latency, reverse=True)
+    policies = {'serial': SERIAL._replace(first_timeout=first_timeout)}
+    for wave_size in [2, 3, 5]:
+        policies[f'waves of {wave_size}'] = FanOutPolicy(wave_size, first_timeout, TIMEOUT_GROWTH)
+    policies['broadcast'] = BROADCAST._replace(first_timeout=first_timeout)
+    for name, policy in policies.items():
+        print(f'{name:>12}: {simulate(policy, roster_, args.runs)}')
@@ -0,0 +1,119 @@
+import json
+import os
+import random
+import signal
+import struct
+import sys
+import tempfile
+import time
+
+from journal import DELETE, SET, JournaledDict, encode, journal_path, recover
+
+TRIALS = int(os.getenv('FAULT_TRIALS', '200'))
+OPERATIONS = int(os.getenv('FAULT_OPERATIONS', '2000'))
+# small, so plenty of the kills land in the middle of writing a snapshot
+COMPACT_EVERY = int(os.getenv('FAULT_COMPACT_EVERY', '7'))
+NAMES = ['amy', 'bea', 'cal', 'dan', 'eve', 'fay', 'gus', 'hal', 'ivy', 'jon']
+ACK = struct.Struct('>I')
+
+
+def operations(seed: int) -> list:
+    # the same seed always gives the same writes, so the parent knows what the child was doing when it died
+    rng = random.Random(seed)
+    ops = []
+    for idx in range(OPERATIONS):
+        roll = rng.random()
+        if roll < 0.2:
+            ops.append((DELETE, rng.choice(NAMES)))
+        else:
+            batch = 1 if roll < 0.8 else rng.randint(2, 5)
+            ops.append((SET, [(name, {'name': name, 'num': f'+1212555{idx:04d}'})
+                              for name in rng.sample(NAMES, batch)]))
+    return ops
+
+
+def expected(ops: list) -> dict:
+    data = {}
+    for kind, arg in ops:
+        if kind == SET:
+            data.update(arg)
+        else:
+            data.pop(arg, None)
+    return data
+
+
+def writer(path: str, ops: list, acks: int) -> None:
+    sitters = JournaledDict(path, compact_every=COMPACT_EVERY)
+    for idx, (kind, arg) in enumerate(ops):
+        if kind == SET:
+            sitters.put_many(arg)
+        else:
+            sitters.pop(arg, None)
+        # the write has returned, so it has to survive whatever happens next
+        os.write(acks, ACK.pack(idx + 1))
+    os._exit(0)
+
+
+def read_acked(acks: int) -> int:
+    blob = b''
+    while True:
+        chunk = os.read(acks, 65536)
+        if not chunk:
+            break
+        blob += chunk
+    return ACK.unpack_from(blob, len(blob) - ACK.size)[0] if len(blob) >= ACK.size else 0
+
+
+def tear_tail(path: str, rng: random.Random) -> int:
+    # what a write cut off by a power cut looks like: part of an entry that never finished
+    partial = encode((SET, [('zed', {'name': 'zed', 'num': '+12125550000'})]))
+    partial = partial[:rng.randint(1, len(partial) - 1)]
+    with open(journal_path(path), 'ab') as f:
+        f.write(partial)
+    return len(partial)
+
+
+def trial(directory: str, seed: int) -> dict:
+    rng = random.Random(seed)
+    path = os.path.join(directory, f'sitters-{seed}.p')
+    ops = operations(seed)
+    read_fd, write_fd = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        os.close(read_fd)
+        writer(path, ops, write_fd)
+    os.close(write_fd)
+    time.sleep(rng.uniform(0, 0.05))
+    os.kill(pid, signal.SIGKILL)
+    os.waitpid(pid, 0)
+    acked = read_acked(read_fd)
+    os.close(read_fd)
+    torn = tear_tail(path, rng) if rng.random() < 0.5 else 0
+
+    try:
+        recovered = recover(path)
+    except Exception as e:
+        return {'ok': False, 'acked': acked, 'replayed': 0, 'torn': torn, 'discarded_bytes': 0, 'error': repr(e)}
+    # the write in flight when the child died may or may not have made it, but nothing before it can be missing
+    ok = recovered.data in [expected(ops[:acked]), expected(ops[:acked + 1])]
+    # and the journal has to be usable again afterwards
+    sitters = JournaledDict(path, compact_every=COMPACT_EVERY)
+    sitters['kim'] = {'name': 'kim', 'num': '+12125559999'}
+    ok = ok and recover(path).data == dict(recovered.data, kim={'name': 'kim', 'num': '+12125559999'})
+    sitters.close()
+    return {'ok': ok, 'acked': acked, 'replayed': recovered.replayed, 'torn': torn,
+            'discarded_bytes': recovered.discarded_bytes}
+
+
+if __name__ == '__main__':
+    with tempfile.TemporaryDirectory() as directory:
+        results = [trial(directory, seed) for seed in range(TRIALS)]
+    failures = [seed for seed, result in enumerate(results) if not result['ok']]
+    print(json.dumps({'trials': TRIALS,
+                      'failures': failures,
+                      'killed_before_first_write': sum(result['acked'] == 0 for result in results),
+                      'killed_after_last_write': sum(result['acked'] == OPERATIONS for result in results),
+                      'recovered_from_journal': sum(result['replayed'] > 0 for result in results),
+                      'torn_tails_injected': sum(result['torn'] > 0 for result in results),
+                      'torn_bytes_discarded': sum(result['discarded_bytes'] for result in results)}, indent=2))
+    sys.exit(1 if failures else 0)
@@ -0,0 +1,81 @@
+import datetime
+import threading
+import time
+from typing import Callable, List, Optional, Tuple
+
+from store import Store
+
+# a text picked up by a worker that then died goes back to the queue once this runs out
+LEASE_SECONDS = 60
+RETENTION = datetime.timedelta(days=1)
+
+QUEUED = 'queued'
+HANDLING = 'handling'
+DONE = 'done'
+FAILED = 'failed'
+
+
+class Inbox:
+
+    def __init__(self, store: Store):
+        self.store = store
+        self._drain_at = None
+        self._lock = threading.Lock()
+
+    def enqueue(self, sid: str, from_: str, body: str) -> int:
+        # part of the caller's transaction, alongside the MessageSid that dedupes Twilio's retries
+        cursor = self.store.conn.execute(
+            'INSERT INTO inbox (sid, from_num, body, status, received_at) VALUES (?, ?, ?, ?, ?)',
+            (sid, from_, body, QUEUED, datetime.datetime.now().isoformat()))
+        return cursor.lastrowid
+
+    def claim(self) -> List[Tuple[int, str, str]]:
+        # the oldest unfinished text from each sender, unless a worker is still on an earlier one of theirs; that's
+        # what keeps each sender's texts in order across threads and processes
+        now = datetime.datetime.now()
+        claimed = []
+        with self.store.transaction():
+            self.store.conn.execute("DELETE FROM inbox WHERE received_at < ? AND status IN ('done', 'failed')",
+                                    ((now - RETENTION).isoformat(),))
+            rows = self.store.conn.execute(
+                "SELECT id, from_num, body, status, lease_until FROM inbox WHERE id IN "
+                "(SELECT MIN(id) FROM inbox WHERE status IN ('queued', 'handling') GROUP BY from_num) "
+                "ORDER BY id").fetchall()
+            for message_id, from_, body, status, lease_until in rows:
+                if status == HANDLING and lease_until > now.isoformat():
+                    continue
+                self.store.conn.execute('UPDATE inbox SET status = ?, lease_until = ? WHERE id = ?',
+                                        (HANDLING, (now + datetime.timedelta(seconds=LEASE_SECONDS)).isoformat(),
+                                         message_id))
+                claimed.append((message_id, from_, body))
+        return claimed
+
+    def drain(self, submit: Callable[[Tuple[int, str, str]], None], wake: Callable[[float], None]) -> None:
+        # hands every text that can be handled now to submit(), then asks wake() to call back when a lease runs out
+        with self._lock:
+            self._drain_at = None
+        for message in self.claim():
+            submit(message)
+        expires_at = self.next_lease_expiry()
+        if expires_at is not None:
+            self._wake(max((expires_at - datetime.datetime.now()).total_seconds(), 0), wake)
+
+    def _wake(self, delay: float, wake: Callable[[float], None]) -> None:
+        at = time.monotonic() + delay
+        with self._lock:
+            if self._drain_at is not None and self._drain_at <= at:
+                return
+            self._drain_at = at
+        wake(delay)
+
+    def finish(self, message_id: int, error: str = None) -> None:
+        self.store.conn.execute('UPDATE inbox SET status = ?, lease_until = NULL, last_error = ? WHERE id = ?',
+                                (FAILED if error is not None else DONE, error, message_id))
+
+    def next_lease_expiry(self) -> Optional[datetime.datetime]:
+        row = self.store.conn.execute("SELECT MIN(lease_until) FROM inbox WHERE status = 'handling'").fetchone()
+        return datetime.datetime.fromisoformat(row[0]) if row[0] is not None else None
+
+    def pending(self) -> int:
+        return self.store.conn.execute(
+            "SELECT COUNT(*) FROM inbox WHERE status IN ('queued', 'handling')").fetchone()[0]
@@ -0,0 +1,177 @@
+import glob
+import os
+import pickle
+import struct
+import tempfile
+import threading
+import zlib
+from collections.abc import MutableMapping
+from contextlib import suppress
+from typing import Any, Iterable, Iterator, List, NamedTuple, Tuple
+
+# every journal entry is its length and checksum, then the pickled operation
+HEADER = struct.Struct('>II')
+COMPACT_EVERY = 200
+
+SET = 'set'
+DELETE = 'delete'
+
+
+class Recovered(NamedTuple):
+    data: dict
+    replayed: int
+    discarded_bytes: int
+
+
+def journal_path(path: str) -> str:
+    return f'{path}.journal'
+
+
+def temp_prefix(path: str) -> str:
+    return f'.{os.path.basename(path)}.'
+
+
+def fsync_dir(path: str) -> None:
+    # a rename is only durable once the directory entry itself is on disk
+    fd = os.open(os.path.dirname(os.path.abspath(path)), os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def write_snapshot(path: str, data: dict) -> None:
+    # readers see either the old snapshot or the new one, never half of one
+    fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(path)), prefix=temp_prefix(path),
+                                     suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            pickle.dump(data, f, pickle.HIGHEST_PROTOCOL)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temp_path, path)
+    except BaseException:
+        with suppress(FileNotFoundError):
+            os.unlink(temp_path)
+        raise
+    fsync_dir(path)
+
+
+def encode(operation: tuple) -> bytes:
+    payload = pickle.dumps(operation, pickle.HIGHEST_PROTOCOL)
+    return HEADER.pack(len(payload), zlib.crc32(payload)) + payload
+
+
+def read_journal(path: str) -> Tuple[List[tuple], int, int]:
+    # stops at the first entry that is cut short or fails its checksum; nothing after it was ever acknowledged
+    try:
+        with open(path, 'rb') as f:
+            blob = f.read()
+    except FileNotFoundError:
+        return [], 0, 0
+    operations, good = [], 0
+    while len(blob) - good >= HEADER.size:
+        length, checksum = HEADER.unpack_from(blob, good)
+        payload = blob[good + HEADER.size:good + HEADER.size + length]
+        if len(payload) < length or zlib.crc32(payload) != checksum:
+            break
+        operations.append(pickle.loads(payload))
+        good += HEADER.size + length
+    return operations, good, len(blob)
+
+
+def apply(data: dict, operation: tuple) -> None:
+    kind, arg = operation
+    if kind == SET:
+        data.update(arg)
+    else:
+        data.pop(arg, None)
+
+
+def recover(path: str) -> Recovered:
+    # the last snapshot, then every complete journal entry on top of it; replaying an entry the snapshot already
+    # has is harmless, so a crash between writing a snapshot and emptying the journal loses nothing
+    for temp_path in glob.glob(os.path.join(glob.escape(os.path.dirname(os.path.abspath(path))),
+                                            glob.escape(temp_prefix(path)) + '*.tmp')):
+        # a snapshot that was still being written when the process died
+        os.unlink(temp_path)
+    data = {}
+    if os.path.exists(path):
+        with open(path, 'rb') as f:
+            data = pickle.load(f)
+    operations, good, size = read_journal(journal_path(path))
+    for operation in operations:
+        apply(data, operation)
+    if size > good:
+        with open(journal_path(path), 'r+b') as f:
+            f.truncate(good)
+            f.flush()
+            os.fsync(f.fileno())
+    return Recovered(data, len(operations), size - good)
+
+
+class JournaledDict(MutableMapping):
+    # a dict whose every change is fsynced to a journal before it's applied, and which is folded into a fresh
+    # snapshot every so often; the snapshot file is a plain pickled dict, the same as the old .p files
+
+    def __init__(self, path: str, compact_every: int = COMPACT_EVERY):
+        self.path = path
+        self.compact_every = compact_every
+        self._lock = threading.Lock()
+        recovered = recover(path)
+        self._data = recovered.data
+        self._entries = 0
+        self._journal = open(journal_path(path), 'ab')
+        if recovered.replayed or not os.path.exists(path):
+            self.snapshot()
+
+    def __getitem__(self, key) -> Any:
+        return self._data[key]
+
+    def __setitem__(self, key, value) -> None:
+        self.put_many([(key, value)])
+
+    def put_many(self, items: Iterable[Tuple[Any, Any]]) -> None:
+        # one entry and one fsync for the lot
+        items = list(items)
+        if items:
+            self._append((SET, items))
+
+    def __delitem__(self, key) -> None:
+        if key not in self._data:
+            raise KeyError(key)
+        self._append((DELETE, key))
+
+    def __iter__(self) -> Iterator:
+        return iter(list(self._data))
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+    def __repr__(self) -> str:
+        return f'JournaledDict({self.path!r}, {self._data!r})'
+
+    def _append(self, operation: tuple) -> None:
+        with self._lock:
+            self._journal.write(encode(operation))
+            self._journal.flush()
+            os.fsync(self._journal.fileno())
+            # only applied once it's durable, so nothing anyone has seen can be lost
+            apply(self._data, operation)
+            self._entries += 1
+            if self._entries >= self.compact_every:
+                self._compact()
+
+    def snapshot(self) -> None:
+        with self._lock:
+            self._compact()
+
+    def _compact(self) -> None:
+        write_snapshot(self.path, self._data)
+        self._journal.truncate(0)
+        self._journal.flush()
+        os.fsync(self._journal.fileno())
+        self._entries = 0
+
+    def close(self) -> None:
+        self._journal.close()
@@ -0,0 +1,144 @@
+import datetime
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Dict, Iterator, Optional, Tuple
+
+TRACE_PATH = os.getenv('SITTER_BOT_TRACE')
+PREFIX = 'sitter_bot'
+BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+HELP = {
+    'stage_seconds': 'Time spent in each stage of handling a webhook or scheduled task.',
+    'webhooks_total': 'Inbound webhooks by outcome.',
+    'offers_total': 'Offers by what became of them.',
+    'twilio_requests_total': 'Outbound Twilio API requests by HTTP status.',
+    'outbox_total': 'Queued texts by delivery outcome.',
+}
+
+# the webhook or scheduler tick whose stages are being timed, if it is being traced
+current_span: ContextVar[Optional[dict]] = ContextVar('current_span', default=None)
+
+Labels = Tuple[Tuple[str, str], ...]
+
+
+class Metrics:
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._counters: Dict[str, Dict[Labels, float]] = {}
+        self._histograms: Dict[str, Dict[Labels, list]] = {}
+
+    def inc(self, name: str, amount: float = 1, **labels) -> None:
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            series = self._counters.setdefault(name, {})
+            series[key] = series.get(key, 0) + amount
+
+    def observe(self, name: str, value: float, **labels) -> None:
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            # one count per bucket, then the running sum and count
+            series = self._histograms.setdefault(name, {}).setdefault(key, [0] * (len(BUCKETS) + 2))
+            for idx, bound in enumerate(BUCKETS):
+                if value <= bound:
+                    series[idx] += 1
+            series[-2] += value
+            series[-1] += 1
+
+    @contextmanager
+    def timer(self, stage: str, **labels) -> Iterator[None]:
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - start
+            self.observe('stage_seconds', elapsed, stage=stage, **labels)
+            span = current_span.get()
+            if span is not None:
+                span['stages_ms'][stage] = round(span['stages_ms'].get(stage, 0) + elapsed * 1000, 3)
+
+    def render(self) -> str:
+        lines = []
+        with self._lock:
+            for name, series in sorted(self._counters.items()):
+                lines += header(name, 'counter')
+                lines += [f'{PREFIX}_{name}{format_labels(key)} {value:g}' for key, value in sorted(series.items())]
+            for name, series in sorted(self._histograms.items()):
+                lines += header(name, 'histogram')
+                for key, values in sorted(series.items()):
+                    for bound, count in zip(BUCKETS, values):
+                        lines.append(f'{PREFIX}_{name}_bucket{format_labels(key + (("le", f"{bound:g}"),))} {count}')
+                    lines.append(f'{PREFIX}_{name}_bucket{format_labels(key + (("le", "+Inf"),))} {values[-1]}')
+                    lines.append(f'{PREFIX}_{name}_sum{format_labels(key)} {values[-2]:.6f}')
+                    lines.append(f'{PREFIX}_{name}_count{format_labels(key)} {values[-1]}')
+        return '\n'.join(lines) + '\n'
+
+
+def header(name: str, kind: str) -> list:
+    lines = [f'# HELP {PREFIX}_{name} {HELP[name]}'] if name in HELP else []
+    return lines + [f'# TYPE {PREFIX}_{name} {kind}']
+
+
+def format_labels(labels: Labels) -> str:
+    if not labels:
+        return ''
+    escaped = (str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for _, value in labels)
+    return '{' + ','.join(f'{name}="{value}"' for (name, _), value in zip(labels, escaped)) + '}'
+
+
+class TraceLog:
+
+    def __init__(self, path: Optional[str] = TRACE_PATH):
+        self.path = path
+        self._file = None
+        self._lock = threading.Lock()
+
+    def write(self, record: dict) -> None:
+        if not self.path:
+            return
+        line = json.dumps(record, default=str)
+        with self._lock:
+            if self._file is None:
+                self._file = open(self.path, 'a', buffering=1)
+            self._file.write(line + '\n')
+
+
+metrics = Metrics()
+trace_log = TraceLog()
+
+
+@contextmanager
+def traced(event: str, labels: Dict[str, str] = None, **fields) -> Iterator[dict]:
+    # times the whole event and collects its stage timings into one JSON line, if a trace file is configured
+    labels = labels or {}
+    span = {'event': event, 'at': datetime.datetime.now().isoformat(), **labels, **fields, 'stages_ms': {}}
+    token = current_span.set(span)
+    start = time.perf_counter()
+    try:
+        yield span
+    finally:
+        elapsed = time.perf_counter() - start
+        current_span.reset(token)
+        metrics.observe('stage_seconds', elapsed, stage=event, **labels)
+        span['ms'] = round(elapsed * 1000, 3)
+        trace_log.write(span)
+
+
+def endpoint(url_map, environ) -> str:
+    # labelled by the route that matched, not the raw path, so scanners probing random URLs can't add series
+    try:
+        return url_map.bind_to_environ(environ).match()[0]
+    except Exception:
+        return 'other'
+
+
+def timed_wsgi(wsgi_app, url_map):
+    # the whole request as the server sees it, so the framework's share is this minus the webhook stage
+    def app(environ, start_response):
+        with metrics.timer('wsgi', endpoint=endpoint(url_map, environ)):
+            return wsgi_app(environ, start_response)
+    return app
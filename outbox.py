@@ -0,0 +1,197 @@
+import datetime
+import os
+import random
+import threading
+import time
+from typing import Callable, Dict, Optional, Set
+
+from metrics import metrics
+from sms import Dispatcher, TwilioError
+from records import OfferStatus
+from store import BookingKey, Store, key_to_text, text_to_key
+
+BACKOFF_SECONDS = float(os.getenv('OUTBOX_BACKOFF_SECONDS', '2'))
+MAX_BACKOFF_SECONDS = 15 * 60
+MAX_ATTEMPTS = int(os.getenv('OUTBOX_MAX_ATTEMPTS', '8'))
+PER_DESTINATION_SECONDS = float(os.getenv('OUTBOX_PER_DESTINATION_SECONDS', '1'))
+# a message claimed by a sender that then died is retried once this runs out
+LEASE_SECONDS = 120
+RETENTION = datetime.timedelta(days=7)
+BATCH_SIZE = 50
+
+QUEUED = 'queued'
+SENDING = 'sending'
+SENT = 'sent'
+FAILED = 'failed'
+SKIPPED = 'skipped'
+
+# what a text about a booking is for, so it can be dropped if the booking has moved on by the time it's sent
+OFFER = 'offer'
+CANCELLATION = 'cancellation'
+
+
+def backoff(attempts: int, retry_after: float = None) -> float:
+    delay = min(MAX_BACKOFF_SECONDS, BACKOFF_SECONDS * 2 ** (attempts - 1)) * random.uniform(0.5, 1)
+    return max(delay, retry_after or 0)
+
+
+def is_retryable(error: Exception) -> bool:
+    # rate limits, Twilio's own errors and network trouble are worth another try; a bad number isn't
+    if isinstance(error, TwilioError) and error.status is not None:
+        return error.status == 429 or error.status >= 500
+    return True
+
+
+class Outbox:
+
+    def __init__(self, store: Store, dispatcher: Dispatcher):
+        self.store = store
+        self.dispatcher = dispatcher
+        self._next_slot: Dict[str, datetime.datetime] = {}
+        self._drain_at = None
+        # claimed here and still waiting on the dispatcher's pool, so a later drain mustn't claim them again
+        self._in_flight: Set[int] = set()
+        self._lock = threading.Lock()
+
+    def enqueue(self, to: str, body: str, from_: str = None, booking_key: BookingKey = None,
+                sitter_name: str = None, kind: str = None) -> int:
+        # part of the caller's transaction, so the message is queued if and only if its state change commits
+        now = datetime.datetime.now().isoformat()
+        cursor = self.store.conn.execute(
+            'INSERT INTO outbox (to_num, from_num, body, booking_key, sitter_name, kind, status, next_attempt_at, '
+            'created_at) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)',
+            (to, from_, body, key_to_text(booking_key) if booking_key is not None else None, sitter_name, kind,
+             QUEUED, now, now))
+        return cursor.lastrowid
+
+    def drain(self, wake: Callable[[float], None]) -> None:
+        # hands every due message to the dispatcher's pool, then asks wake() to call back when the next one is due
+        with self._lock:
+            self._drain_at = None
+            in_flight = list(self._in_flight)
+        # no more than the pool can get through before a lease runs out
+        limit = min(BATCH_SIZE, int(LEASE_SECONDS / self.dispatcher.limiter.interval) - len(in_flight))
+        now = datetime.datetime.now()
+        claimed = []
+        with self.store.transaction():
+            self.store.conn.execute("DELETE FROM outbox WHERE created_at < ? AND status IN ('sent', 'failed', 'skipped')",
+                                    ((now - RETENTION).isoformat(),))
+            rows = self.store.conn.execute(
+                f"SELECT id, to_num, from_num, body, attempts FROM outbox "
+                f"WHERE status IN ('queued', 'sending') AND next_attempt_at <= ? "
+                f"AND id NOT IN ({', '.join('?' for _ in in_flight)}) ORDER BY next_attempt_at LIMIT ?",
+                (now.isoformat(), *in_flight, max(limit, 0))).fetchall()
+            for message_id, to, from_, body, attempts in rows:
+                slot = self._next_slot.get(to)
+                if slot is not None and slot > now:
+                    self.store.conn.execute("UPDATE outbox SET status = 'queued', next_attempt_at = ? WHERE id = ?",
+                                            (slot.isoformat(), message_id))
+                    continue
+                self._next_slot[to] = now + datetime.timedelta(seconds=PER_DESTINATION_SECONDS)
+                self.store.conn.execute(
+                    "UPDATE outbox SET status = 'sending', attempts = attempts + 1, next_attempt_at = ? WHERE id = ?",
+                    ((now + datetime.timedelta(seconds=LEASE_SECONDS)).isoformat(), message_id))
+                claimed.append((message_id, to, from_, body, attempts + 1))
+        self._next_slot = {to: slot for to, slot in self._next_slot.items() if slot > now}
+
+        with self._lock:
+            self._in_flight.update(message[0] for message in claimed)
+        for message in claimed:
+            self.dispatcher.submit(self._deliver, message, wake)
+
+        row = self.store.conn.execute(
+            "SELECT MIN(next_attempt_at) FROM outbox WHERE status IN ('queued', 'sending')").fetchone()
+        if row[0] is not None:
+            due_in = datetime.datetime.fromisoformat(row[0]) - datetime.datetime.now()
+            self._wake(max(due_in.total_seconds(), 0), wake)
+
+    def _wake(self, delay: float, wake: Callable[[float], None]) -> None:
+        # only the earliest wake-up needs scheduling; later ones would just find nothing due
+        at = time.monotonic() + delay
+        with self._lock:
+            if self._drain_at is not None and self._drain_at <= at:
+                return
+            self._drain_at = at
+        wake(delay)
+
+    def _deliver(self, message: tuple, wake: Callable[[float], None]) -> None:
+        message_id, to, from_, body, attempts = message
+        try:
+            result = self.dispatcher.deliver(to, body, from_, attempts=1,
+                                             ready=lambda: self._ready(message_id, attempts))
+        except Exception as e:
+            if is_retryable(e) and attempts < MAX_ATTEMPTS:
+                delay = backoff(attempts, getattr(e, 'retry_after', None))
+                self._settle(message_id, QUEUED, error=str(e), retry_in=delay)
+                metrics.inc('outbox_total', event='retried')
+                self._wake(delay, wake)
+            else:
+                self._settle(message_id, FAILED, error=str(e))
+                metrics.inc('outbox_total', event='failed')
+            return
+        finally:
+            with self._lock:
+                self._in_flight.discard(message_id)
+        if result is None:
+            return
+        self._settle(message_id, SENT, sid=result.get('sid'))
+        metrics.inc('outbox_total', event='sent')
+
+    def _ready(self, message_id: int, attempts: int) -> bool:
+        with self.store.transaction():
+            if not self._lease(message_id, attempts):
+                return False
+            if not self._is_stale(message_id):
+                return True
+            self.store.conn.execute("UPDATE outbox SET status = 'skipped' WHERE id = ?", (message_id,))
+            self._record_on_booking(message_id, SKIPPED)
+        metrics.inc('outbox_total', event='skipped')
+        return False
+
+    def _is_stale(self, message_id: int) -> bool:
+        # an offer for a gig that's been filled or withdrawn since it was queued would only ask for a yes that can't
+        # be taken up, and a cancellation is pointless once the offer it follows was never sent
+        key_text, sitter_name, kind = self.store.conn.execute(
+            'SELECT booking_key, sitter_name, kind FROM outbox WHERE id = ?', (message_id,)).fetchone()
+        if kind not in [OFFER, CANCELLATION]:
+            return False
+        booking = self.store.bookings.get(text_to_key(key_text))
+        offer = booking.offers.get(sitter_name) if booking is not None else None
+        if kind == CANCELLATION:
+            return offer is not None and offer.delivery == SKIPPED
+        return offer is None or booking.accepted_by is not None or offer.status is OfferStatus.CANCELLED
+
+    def _lease(self, message_id: int, attempts: int) -> bool:
+        # the lease starts when the text is actually about to go, not when it was claimed; if another drain has
+        # claimed it again in the meantime, that one sends it instead
+        lease_until = datetime.datetime.now() + datetime.timedelta(seconds=LEASE_SECONDS)
+        cursor = self.store.conn.execute(
+            "UPDATE outbox SET next_attempt_at = ? WHERE id = ? AND status = 'sending' AND attempts = ?",
+            (lease_until.isoformat(), message_id, attempts))
+        return cursor.rowcount > 0
+
+    def _settle(self, message_id: int, status: str, sid: str = None, error: str = None,
+                retry_in: float = None) -> None:
+        next_attempt_at = datetime.datetime.now() + datetime.timedelta(seconds=retry_in or 0)
+        with self.store.transaction():
+            self.store.conn.execute(
+                'UPDATE outbox SET status = ?, sid = ?, last_error = ?, next_attempt_at = ? WHERE id = ?',
+                (status, sid, error, next_attempt_at.isoformat(), message_id))
+            if status in [SENT, FAILED]:
+                self._record_on_booking(message_id, status)
+
+    def _record_on_booking(self, message_id: int, status: str) -> None:
+        key_text, sitter_name = self.store.conn.execute(
+            'SELECT booking_key, sitter_name FROM outbox WHERE id = ?', (message_id,)).fetchone()
+        if key_text is None or sitter_name is None:
+            return
+        key = text_to_key(key_text)
+        booking = self.store.bookings.get(key)
+        if booking is None or sitter_name not in booking.offers:
+            return
+        booking.offers[sitter_name].delivery = status
+        self.store.bookings[key] = booking
+
+    def status(self, message_id: int) -> Optional[str]:
+        row = self.store.conn.execute('SELECT status FROM outbox WHERE id = ?', (message_id,)).fetchone()
+        return row[0] if row is not None else None
@@ -0,0 +1,14 @@
+import os
+
+DEFAULT_COUNTRY_CODE = os.getenv('TWILIO_COUNTRY_CODE') or '1'
+
+
+def to_e164(num: str, country_code: str = DEFAULT_COUNTRY_CODE) -> str:
+    digits = ''.join(char for char in num if char.isdigit())
+    if num.strip().startswith('+') and 8 <= len(digits) <= 15:
+        return f'+{digits}'
+    if len(digits) == 10:
+        return f'+{country_code}{digits}'
+    if len(digits) == len(country_code) + 10 and digits.startswith(country_code):
+        return f'+{digits}'
+    raise ValueError(f'"{num}" is not a phone number')
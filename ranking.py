@@ -0,0 +1,125 @@
+import argparse
+import datetime
+import statistics
+from typing import Iterable, List, Optional
+
+from records import Booking, Sitter
+
+PRIOR_YES = 1
+PRIOR_NO = 1
+DEFAULT_LATENCY_SECONDS = 15 * 60
+LATENCY_SAMPLES = 25
+LOAD_WINDOW = datetime.timedelta(days=30)
+LOAD_PENALTY = 0.25
+
+
+def new_stats() -> dict:
+    return {'offers': 0, 'yes': 0, 'no': 0, 'timeouts': 0, 'latencies': [], 'gigs': []}
+
+
+def record_offer(stats: dict) -> None:
+    stats['offers'] += 1
+
+
+def record_reply(stats: dict, accepted: bool, latency: datetime.timedelta) -> None:
+    stats['yes' if accepted else 'no'] += 1
+    stats['latencies'] = (stats['latencies'] + [latency.total_seconds()])[-LATENCY_SAMPLES:]
+
+
+def record_timeout(stats: dict) -> None:
+    stats['timeouts'] += 1
+
+
+def record_gig(stats: dict, start: datetime.datetime, now: datetime.datetime = None) -> None:
+    now = now or datetime.datetime.now()
+    stats['gigs'] = [gig for gig in stats['gigs'] if abs(gig - now) <= LOAD_WINDOW] + [start]
+
+
+def acceptance_rate(stats: dict) -> float:
+    replies = stats['yes'] + stats['no'] + stats['timeouts']
+    return (stats['yes'] + PRIOR_YES) / (replies + PRIOR_YES + PRIOR_NO)
+
+
+def median_latency(stats: dict) -> float:
+    return statistics.median(stats['latencies']) if stats['latencies'] else DEFAULT_LATENCY_SECONDS
+
+
+def recent_load(stats: dict, now: datetime.datetime = None) -> int:
+    now = now or datetime.datetime.now()
+    return sum(1 for gig in stats['gigs'] if abs(gig - now) <= LOAD_WINDOW)
+
+
+def rescore_at(stats: dict, now: datetime.datetime = None) -> Optional[datetime.datetime]:
+    # recent_load, and so the score, next changes when one of the gigs comes into the window or drops out of it
+    now = now or datetime.datetime.now()
+    return min((edge for gig in stats['gigs'] for edge in (gig - LOAD_WINDOW, gig + LOAD_WINDOW) if edge > now),
+               default=None)
+
+
+def score(stats: dict, now: datetime.datetime = None) -> float:
+    # roughly the chance of a yes per minute spent waiting, discounted for sitters who are already busy
+    return acceptance_rate(stats) / (1 + median_latency(stats) / 60) / (1 + LOAD_PENALTY * recent_load(stats, now))
+
+
+def is_available(sitter: Sitter, start: datetime.datetime, end: datetime.datetime) -> bool:
+    # sitters who haven't declared any windows are assumed to be free whenever
+    if not sitter.availability:
+        return True
+    for weekday, window_start, window_end in sitter.availability:
+        if weekday != start.weekday():
+            continue
+        opens = datetime.datetime.combine(start.date(), window_start)
+        closes = datetime.datetime.combine(start.date(), window_end)
+        if closes <= opens:
+            closes += datetime.timedelta(days=1)
+        if opens <= start and end <= closes:
+            return True
+    return False
+
+
+def expected_wait(ranked_stats: Iterable[dict], offer_timeout: datetime.timedelta) -> float:
+    # seconds until someone says yes (or the list runs out) when offering one at a time in this order
+    expected, still_waiting = 0.0, 1.0
+    for stats in ranked_stats:
+        p_yes = acceptance_rate(stats)
+        replies = stats['yes'] + stats['no'] + stats['timeouts']
+        p_timeout = stats['timeouts'] / replies if replies else 0.0
+        latency = min(median_latency(stats), offer_timeout.total_seconds())
+        expected += still_waiting * ((1 - p_timeout) * latency + p_timeout * offer_timeout.total_seconds())
+        still_waiting *= 1 - p_yes
+    return expected
+
+
+def time_to_book(booking: Booking) -> Optional[datetime.timedelta]:
+    if booking.accepted_at is None or booking.requested_at is None:
+        return None
+    return booking.accepted_at - booking.requested_at
+
+
+def history(store) -> List[datetime.timedelta]:
+    bookings = [booking for _, booking in store.bookings.items()]
+    bookings += [booking for _, _, booking in store.archived()]
+    return [waited for waited in map(time_to_book, bookings) if waited is not None]
+
+
+if __name__ == '__main__':
+    from store import Store
+
+    parser = argparse.ArgumentParser(description='Report how long bookings take to fill, and what ranking buys.')
+    parser.add_argument('--db', help='household database (defaults to SITTER_BOT_DB)')
+    parser.add_argument('--offer-timeout-minutes', type=float, default=1)
+    args = parser.parse_args()
+
+    store_ = Store(args.db) if args.db else Store()
+    waits = sorted(waited.total_seconds() / 60 for waited in history(store_))
+    if waits:
+        print(f'{len(waits)} booked: median {statistics.median(waits):.1f} min, '
+              f'p90 {waits[int(0.9 * (len(waits) - 1))]:.1f} min to book')
+    else:
+        print('No bookings have been accepted yet.')
+
+    offer_timeout = datetime.timedelta(minutes=args.offer_timeout_minutes)
+    roster = [stats for _, stats in store_.sitter_stats.items()]
+    ranked = [stats for _, stats in store_.sitter_stats.ranked_items()]
+    print(f'expected wait offering in roster order: {expected_wait(roster, offer_timeout) / 60:.1f} min, '
+          f'by rank: {expected_wait(ranked, offer_timeout) / 60:.1f} min')
@@ -0,0 +1,153 @@
+import datetime
+import enum
+import pickle
+from typing import Dict, Iterable, List, Optional, Tuple
+
+EPOCH = datetime.datetime(1970, 1, 1)
+MICROSECOND = datetime.timedelta(microseconds=1)
+
+AvailabilityWindow = Tuple[int, datetime.time, datetime.time]
+
+
+class OfferStatus(enum.Enum):
+    PENDING = 'pending'
+    YES = 'yes'
+    NO = 'no'
+    CANCELLED = 'cancelled'
+
+
+# position in this list is what gets stored, so only ever append to it
+STATUSES = [OfferStatus.PENDING, OfferStatus.YES, OfferStatus.NO, OfferStatus.CANCELLED]
+
+
+class Record:
+    __slots__ = ()
+
+    def __eq__(self, other) -> bool:
+        return type(self) is type(other) and all(getattr(self, name) == getattr(other, name)
+                                                 for name in self.__slots__)
+
+    def __repr__(self) -> str:
+        fields = ', '.join(f'{name}={getattr(self, name)!r}' for name in self.__slots__)
+        return f'{type(self).__name__}({fields})'
+
+    def dumps(self) -> bytes:
+        return pickle.dumps(self.to_row(), pickle.HIGHEST_PROTOCOL)
+
+    def to_row(self) -> tuple:
+        raise NotImplementedError
+
+
+class Sitter(Record):
+    __slots__ = ('name', 'num', 'availability', 'next_action')
+
+    def __init__(self, name: str, num: str, availability: Iterable[AvailabilityWindow] = (),
+                 next_action: str = None):
+        self.name = name
+        self.num = num
+        self.availability = list(availability)
+        self.next_action = next_action
+
+    def to_row(self) -> tuple:
+        return (self.name, self.num,
+                tuple((weekday, minutes(start), minutes(end)) for weekday, start, end in self.availability),
+                self.next_action)
+
+    @classmethod
+    def from_row(cls, row: tuple) -> 'Sitter':
+        name, num, availability, next_action = row
+        return cls(name, num, [(weekday, from_minutes(start), from_minutes(end)) for weekday, start, end in availability],
+                   next_action)
+
+    @classmethod
+    def from_dict(cls, sitter: dict) -> 'Sitter':
+        return cls(sitter['name'], sitter['num'], sitter.get('availability') or (), sitter.get('next action'))
+
+
+class Offer(Record):
+    __slots__ = ('status', 'offered_at', 'replied_at', 'wave', 'delivery')
+
+    def __init__(self, offered_at: datetime.datetime = None, wave: int = 0, status: OfferStatus = OfferStatus.PENDING,
+                 replied_at: datetime.datetime = None, delivery: str = None):
+        self.status = status
+        self.offered_at = offered_at
+        self.replied_at = replied_at
+        self.wave = wave
+        self.delivery = delivery
+
+    @property
+    def is_open(self) -> bool:
+        return self.status is OfferStatus.PENDING
+
+    def to_row(self) -> tuple:
+        return (STATUSES.index(self.status), stamp(self.offered_at), stamp(self.replied_at), self.wave, self.delivery)
+
+    @classmethod
+    def from_row(cls, row: tuple) -> 'Offer':
+        status, offered_at, replied_at, wave, delivery = row
+        return cls(unstamp(offered_at), wave, STATUSES[status], unstamp(replied_at), delivery)
+
+
+class Booking(Record):
+    __slots__ = ('offers', 'accepted_by', 'requested_at', 'accepted_at')
+
+    def __init__(self, offers: Dict[str, Offer] = None, accepted_by: str = None,
+                 requested_at: datetime.datetime = None, accepted_at: datetime.datetime = None):
+        self.offers = offers if offers is not None else {}
+        self.accepted_by = accepted_by
+        self.requested_at = requested_at
+        self.accepted_at = accepted_at
+
+    def open_offers(self) -> List[str]:
+        return [name for name, offer in self.offers.items() if offer.is_open]
+
+    def waves(self) -> int:
+        return max((offer.wave for offer in self.offers.values()), default=-1) + 1
+
+    def to_row(self) -> tuple:
+        return (self.accepted_by, stamp(self.requested_at), stamp(self.accepted_at),
+                tuple((name,) + offer.to_row() for name, offer in self.offers.items()))
+
+    @classmethod
+    def from_row(cls, row: tuple) -> 'Booking':
+        accepted_by, requested_at, accepted_at, offers = row
+        return cls({offer[0]: Offer.from_row(offer[1:]) for offer in offers}, accepted_by, unstamp(requested_at),
+                   unstamp(accepted_at))
+
+    @classmethod
+    def from_dict(cls, booking: dict) -> 'Booking':
+        # the nested dicts bookings were kept in before, where an offer was its timestamp until it became a string
+        wave_of = {name: wave for wave, (_, names) in enumerate(booking.get('waves', [])) for name in names}
+        delivery = booking.get('delivery', {})
+        offers = {}
+        for name, offer in booking['offered'].items():
+            if isinstance(offer, datetime.datetime):
+                offers[name] = Offer(offer, wave_of.get(name, 0), delivery=delivery.get(name))
+            else:
+                offers[name] = Offer(None, wave_of.get(name, 0), OfferStatus(offer), delivery=delivery.get(name))
+        accepted_by = booking.get('accepted_by')
+        if accepted_by is None:
+            accepted_by = next((name for name, offer in offers.items() if offer.status is OfferStatus.YES), None)
+        return cls(offers, accepted_by, booking.get('requested_at'), booking.get('accepted_at'))
+
+
+def stamp(value: Optional[datetime.datetime]) -> Optional[int]:
+    return (value - EPOCH) // MICROSECOND if value is not None else None
+
+
+def unstamp(value: Optional[int]) -> Optional[datetime.datetime]:
+    return EPOCH + value * MICROSECOND if value is not None else None
+
+
+def minutes(value: datetime.time) -> int:
+    return value.hour * 60 + value.minute
+
+
+def from_minutes(value: int) -> datetime.time:
+    return datetime.time(*divmod(value, 60))
+
+
+def loads(record_type, blob: bytes):
+    # rows written before the slotted records were pickled dicts
+    row = pickle.loads(blob)
+    return record_type.from_dict(row) if isinstance(row, dict) else record_type.from_row(row)
@@ -0,0 +1,37 @@
+import datetime
+from typing import Iterator, List, NamedTuple, Tuple
+
+WEEKLY = datetime.timedelta(days=7)
+# how far ahead the occurrences of a recurring booking are made into bookings and offered to sitters
+HORIZON = datetime.timedelta(days=7)
+
+
+class Recurrence(NamedTuple):
+    rule: str
+    next_start: datetime.datetime
+    seconds: float
+    every: datetime.timedelta = WEEKLY
+
+
+def new_recurrence(start: datetime.datetime, end: datetime.datetime,
+                   every: datetime.timedelta = WEEKLY) -> Recurrence:
+    # named after the slot rather than the first date, so "stop every tuesday 6pm to 10pm" finds it again
+    return Recurrence(f'{start:%a %H:%M} {end - start} every {every.days}d', start, (end - start).total_seconds(),
+                      every)
+
+
+def occurrences(recurrence: Recurrence) -> Iterator[Tuple[datetime.datetime, datetime.datetime]]:
+    start, length = recurrence.next_start, datetime.timedelta(seconds=recurrence.seconds)
+    while True:
+        yield start, start + length
+        start += recurrence.every
+
+
+def within(recurrence: Recurrence,
+           horizon: datetime.datetime) -> Tuple[List[Tuple[datetime.datetime, datetime.datetime]], datetime.datetime]:
+    # the occurrences that have come within the horizon, and where the next one starts
+    keys = []
+    for key in occurrences(recurrence):
+        if key[0] > horizon:
+            return keys, key[0]
+        keys.append(key)
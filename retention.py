@@ -0,0 +1,40 @@
+import datetime
+from typing import Optional
+
+from records import Booking
+from store import BookingKey, booking_end
+
+FINISHED = 'finished'
+EXPIRED = 'expired'
+TIMED_OUT = 'timed out'
+# called off by the owner rather than retired here
+CANCELLED = 'cancelled'
+
+
+def requested_at(booking: Booking) -> Optional[datetime.datetime]:
+    if booking.requested_at is not None:
+        return booking.requested_at
+    offered_at = [offer.offered_at for offer in booking.offers.values() if offer.offered_at is not None]
+    return min(offered_at) if offered_at else None
+
+
+def archive_reason(key: BookingKey, booking: Booking, timeout: datetime.timedelta,
+                   now: datetime.datetime = None) -> Optional[str]:
+    now = now or datetime.datetime.now()
+    if booking.accepted_by is not None:
+        return FINISHED if booking_end(key) <= now else None
+    if key[0] <= now:
+        return EXPIRED
+    asked_at = requested_at(booking)
+    if asked_at is not None and now - asked_at >= timeout:
+        return TIMED_OUT
+    return None
+
+
+def next_check(key: BookingKey, booking: Booking, timeout: datetime.timedelta) -> datetime.datetime:
+    if booking.accepted_by is not None:
+        return booking_end(key)
+    asked_at = requested_at(booking)
+    if asked_at is None:
+        return key[0]
+    return min(key[0], asked_at + timeout)
@@ -0,0 +1,198 @@
+import argparse
+import csv
+import io
+import sys
+from typing import Iterable, Iterator, List, NamedTuple, Optional, Tuple
+
+from commands import ADD, commands
+from phones import to_e164
+from records import Sitter
+from store import Store, booking_end
+
+NAME_HEADERS = ['name', 'first name', 'given name', 'full name', 'sitter']
+NUM_HEADERS = ['num', 'number', 'phone', 'phone number', 'mobile', 'mobile phone', 'cell', 'tel']
+SITTER_COLUMNS = ['name', 'num']
+BOOKING_COLUMNS = ['start', 'end', 'status', 'accepted_by', 'requested_at', 'accepted_at', 'offers']
+
+
+class Parsed(NamedTuple):
+    entries: List[Tuple[str, str]]
+    errors: List[str]
+
+
+class ImportResult(NamedTuple):
+    added: List[str]
+    updated: List[str]
+    errors: List[str]
+
+
+def first_name(name: str) -> Optional[str]:
+    words = name.replace(',', ' ').split()
+    return words[0].lower() if words else None
+
+
+def parse_lines(text: str) -> Parsed:
+    # one "name number" per line, the same as adding a single sitter by text
+    entries, errors = [], []
+    for line in text.splitlines():
+        if not line.strip():
+            continue
+        command = commands.classify(line)
+        if command.intent == ADD:
+            entries.append((command.args['name'], command.args['num']))
+        else:
+            errors.append(line.strip())
+    return Parsed(entries, errors)
+
+
+def parse_csv(text: str) -> Parsed:
+    rows = [row for row in csv.reader(io.StringIO(text)) if any(cell.strip() for cell in row)]
+    if not rows:
+        return Parsed([], [])
+    header = [cell.strip().lower() for cell in rows[0]]
+    name_idx = next((idx for idx, cell in enumerate(header) if cell in NAME_HEADERS), None)
+    num_idx = next((idx for idx, cell in enumerate(header) if cell in NUM_HEADERS), None)
+    if name_idx is None or num_idx is None:
+        # no header we recognise: name then number
+        name_idx, num_idx = 0, 1
+    else:
+        rows = rows[1:]
+    entries, errors = [], []
+    for row in rows:
+        name = first_name(row[name_idx]) if len(row) > name_idx else None
+        if name is None or len(row) <= num_idx:
+            errors.append(','.join(row))
+        else:
+            entries.append((name, row[num_idx]))
+    return Parsed(entries, errors)
+
+
+def parse_vcards(text: str) -> Parsed:
+    # folded lines carry on with a leading space or tab
+    lines = []
+    for line in text.splitlines():
+        if line[:1] in [' ', '\t'] and lines:
+            lines[-1] += line[1:]
+        else:
+            lines.append(line)
+    entries, errors = [], []
+    card = None
+    for line in lines:
+        field, _, value = line.partition(':')
+        name, *params = field.upper().split(';')
+        name = name.rsplit('.', 1)[-1]
+        if name == 'BEGIN':
+            card = {'tels': []}
+        elif card is None:
+            continue
+        elif name == 'FN':
+            card['fn'] = value
+        elif name == 'N':
+            card['n'] = value.split(';')
+        elif name == 'TEL':
+            # a mobile number is the one that can get texts, so it goes first
+            cell = any('CELL' in param for param in params)
+            card['tels'].insert(0 if cell else len(card['tels']), value.replace('tel:', ''))
+        elif name == 'END':
+            given = card['n'][1] if len(card.get('n', [])) > 1 and card['n'][1] else None
+            name = first_name(given or card.get('fn', ''))
+            if name is None or not card['tels']:
+                errors.append(card.get('fn') or 'a contact with no name')
+            else:
+                entries.append((name, card['tels'][0]))
+            card = None
+    return Parsed(entries, errors)
+
+
+def parse(text: str) -> Parsed:
+    if 'BEGIN:VCARD' in text.upper():
+        return parse_vcards(text)
+    first_line = text.strip().splitlines()[0] if text.strip() else ''
+    if ',' in first_line or '\t' in first_line:
+        return parse_csv(text.replace('\t', ','))
+    return parse_lines(text)
+
+
+def import_sitters(store: Store, entries: Iterable[Tuple[str, str]], errors: List[str] = ()) -> ImportResult:
+    # every number is checked before anything is written, then the whole roster goes in as one write
+    errors = list(errors)
+    by_num, names = {}, {}
+    for name, num in entries:
+        try:
+            num = to_e164(num)
+        except ValueError:
+            errors.append(f'{name} {num}')
+            continue
+        if num in by_num and by_num[num] != name:
+            errors.append(f'{name} {num} (same number as {by_num[num]})')
+            continue
+        if name in names and names[name] != num:
+            errors.append(f'{name} {num} (already listed with {names[name]})')
+            continue
+        by_num[num], names[name] = name, num
+
+    added, updated, sitters = [], [], []
+    with store.transaction():
+        taken = dict(store.conn.execute('SELECT num, name FROM sitters'))
+        for name, num in names.items():
+            if taken.get(num, name) != name:
+                errors.append(f'{name} {num} (already {taken[num]}\'s number)')
+                continue
+            sitter = store.sitters.get(name)
+            if sitter is None:
+                sitters.append((name, Sitter(name, num)))
+                added.append(name)
+            elif sitter.num != num:
+                sitter.num = num
+                sitters.append((name, sitter))
+                updated.append(name)
+        store.sitters.put_many(sitters)
+    return ImportResult(added, updated, errors)
+
+
+def csv_line(row: Iterable) -> str:
+    out = io.StringIO()
+    csv.writer(out).writerow(['' if cell is None else cell for cell in row])
+    return out.getvalue()
+
+
+def export_sitters(store: Store) -> Iterator[str]:
+    yield csv_line(SITTER_COLUMNS)
+    for name, sitter in store.sitters.stream():
+        yield csv_line([name, sitter.num])
+
+
+def export_bookings(store: Store) -> Iterator[str]:
+    yield csv_line(BOOKING_COLUMNS)
+    for key, booking in store.bookings.stream():
+        yield booking_line(key, 'booked' if booking.accepted_by is not None else 'open', booking)
+    for key, reason, booking in store.archived():
+        yield booking_line(key, reason, booking)
+
+
+def booking_line(key, status: str, booking) -> str:
+    return csv_line([key[0].isoformat(), booking_end(key).isoformat(), status, booking.accepted_by,
+                     booking.requested_at.isoformat() if booking.requested_at else None,
+                     booking.accepted_at.isoformat() if booking.accepted_at else None, len(booking.offers)])
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Import sitters from CSV or vCard, or export the roster or bookings.')
+    parser.add_argument('--db', help='household database (defaults to SITTER_BOT_DB)')
+    subparsers = parser.add_subparsers(dest='action', required=True)
+    import_parser = subparsers.add_parser('import', help='add or update sitters from a CSV, vCard or text file')
+    import_parser.add_argument('path', help='file to read, or - for stdin')
+    export_parser = subparsers.add_parser('export', help='write CSV to stdout')
+    export_parser.add_argument('what', choices=['sitters', 'bookings'])
+    args = parser.parse_args()
+
+    store_ = Store(args.db) if args.db else Store()
+    if args.action == 'import':
+        with (open(args.path, encoding='utf-8-sig') if args.path != '-' else sys.stdin) as f:
+            parsed = parse(f.read())
+        result = import_sitters(store_, parsed.entries, parsed.errors)
+        print(f'Added {len(result.added)} and updated {len(result.updated)} sitters.')
+        for error in result.errors:
+            print(f'Skipped: {error}', file=sys.stderr)
+    else:
+        sys.stdout.writelines(export_sitters(store_) if args.what == 'sitters' else export_bookings(store_))
@@ -0,0 +1,118 @@
+import heapq
+import itertools
+import threading
+import time
+import traceback
+from concurrent.futures import Future
+from contextvars import Context, ContextVar, copy_context
+from typing import Any, Callable, Sequence
+
+from metrics import traced
+
+
+class Scheduler:
+
+    def __init__(self, context_vars: Sequence[ContextVar] = ()):
+        # values of these are captured when a call is scheduled and restored while it runs
+        self.context_vars = list(context_vars)
+        self._heap = []
+        self._counter = itertools.count()
+        self._wakeup = threading.Condition()
+        self._stopped = False
+        self._owner = None
+        self._queued_once = set()
+
+    def call_at(self, when: float, fn: Callable, *args) -> None:
+        with self._wakeup:
+            heapq.heappush(self._heap, (when, next(self._counter), fn, args, self._snapshot()))
+            self._wakeup.notify()
+
+    def call_later(self, delay_seconds: float, fn: Callable, *args) -> None:
+        self.call_at(time.monotonic() + max(delay_seconds, 0), fn, *args)
+
+    def call_soon(self, fn: Callable, *args) -> None:
+        self.call_at(time.monotonic(), fn, *args)
+
+    def call_soon_once(self, fn: Callable, *args) -> None:
+        # collapse repeats of the same call that arrive before the first one has run
+        key = (fn, args, self._snapshot())
+        with self._wakeup:
+            if key in self._queued_once:
+                return
+            self._queued_once.add(key)
+        self.call_soon(self._run_queued_once, key)
+
+    def _run_queued_once(self, key: tuple) -> None:
+        with self._wakeup:
+            self._queued_once.discard(key)
+        fn, args, _ = key
+        fn(*args)
+
+    def _snapshot(self) -> tuple:
+        return tuple(var.get() for var in self.context_vars)
+
+    def call(self, fn: Callable, *args) -> Any:
+        # run fn on the scheduler thread and wait for it, so all state changes happen one at a time
+        if self._owner is None or self._owner is threading.current_thread():
+            return fn(*args)
+        future = Future()
+        self.call_soon(_resolve, future, copy_context(), fn, args)
+        return future.result()
+
+    def pending(self) -> int:
+        with self._wakeup:
+            return len(self._heap)
+
+    def stop(self) -> None:
+        with self._wakeup:
+            self._stopped = True
+            self._wakeup.notify()
+
+    def run_once(self, block: bool = True) -> bool:
+        with self._wakeup:
+            while not self._stopped:
+                if self._heap and self._heap[0][0] <= time.monotonic():
+                    _, _, fn, args, snapshot = heapq.heappop(self._heap)
+                    break
+                if not block:
+                    return False
+                # sleep until the earliest deadline, or indefinitely if nothing is scheduled
+                timeout = self._heap[0][0] - time.monotonic() if self._heap else None
+                self._wakeup.wait(timeout)
+            else:
+                return False
+        tokens = [var.set(value) for var, value in zip(self.context_vars, snapshot)]
+        try:
+            with traced('tick', {'task': task_name(fn, args)}):
+                fn(*args)
+        except Exception:
+            traceback.print_exc()
+        finally:
+            for var, token in zip(self.context_vars, tokens):
+                var.reset(token)
+        return True
+
+    def run(self) -> None:
+        self._owner = threading.current_thread()
+        try:
+            while self.run_once():
+                pass
+        finally:
+            self._owner = None
+
+
+def _resolve(future: Future, context: Context, fn: Callable, args: tuple) -> None:
+    # runs in the caller's context, so whatever it was tracing or whichever tenant it had active carries over
+    try:
+        future.set_result(context.run(fn, *args))
+    except BaseException as e:
+        future.set_exception(e)
+
+
+def task_name(fn: Callable, args: tuple) -> str:
+    # calls made through call() and call_soon_once() are named after what they end up running
+    if fn is _resolve:
+        fn = args[2]
+    elif getattr(fn, '__func__', None) is Scheduler._run_queued_once:
+        fn = args[0][0]
+    return getattr(fn, '__name__', type(fn).__name__)
@@ -1,116 +1,441 @@
 import datetime
-from multiprocessing import Process
+import hmac
 import os
-import time
-from typing import Tuple, Dict
-
-import parsedatetime as pdt
-import pickle
-
-from flask import request, Flask
-from twilio.rest import Client as TwilioClient
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+from contextvars import copy_context
+from functools import wraps
+from threading import Thread
+from typing import List, Optional, Tuple
+
+from flask import abort, jsonify, request, Flask, Response
 from twilio.twiml.messaging_response import MessagingResponse
 
-twilio_client = TwilioClient(os.getenv('TWILIO_SID'), os.getenv('TWILIO_TOKEN'))
+from commands import ADD, BOOK, BUSY, CANCEL, CHOICE, FREE, HOURS, LIST, NO, RECUR, REMOVE, STATUS, UPCOMING, YES, \
+    Command, commands
+from dateparse import WEEKDAYS, calendar, parse_booking_window, parse_day_or_window, parse_recurring_window
+from fanout import FanOutPolicy, cancel_open_offers, start_wave, wave_deadline
+from metrics import current_span, metrics, timed_wsgi, traced
+from outbox import CANCELLATION, OFFER, SENT
+from ranking import is_available, record_gig, record_offer, record_reply, record_timeout
+from records import AvailabilityWindow, Booking, Offer, OfferStatus, Sitter
+from recurring import HORIZON as RECURRING_HORIZON, new_recurrence, within
+from roster import export_bookings, export_sitters, import_sitters, parse as parse_roster
+from retention import CANCELLED, FINISHED, archive_reason, next_check
+from scheduler import Scheduler
+from sms import Dispatcher
+from phones import to_e164
+from store import BookingKey, booking_end
+from tenants import Current, TenantRegistry, UnknownTenant, current_tenant
 
 MY_CELL = os.getenv('MY_CELL')
 BOT_NUM = os.getenv('MY_TWILIO_NUM')
-COUNTRY_CODE = f'+{os.getenv("TWILIO_COUNTRY_CODE")}'
+# the import and export endpoints stay switched off unless this is set
+ADMIN_TOKEN = os.getenv('SITTER_BOT_ADMIN_TOKEN')
 TIMEOUT_MINUTES = 120
+BOOKING_TIMEOUT = datetime.timedelta(minutes=TIMEOUT_MINUTES)
+OFFER_TIMEOUT = datetime.timedelta(minutes=1)
+# OFFER_TIMEOUT = datetime.timedelta(minutes=60)
+FAN_OUT = FanOutPolicy(first_timeout=OFFER_TIMEOUT)
+# acknowledge each webhook straight away and text the reply once the command has been handled
+FAST_ACK = bool(os.getenv('SITTER_BOT_FAST_ACK'))
+INBOX_WORKERS = int(os.getenv('SITTER_BOT_INBOX_WORKERS', '4'))
+FAILED_REPLY = 'Sorry, something went wrong, please try again.'
+# an import's reply is a text, so only the first few problems get listed
+IMPORT_ERRORS_SHOWN = 3
+# short lines, so a page of answers to "list", "status" or "upcoming" fits in three SMS segments
+QUERY_PAGE_SIZE = 6
+QUERY_LINE_LENGTH = 60
 
 help_add = 'You can add a sitter by giving me their first name and 10-digit phone number'
 help_text = help_add + ', or book a sitter by ' \
                        'specifying a date and time.  You can also remove a sitter from the list ' \
-                       'with "delete" or "remove" and then their first name.'
-
-app = Flask(__name__)
-app.config.from_object(__name__)
-
-cal = pdt.Calendar()
+                       'with "delete" or "remove" and then their first name.  Text "list", "status" ' \
+                       'or "upcoming" to see the sitters, open bookings or booked gigs, "cancel" and a date and time ' \
+                       'to call a booking off, or "every" and a day and time (e.g. "every tuesday 6pm ' \
+                       'to 10pm") to book the same slot each week.'
+
+sms = Dispatcher(os.getenv('TWILIO_SID'), os.getenv('TWILIO_TOKEN'), BOT_NUM)
+tenants = TenantRegistry(sms, BOT_NUM, MY_CELL)
+
+# each of these resolves to the household whose text or scheduled event is being handled
+store = Current(tenants, 'store')
+sitters = Current(tenants, 'sitters')
+bookings = Current(tenants, 'bookings')
+owner_updates = Current(tenants, 'owner_updates')
+outbox = Current(tenants, 'outbox')
+inbox = Current(tenants, 'inbox')
+
+scheduler = Scheduler(context_vars=[current_tenant])
+inbox_workers = ThreadPoolExecutor(max_workers=INBOX_WORKERS, thread_name_prefix='inbox')
+# when each household's next recurring occurrence is due to be booked, so it only ever has one wakeup waiting
+recurring_wakeups = {}
+
+
+def atomic(fn):
+    # a household's read-modify-writes each commit as a whole, so workers in other processes never interleave
+    @wraps(fn)
+    def wrapper(*args):
+        with store.transaction():
+            return fn(*args)
+    return wrapper
+
+
+def create_app(prewarm: bool = bool(os.getenv('SITTER_BOT_PREWARM'))) -> Flask:
+    app = Flask(__name__)
+    app.config.from_object(__name__)
+    app.add_url_rule('/bot', view_func=bot, methods=['POST'])
+    app.add_url_rule('/metrics', view_func=metrics_page, methods=['GET'])
+    app.add_url_rule('/sitters', view_func=import_page, methods=['POST'])
+    app.add_url_rule('/export/<any(sitters, bookings):what>.csv', view_func=export_page, methods=['GET'])
+    app.wsgi_app = timed_wsgi(app.wsgi_app, app.url_map)
+    if prewarm:
+        warm_up()
+    return app
+
+
+def warm_up() -> None:
+    if BOT_NUM:
+        # opens the default household's database and runs any pending migrations
+        store.conn
+    sms.start()
+    calendar()
+    parse_booking_request('tomorrow 6pm to 10pm')
+
+
+def metrics_page() -> Response:
+    return Response(metrics.render(), mimetype='text/plain; version=0.0.4')
+
+
+def admin_tenant():
+    authorization = request.headers.get('Authorization', '')
+    if not ADMIN_TOKEN or not hmac.compare_digest(authorization.encode(), f'Bearer {ADMIN_TOKEN}'.encode()):
+        abort(404)
+    try:
+        return tenants.get(to_e164(request.args['bot_num']) if 'bot_num' in request.args else BOT_NUM)
+    except (UnknownTenant, ValueError):
+        abort(404)
 
 
-def load_from_pickle(var_name: str) -> dict:
-    payload = {}
-    if os.path.exists(f'{var_name}.p'):
-        payload = pickle.load(open(f'{var_name}.p', 'rb'))
-    return payload
+def import_page() -> Response:
+    tenant = admin_tenant()
+    with tenants.activate(tenant.bot_num):
+        result = scheduler.call(import_roster, request.get_data(as_text=True))
+    return jsonify(result._asdict())
 
 
-sitters, bookings = load_from_pickle('sitters'), load_from_pickle('bookings')
-sitters_num_name_lookup = {v['num']: k for k, v in sitters.items()}
+def export_page(what: str) -> Response:
+    # the rows are written out as they're read, so a long history never sits in memory
+    tenant = admin_tenant()
+    rows = export_sitters(tenant.store) if what == 'sitters' else export_bookings(tenant.store)
+    return Response(rows, mimetype='text/csv')
 
 
-@app.route('/bot', methods=['POST'])
 def bot() -> str:
-    from_ = request.values.get('From')
-    body = request.values.get('Body').lower()
-
+    with traced('webhook', sid=request.values.get('MessageSid'), to=request.values.get('To')) as span:
+        try:
+            with tenants.activate(request.values.get('To') or BOT_NUM) as tenant:
+                if FAST_ACK and request.values.get('MessageSid'):
+                    response = acknowledge(request.values.get('MessageSid'), request.values.get('From'),
+                                           request.values.get('Body'))
+                else:
+                    response = handle_once(request.values.get('MessageSid'), tenant.owner,
+                                           request.values.get('From'), request.values.get('Body').lower())
+                span.setdefault('outcome', 'handled')
+        except UnknownTenant:
+            span['outcome'] = 'unknown tenant'
+            response = str(MessagingResponse())
+        metrics.inc('webhooks_total', outcome=span['outcome'])
+        return response
+
+
+def handle_once(sid: str, owner: str, from_: str, body: str) -> str:
+    if not sid:
+        return handle_text(owner, from_, body)
+    with metrics.timer('dedupe'):
+        first_delivery = store.record_inbound(sid)
+    if not first_delivery:
+        # Twilio retried a webhook that was already handled, maybe by another worker: answer it the same way
+        current_span.get()['outcome'] = 'duplicate'
+        return store.inbound_response(sid) or str(MessagingResponse())
+    try:
+        response = handle_text(owner, from_, body)
+    except BaseException:
+        store.forget_inbound(sid)
+        raise
+    store.save_inbound_response(sid, response)
+    return response
+
+
+def acknowledge(sid: str, from_: Optional[str], body: Optional[str]) -> str:
+    # all Twilio has to hear is that the text arrived; it's handled on the inbox pool and answered by the REST API
+    if not from_ or body is None:
+        current_span.get()['outcome'] = 'invalid'
+        return str(MessagingResponse())
+    with metrics.timer('dedupe'), store.transaction():
+        if not store.record_inbound(sid):
+            current_span.get()['outcome'] = 'duplicate'
+            return str(MessagingResponse())
+        inbox.enqueue(sid, from_, body)
+    current_span.get()['outcome'] = 'queued'
+    scheduler.call_soon_once(drain_inbox)
+    return str(MessagingResponse())
+
+
+def drain_inbox() -> None:
+    inbox.drain(submit=lambda message: inbox_workers.submit(copy_context().run, handle_queued, *message),
+                wake=lambda delay: scheduler.call_later(delay, drain_inbox))
+
+
+def handle_queued(message_id: int, from_: str, body: str) -> None:
+    # the sender's next text isn't picked up until this one is finished, so replies go out in the order asked
+    tenant = tenants.get()
+    error = None
+    try:
+        with metrics.timer('handle_queued'):
+            response = reply_to(tenant.owner, from_, body.lower())
+    except Exception as e:
+        traceback.print_exc()
+        # the webhook has long since been answered, so a text is the only way they'll know to send it again
+        response, error = FAILED_REPLY, repr(e)
+    with store.transaction():
+        if response:
+            outbox.enqueue(from_, response, tenant.bot_num)
+        inbox.finish(message_id, error=error)
+    scheduler.call_soon_once(deliver_outbox)
+    scheduler.call_soon_once(drain_inbox)
+
+
+def handle_text(owner: str, from_: str, body: str) -> str:
     resp = MessagingResponse()
+    resp.message(reply_to(owner, from_, body))
+    return str(resp)
+
+
+def reply_to(owner: str, from_: str, body: str) -> str:
     response = ''
 
-    if from_ == MY_CELL:
+    with metrics.timer('classify'):
+        command = commands.classify(body)
 
-        if has_phone_num(body):
+    if from_ == owner:
 
-            try:
-                sitter_name, sitter_num = add_sitter(body)
-            except (AssertionError, ValueError):
-                response = 'Sorry, did you mean to add a sitter?  Please try again.'
-            else:
-                response = f'Okay, I added {sitter_name.title()} to sitters, with phone # {sitter_num}.  '
+        handler = OWNER_COMMANDS.get(command.intent)
+        if len(body.strip().splitlines()) > 1:
+            # several sitters at once, one per line
+            response = on_import(body)
+        elif handler is None:
+            response = 'I wasn\'t sure what to do with your input. ' + help_text
+        else:
+            response = handler(command)
 
-        elif any(remove_word in body for remove_word in ['remove', 'delete']):
+    else:
 
-            try:
-                sitter_name = remove_sitter(body)
-            except KeyError:
-                response = 'No such sitter. Please write "delete [sitter\'s first name]."'
+        sitter_name = sitters.name_by_num(from_)
+        if sitter_name is not None:
+            handler = SITTER_COMMANDS.get(command.intent)
+            if handler is None:
+                response = scheduler.call(accept_or_decline, sitter_name, command)
             else:
-                response = f'Okay, I removed {sitter_name.title()} from the sitters.'
+                response = handler(sitter_name, command)
 
-        else:
-            try:
-                start_datetime, end_time = request_booking(body)
-            except ValueError:
-                response = 'Please specify an end time (e.g. "tomorrow 5pm to 10pm").'
-            else:
-                booking_string = make_booking_string(start_datetime, end_time)
-                response = f'Okay, I will reach out to the sitters about sitting on {booking_string}.'
+    return response
 
-        if response is None:
-            response = 'I wasn\'t sure what to do with your input. ' + help_text
 
-    else:
+def on_add(command: Command) -> str:
+    try:
+        sitter_name, sitter_num = scheduler.call(add_sitter, command.args['name'], command.args['num'])
+    except ValueError:
+        return 'Sorry, did you mean to add a sitter?  Please try again.'
+    scheduler.call_soon_once(offer_all_pending)
+    return f'Okay, I added {sitter_name.title()} to sitters, with phone # {sitter_num}.  '
 
-        sitter_name = sitters_num_name_lookup.get(from_)
-        if sitter_name is not None:
-            response = accept_or_decline(sitter_name, body)
 
-    resp.message(response)
+def on_remove(command: Command) -> str:
+    try:
+        sitter_name = scheduler.call(remove_sitter, command.args['name'])
+    except KeyError:
+        return 'No such sitter. Please write "delete [sitter\'s first name]."'
+    return f'Okay, I removed {sitter_name.title()} from the sitters.'
+
 
-    return str(resp)
+def on_book(command: Command) -> str:
+    try:
+        start_datetime, end_datetime = scheduler.call(request_booking, command.args['when'])
+    except ValueError:
+        return 'Please specify an end time (e.g. "tomorrow 5pm to 10pm").'
+    scheduler.call_soon(offer_next, (start_datetime, end_datetime))
+    scheduler.call_soon(retire_booking, (start_datetime, end_datetime))
+    booking_string = make_booking_string(start_datetime, end_datetime)
+    return f'Okay, I will reach out to the sitters about sitting on {booking_string}.'
 
 
-def accept_or_decline(sitter_name: str, body: str) -> str:
-    body = body.strip()
+def on_cancel(command: Command) -> str:
+    try:
+        booking_key = parse_booking_request(command.args['when'] or '')
+    except ValueError:
+        return 'Which booking should I cancel?  Please give its date and time (e.g. "cancel friday 6pm to 10pm").'
+    booking_string = make_booking_string(*booking_key)
+    try:
+        accepted_by = scheduler.call(cancel_booking, booking_key)
+    except KeyError:
+        return f'I couldn\'t find a booking on {booking_string}.'
+    if accepted_by is not None:
+        return f'Okay, I cancelled {booking_string} and let {accepted_by.title()} know.'
+    return f'Okay, I cancelled {booking_string} and stopped asking the sitters.'
+
 
-    global bookings
-    global sitters
-    bookings, sitters = load_from_pickle('bookings'), load_from_pickle('sitters')
+def on_recur(command: Command) -> str:
+    try:
+        start_datetime, end_datetime = parse_recurring_window(command.args['when'])
+    except ValueError:
+        return 'Please give a day of the week and a time range (e.g. "every tuesday 6pm to 10pm").'
+    recurrence_string = make_recurrence_string(start_datetime, end_datetime)
+    if command.args['stop']:
+        if not scheduler.call(stop_recurring, start_datetime, end_datetime):
+            return f'I wasn\'t booking a sitter {recurrence_string}.'
+        return f'Okay, I\'ll stop booking a sitter {recurrence_string}.  Bookings I\'ve already made still stand.'
+    if not scheduler.call(start_recurring, start_datetime, end_datetime):
+        return f'I\'m already booking a sitter {recurrence_string}.'
+    scheduler.call_soon(extend_recurring, None)
+    return f'Okay, I\'ll book a sitter {recurrence_string}, reaching out to them a week ahead.'
+
+
+def on_import(body: str) -> str:
+    result = scheduler.call(import_roster, body)
+    response = f'Okay, I added {len(result.added)} sitters'
+    if result.updated:
+        response += f' and updated {len(result.updated)}'
+    response += '.'
+    if result.errors:
+        shown = '; '.join(result.errors[:IMPORT_ERRORS_SHOWN])
+        more = len(result.errors) - IMPORT_ERRORS_SHOWN
+        response += f'  I couldn\'t add: {shown}' + (f' and {more} more.' if more > 0 else '.')
+    return response
+
+
+def on_list(command: Command) -> str:
+    page = page_number(command)
+    rows = sitters.booking_counts(QUERY_PAGE_SIZE + 1, (page - 1) * QUERY_PAGE_SIZE)
+    lines = [f'{name.title()} {num}: {booked} booked' for name, num, booked in rows]
+    return paginate('Sitters', lines, page, 'list', 'There are no sitters yet.  ' + help_add + '.')
+
+
+def on_status(command: Command) -> str:
+    page = page_number(command)
+    rows = bookings.pending(QUERY_PAGE_SIZE + 1, (page - 1) * QUERY_PAGE_SIZE)
+    lines = [f'{make_booking_string(*key)}: asked {asked}, {declined} no, {waiting} waiting'
+             for key, asked, declined, waiting in rows]
+    return paginate('Open bookings', lines, page, 'status', 'Nothing is waiting on a sitter.')
+
+
+def on_upcoming(command: Command) -> str:
+    page = page_number(command)
+    rows = bookings.upcoming(datetime.datetime.now(), QUERY_PAGE_SIZE + 1, (page - 1) * QUERY_PAGE_SIZE)
+    lines = [f'{make_booking_string(*key)}: {accepted_by.title()}' for key, accepted_by in rows]
+    return paginate('Booked', lines, page, 'upcoming', 'No sitters are booked yet.')
+
+
+def page_number(command: Command) -> int:
+    return max(int(command.args.get('page') or 1), 1)
+
+
+def paginate(title: str, lines: list, page: int, query: str, empty: str) -> str:
+    # callers fetch one row more than a page, which is how we know there's another page without counting them all
+    if not lines:
+        return empty if page == 1 else f'That\'s everything; there\'s no page {page}.'
+    more = len(lines) > QUERY_PAGE_SIZE
+    lines = [line if len(line) <= QUERY_LINE_LENGTH else line[:QUERY_LINE_LENGTH - 3] + '...'
+             for line in lines[:QUERY_PAGE_SIZE]]
+    response = '\n'.join([f'{title} (page {page}):' if page > 1 or more else f'{title}:'] + lines)
+    if more:
+        response += f'\nText "{query} {page + 1}" for more.'
+    return response
+
+
+OWNER_COMMANDS = {ADD: on_add, REMOVE: on_remove, BOOK: on_book, LIST: on_list, STATUS: on_status,
+                  UPCOMING: on_upcoming, RECUR: on_recur, CANCEL: on_cancel}
+
+
+def on_busy(sitter_name: str, command: Command) -> str:
+    try:
+        start_datetime, end_datetime = parse_day_or_window(command.args['when'] or '')
+    except ValueError:
+        return f'Sorry, {sitter_name.title()}, when are you busy?  Please write something like "busy saturday" ' \
+               f'or "busy friday 6pm to 10pm".'
+    scheduler.call(store.commitments.add, sitter_name, start_datetime, end_datetime)
+    return f'Okay, {sitter_name.title()}, I won\'t ask you about anything during ' \
+           f'{make_window_string(start_datetime, end_datetime)}.'
+
+
+def on_free(sitter_name: str, command: Command) -> str:
+    try:
+        start_datetime, end_datetime = parse_day_or_window(command.args['when'] or '')
+    except ValueError:
+        return f'Sorry, {sitter_name.title()}, when are you free again?  Please write something like "free saturday".'
+    window_string = make_window_string(start_datetime, end_datetime)
+    if not scheduler.call(store.commitments.clear_blackouts, sitter_name, start_datetime, end_datetime):
+        return f'You weren\'t down as busy during {window_string}, {sitter_name.title()}.'
+    scheduler.call_soon_once(offer_all_pending)
+    return f'Okay, {sitter_name.title()}, you\'re back on the list for {window_string}.'
+
+
+def on_hours(sitter_name: str, command: Command) -> str:
+    when = command.args['when']
+    if when is None:
+        availability = sitters[sitter_name].availability
+        if not availability:
+            return f'{sitter_name.title()}, I ask you about gigs at any time.  To only hear about some, write ' \
+                   f'something like "hours tuesdays 6pm to 10pm".'
+        return f'{sitter_name.title()}, I only ask you about gigs during {make_hours_string(availability)}.'
+    if when in ['any', 'anytime', 'any time', 'clear']:
+        scheduler.call(set_hours, sitter_name, None)
+        scheduler.call_soon_once(offer_all_pending)
+        return f'Okay, {sitter_name.title()}, I\'ll ask you about gigs at any time.'
+    try:
+        start_datetime, end_datetime = parse_recurring_window(when)
+    except ValueError:
+        return f'Sorry, {sitter_name.title()}, when can you usually sit?  Please write something like ' \
+               f'"hours tuesdays 6pm to 10pm", or "hours any time".'
+    availability = scheduler.call(set_hours, sitter_name,
+                                  (start_datetime.weekday(), start_datetime.time(), end_datetime.time()))
+    scheduler.call_soon_once(offer_all_pending)
+    return f'Okay, {sitter_name.title()}, I\'ll only ask you about gigs during {make_hours_string(availability)}.'
+
+
+@atomic
+def set_hours(sitter_name: str, window: Optional[AvailabilityWindow]) -> List[AvailabilityWindow]:
+    # each text adds a weekly window; "any time" goes back to asking whenever
+    sitter = sitters[sitter_name]
+    sitter.availability = [] if window is None else \
+        [other for other in sitter.availability if other != window] + [window]
+    sitters[sitter_name] = sitter
+    return sitter.availability
+
+
+def make_hours_string(availability: List[AvailabilityWindow]) -> str:
+    return ', '.join(f'{WEEKDAYS[weekday].title()} {start:%-I:%M%p} to {end:%-I:%M%p}'
+                     for weekday, start, end in sorted(availability))
+
+
+SITTER_COMMANDS = {HOURS: on_hours, BUSY: on_busy, FREE: on_free}
+
+
+@metrics.timer('accept_or_decline')
+@atomic
+def accept_or_decline(sitter_name: str, command: Command) -> str:
     sitter = sitters[sitter_name]
 
-    sitter_offers = [k for k, v in bookings.items()
-                     if sitter_name in v['offered']
-                     if v['offered'][sitter_name] not in ['yes', 'no']]
+    sitter_offers = bookings.pending_offers(sitter_name)
 
-    if body not in ['yes', 'no', 'n', 'y'] and not body.isnumeric():
+    if command.intent not in [YES, NO, CHOICE]:
         return f'Hm, I\'m not sure what you meant, {sitter_name.title()}. Please write "yes", "no", ' \
                f'or a number (if there are any pending bookings).'
 
     action = None
 
-    if not body.isnumeric():
-        action = 'accept' if body in ['yes', 'y'] else 'decline'
+    if command.intent != CHOICE:
+        action = 'accept' if command.intent == YES else 'decline'
 
     if len(sitter_offers) == 0:
         return f'Sorry, {sitter_name.title()}, it looks like either that gig ' \
@@ -123,188 +448,339 @@ def accept_or_decline(sitter_name: str, body: str) -> str:
         sitter_offers_string = ", ".join([f'{idx + 1}) {make_booking_string(*sitter_offer)}'
                                           for idx, sitter_offer in enumerate(sitter_offers)])
 
-        if body.isnumeric():
+        if command.intent == CHOICE:
             try:
-                offer = sitter_offers[int(body) - 1]
+                offer = sitter_offers[int(command.args['choice']) - 1]
             except IndexError:
-                action = sitter['next action']
+                action = sitter.next_action
                 return f'Sorry, which booking did you want to {action}? {sitter_offers_string}'
         else:
-            sitter['next action'] = action
-            persist_sitters()
+            sitter.next_action = action
+            sitters[sitter_name] = sitter
             return f'Sorry, which booking did you want to {action}? {sitter_offers_string}'
 
-    try:
-        action = action or sitter.pop('next action')
-    except KeyError:
-        raise KeyError(f'no next action, and sitter_offers is {sitter_offers}, so offer is {offer}.')
+    if action is None:
+        if sitter.next_action is None:
+            raise KeyError(f'no next action, and sitter_offers is {sitter_offers}, so offer is {offer}.')
+        action, sitter.next_action = sitter.next_action, None
+        sitters[sitter_name] = sitter
     booking_string = make_booking_string(*offer)
 
+    booking = bookings.get(offer)
+
     if action == 'accept':
 
-        if not bookings.get(offer):
-            return f'Sorry, {sitter_name.title()}, it looks like {booking_string} is already booked.'
+        if booking is not None and booking.accepted_by == sitter_name:
+            return f'You already accepted {booking_string}, {sitter_name.title()}!'
 
-        if any(bookings[offer]['offered'][sitter_] == 'yes'
-               for sitter_ in bookings[offer]['offered'].keys()):
-            if bookings[offer]['offered'][sitter_name] == 'yes':
-                return f'You already accepted {booking_string}, {sitter_name.title()}!'
+        if store.commitments.overlapping(sitter_name, offer[0], booking_end(offer)):
+            return f'Sorry, {sitter_name.title()}, {booking_string} overlaps with a gig you already took or a time ' \
+                   f'you said you\'re busy.  Text "free" and the day if that\'s changed.'
+
+        record_reply_to(sitter_name, booking, accepted=True)
+        if not bookings.claim(offer, sitter_name):
             return f'Sorry, {sitter_name.title()}, it looks like {booking_string} is already booked.'
 
-        bookings[offer]['offered'][sitter_name] = 'yes'
-        persist_bookings()
+        metrics.inc('offers_total', event='accepted')
+        store.sitter_stats.update(sitter_name, record_gig, offer[0])
+        booking = bookings[offer]
+        for other_name in cancel_open_offers(booking):
+            metrics.inc('offers_total', event='cancelled')
+            other_sitter = sitters.get(other_name)
+            if other_sitter is not None:
+                cancel_offer(other_sitter, booking_string, offer)
+        bookings[offer] = booking
+
         update_client(f'{sitter_name.title()} agreed to babysit on {booking_string}!')
         return f'Awesome, {sitter_name.title()}!  See you on {booking_string}.'
 
     else:
-        if bookings[offer]['offered'][sitter_name] == 'yes':
+        if booking.accepted_by == sitter_name:
             return f'You already accepted {booking_string}, {sitter_name.title()}!'
 
-        bookings[offer]['offered'][sitter_name] = 'no'
-        persist_bookings()
+        record_reply_to(sitter_name, booking, accepted=False)
+        metrics.inc('offers_total', event='declined')
+        declined = booking.offers.setdefault(sitter_name, Offer(wave=booking.waves()))
+        declined.status, declined.replied_at = OfferStatus.NO, datetime.datetime.now()
+        bookings[offer] = booking
+        scheduler.call_soon(offer_next, offer)
         return f'Okay, no problem, {sitter_name.title()}!  Next time.'
 
 
-def make_booking_string(start_datetime: datetime.datetime, end_time: datetime.time) -> str:
+def record_reply_to(sitter_name: str, booking: Optional[Booking], accepted: bool) -> None:
+    offer = booking.offers.get(sitter_name) if booking is not None else None
+    if offer is not None and offer.is_open:
+        store.sitter_stats.update(sitter_name, record_reply, accepted, datetime.datetime.now() - offer.offered_at)
+
+
+def make_booking_string(start_datetime: datetime.datetime, end_datetime: datetime.datetime) -> str:
     start_time_and_date_string = start_datetime.strftime('%-m/%-d from %-I:%M%p')
-    end_time_string = end_time.strftime('%-I:%M%p')
+    end_time_string = end_datetime.strftime('%-I:%M%p')
     return f'{start_time_and_date_string} to {end_time_string}'
 
 
-def book_forever():
-    while True:
+def make_recurrence_string(start_datetime: datetime.datetime, end_datetime: datetime.datetime) -> str:
+    return f'every {start_datetime:%A} from {start_datetime:%-I:%M%p} to {end_datetime:%-I:%M%p}'
+
+
+def make_window_string(start_datetime: datetime.datetime, end_datetime: datetime.datetime) -> str:
+    if start_datetime.time() == datetime.time.min and end_datetime - start_datetime == datetime.timedelta(days=1):
+        return start_datetime.strftime('%-m/%-d')
+    return make_booking_string(start_datetime, end_datetime)
+
+
+@atomic
+def offer_next(booking_key: BookingKey) -> None:
+    booking = bookings.get(booking_key)
+    if booking is None:
+        return
+
+    offers = booking.offers
+
+    if booking.accepted_by is not None:
+        return
+
+    booking_string = make_booking_string(*booking_key)
+
+    # hold off while anyone in the latest wave is still deciding and its timeout hasn't run out
+    deadline = wave_deadline(booking, FAN_OUT)
+    if deadline is not None and datetime.datetime.now() < deadline:
+        return
+
+    # if len(sitters) == len(offers):
+    #     del bookings[booking_key]
+    #     update_client(
+    #         f'No babysitters are available for {booking_string}! Deleting request.')
+
+    # the next wave is the best-ranked sitters who haven't been asked yet and haven't said they're busy then
+    busy = store.commitments.busy(booking_key[0], booking_end(booking_key))
+    wave = {}
+    for sitter_name in store.sitter_stats.ranked():
+        if len(wave) == FAN_OUT.wave_size:
+            break
+        if sitter_name in offers or sitter_name in busy:
+            continue
+        sitter = sitters[sitter_name]
+        if is_available(sitter, booking_key[0], booking_end(booking_key)):
+            wave[sitter_name] = sitter
+
+    if not wave:
+        return
+
+    start_wave(booking, list(wave), datetime.datetime.now())
+    bookings[booking_key] = booking
+    for sitter_name, sitter in wave.items():
+        offer_booking(sitter, booking_string, booking_key)
+        metrics.inc('offers_total', event='sent')
+        store.sitter_stats.update(sitter_name, record_offer)
+        update_client_offered(booking_string, sitter_name)
+    timeout = FAN_OUT.timeout(booking.waves() - 1)
+    scheduler.call_later(timeout.total_seconds(), offer_timed_out, booking_key, *wave)
+
+
+@atomic
+def offer_timed_out(booking_key: BookingKey, *sitter_names: str) -> None:
+    booking = bookings.get(booking_key)
+    if booking is None:
+        return
+    open_offers = booking.open_offers()
+    silent = [sitter_name for sitter_name in sitter_names if sitter_name in open_offers]
+    for sitter_name in silent:
+        metrics.inc('offers_total', event='timed_out')
+        store.sitter_stats.update(sitter_name, record_timeout)
+    if silent:
+        offer_next(booking_key)
+
+
+def offer_all_pending() -> None:
+    for booking_key in bookings.open_keys():
+        offer_next(booking_key)
+
+
+@atomic
+def retire_booking(booking_key: BookingKey) -> None:
+    booking = bookings.get(booking_key)
+    if booking is None:
+        return
+
+    reason = archive_reason(booking_key, booking, BOOKING_TIMEOUT)
+    if reason is None:
+        check_at = next_check(booking_key, booking, BOOKING_TIMEOUT)
+        scheduler.call_later((check_at - datetime.datetime.now()).total_seconds(), retire_booking, booking_key)
+        return
+
+    store.archive(booking_key, reason)
+    booking_string = make_booking_string(*booking_key)
+    if reason == FINISHED:
+        update_client(f'{booking.accepted_by.title()}\'s gig on {booking_string} is over, so I archived it.')
+    else:
+        update_client(f'No one took {booking_string} ({reason}), so I stopped asking the sitters.')
 
-        sitters_, bookings_ = load_from_pickle('sitters'), load_from_pickle('bookings')
 
-        if bookings_:
+def extend_recurring(due_at: Optional[datetime.datetime]) -> None:
+    # None is a check asked for right now; a wakeup that an earlier one has since replaced has nothing left to do
+    bot_num = tenants.get().bot_num
+    if due_at is not None and recurring_wakeups.get(bot_num) != due_at:
+        return
+    recurring_wakeups.pop(bot_num, None)
+    for booking_key in scheduler.call(materialize_recurring, datetime.datetime.now() + RECURRING_HORIZON):
+        scheduler.call_soon(offer_next, booking_key)
+        scheduler.call_soon(retire_booking, booking_key)
+    schedule_recurring()
 
-            bookings_keys_to_delete = []
 
-            for booking_start_and_end, offered_dict in bookings_.items():
+def schedule_recurring() -> None:
+    next_start = store.recurrences.next_start()
+    if next_start is None:
+        return
+    due_at = next_start - RECURRING_HORIZON
+    bot_num = tenants.get().bot_num
+    if bot_num in recurring_wakeups and recurring_wakeups[bot_num] <= due_at:
+        return
+    recurring_wakeups[bot_num] = due_at
+    scheduler.call_later((due_at - datetime.datetime.now()).total_seconds(), extend_recurring, due_at)
 
-                booking = bookings_[booking_start_and_end]
-                offers = booking['offered']
 
-                if any(v == 'yes' for k, v in offers.items()):
-                    continue
+def book_forever():
+    # pick up where we left off: offers still waiting on a reply get their deadlines back
+    for bot_num in tenants.bot_nums():
+        with tenants.activate(bot_num):
+            for booking_key, booking in bookings.items():
+                scheduler.call_soon(retire_booking, booking_key)
+                deadline = wave_deadline(booking, FAN_OUT)
+                if deadline is not None:
+                    scheduler.call_later((deadline - datetime.datetime.now()).total_seconds(), offer_next, booking_key)
+                else:
+                    scheduler.call_soon(offer_next, booking_key)
+            # texts that were still queued or mid-retry when we last stopped
+            scheduler.call_soon(deliver_outbox)
+            scheduler.call_soon(extend_recurring, None)
+            # texts that were acknowledged but not yet answered
+            scheduler.call_soon(drain_inbox)
+    scheduler.run()
 
-                sitter_to_offer_name = None
-                booking_string = make_booking_string(*booking_start_and_end)
 
-                if len(offers) == 0:
-                    first_sitter_name = list(sitters_)[0]
-                    sitter_to_offer_name = first_sitter_name
-                else:
-                    last_offer_was_minutes_ago = 0
-                    offers_without_a_no = {k: v for k, v in offers.items() if v != 'no'}
-                    if len(offers_without_a_no) > 0:
-                        last_offer: datetime.datetime = max(offers_without_a_no.values())
-                        last_offer_was_minutes_ago \
-                            = (datetime.datetime.now() - last_offer).total_seconds() / 60
+def deliver_outbox() -> None:
+    outbox.drain(wake=lambda delay: scheduler.call_later(delay, deliver_outbox))
 
-                    if len(offers_without_a_no) == 0 or last_offer_was_minutes_ago > 1:
-                    # if len(offers_without_a_no) == 0 or last_offer_was_minutes_ago > 60:
 
-                        # if len(sitters_) == len(offers):
-                        #     bookings_keys_to_delete.append(booking_start_and_end)
-                        #     update_client(
-                        #         f'No babysitters are available for {booking_string}! Deleting request.')
+def offer_booking(sitter: Sitter, booking_string: str, booking_key: BookingKey) -> None:
+    message = f'{sitter.name.title()}, are you available to babysit on {booking_string}?'
+    outbox.enqueue(sitter.num, message, tenants.get().bot_num, booking_key, sitter.name, OFFER)
+    scheduler.call_soon_once(deliver_outbox)
 
-                        # else:
-                        for sitter in sitters_:
-                            if sitter not in offers:
-                                sitter_to_offer_name = sitter
-                                break
 
-                if sitter_to_offer_name is not None:
-                    sitter_to_offer = sitters_[sitter_to_offer_name]
-                    offer_booking(sitter_to_offer, booking_string)
-                    offers[sitter_to_offer_name] = datetime.datetime.now()
-                    update_client(
-                        f'Okay, I offered {booking_string} to {sitter_to_offer_name.title()}.')
+def cancel_offer(sitter: Sitter, booking_string: str, booking_key: BookingKey, why: str = 'has been filled') -> None:
+    message = f'Thanks, {sitter.name.title()}, {booking_string} {why}, so no need to reply.'
+    outbox.enqueue(sitter.num, message, tenants.get().bot_num, booking_key, sitter.name, CANCELLATION)
+    scheduler.call_soon_once(deliver_outbox)
 
-            if len(bookings_keys_to_delete) > 0:
-                for k in bookings_keys_to_delete:
-                    del bookings_[k]
 
-            persist_bookings(bookings_)
+def call_off_gig(sitter: Sitter, booking_string: str, booking_key: BookingKey) -> None:
+    message = f'Sorry, {sitter.name.title()}, {booking_string} has been cancelled, so you\'re no longer needed then.'
+    outbox.enqueue(sitter.num, message, tenants.get().bot_num, booking_key, sitter.name, CANCELLATION)
+    scheduler.call_soon_once(deliver_outbox)
 
-        # time.sleep(60)
-        time.sleep(5)
 
+def update_client(string: str) -> None:
+    owner_updates.send(string)
 
-def offer_booking(sitter_dict: dict, booking_string: str) -> None:
-    message = f'{sitter_dict["name"].title()}, are you available to babysit on {booking_string}?'
-    twilio_client.api.account.messages.create(to=sitter_dict['num'],
-                                              from_=BOT_NUM,
-                                              body=message)
 
+def update_client_offered(booking_string: str, sitter_name: str) -> None:
+    owner_updates.add(f'Okay, I offered {booking_string}', sitter_name.title())
 
-def update_client(string: str) -> None:
-    twilio_client.api.account.messages.create(to=MY_CELL, from_=BOT_NUM, body=string)
 
+@metrics.timer('request_booking')
+@atomic
+def request_booking(body: str) -> Tuple[datetime.datetime, datetime.datetime]:
+    session_start_datetime, session_end_datetime = parse_booking_request(body)
+    bookings[(session_start_datetime, session_end_datetime)] = Booking(requested_at=datetime.datetime.now())
+    return session_start_datetime, session_end_datetime
 
-def has_phone_num(string):
-    return len([char for char in string if char.isnumeric()]) == 10
 
+@atomic
+def start_recurring(start_datetime: datetime.datetime, end_datetime: datetime.datetime) -> bool:
+    return store.recurrences.add(new_recurrence(start_datetime, end_datetime))
 
-def request_booking(body: str) -> Tuple[datetime.datetime, datetime.time]:
-    session_start_datetime, session_end_time = parse_booking_request(body)
-    global bookings
-    bookings = load_from_pickle('bookings')
-    bookings[(session_start_datetime, session_end_time)] = {'offered': dict()}
-    persist_bookings()
-    return session_start_datetime, session_end_time
 
+@atomic
+def stop_recurring(start_datetime: datetime.datetime, end_datetime: datetime.datetime) -> bool:
+    return store.recurrences.remove(new_recurrence(start_datetime, end_datetime).rule)
 
-def parse_booking_request(body: str) -> Tuple[datetime.datetime, datetime.time]:
-    start_string, end_string = body.split(' to ')
-    session_start_datetime = cal.parseDT(start_string)[0]
-    session_end_time = datetime.time(cal.parse(end_string)[0].tm_hour)
-    return session_start_datetime, session_end_time
 
+@atomic
+def materialize_recurring(horizon: datetime.datetime) -> List[BookingKey]:
+    # only the occurrences that have come within the horizon become bookings; each rule then remembers where its
+    # next one starts, so another worker doing the same finds nothing left to add
+    now = datetime.datetime.now()
+    added = []
+    for recurrence in store.recurrences.due(horizon):
+        booking_keys, next_start = within(recurrence, horizon)
+        for booking_key in booking_keys:
+            if booking_key[0] > now and booking_key not in bookings:
+                bookings[booking_key] = Booking(requested_at=now)
+                added.append(booking_key)
+        store.recurrences.advance(recurrence.rule, next_start)
+    return added
 
-def add_sitter(body: str) -> Tuple[str, str]:
-    name, *num_parts = body.split(' ')
 
-    num_only = ''.join(char
-                       for num in num_parts
-                       for char in num if char.isnumeric())
+@metrics.timer('parse')
+def parse_booking_request(body: str) -> Tuple[datetime.datetime, datetime.datetime]:
+    return parse_booking_window(body)
 
-    lowercase_name = name.lower()
 
-    assert len(num_only) == 10
+@atomic
+def cancel_booking(booking_key: BookingKey) -> Optional[str]:
+    booking = bookings.get(booking_key)
+    if booking is None:
+        raise KeyError(booking_key)
+    booking_string = make_booking_string(*booking_key)
+    # only sitters whose offer actually went out need telling; ones still queued are dropped once it's archived
+    for sitter_name in cancel_open_offers(booking):
+        sitter = sitters.get(sitter_name)
+        if sitter is not None and booking.offers[sitter_name].delivery == SENT:
+            cancel_offer(sitter, booking_string, booking_key, 'has been cancelled')
+    if booking.accepted_by is not None and booking.accepted_by in sitters:
+        call_off_gig(sitters[booking.accepted_by], booking_string, booking_key)
+    bookings[booking_key] = booking
+    store.archive(booking_key, CANCELLED)
+    return booking.accepted_by
+
 
-    phone_number = f'{COUNTRY_CODE}{num_only}'
-    sitters[lowercase_name] = {'num': phone_number,
-                               'name': lowercase_name}
+@atomic
+def add_sitter(name: str, num: str) -> Tuple[str, str]:
+    lowercase_name = name.lower()
+    # the same form Twilio gives the From of their replies in, whether or not TWILIO_COUNTRY_CODE is set
+    phone_number = to_e164(num)
+    # replies are routed by number, so a number can only belong to one sitter
+    if sitters.name_by_num(phone_number) not in [None, lowercase_name]:
+        raise ValueError(f'{phone_number} already belongs to another sitter')
+    sitters[lowercase_name] = Sitter(lowercase_name, phone_number)
 
-    persist_sitters()
     return name, phone_number
 
 
-def remove_sitter(body: str) -> str:
-    sitter_first_name = body.split(' ')[1]
-    sitter = sitters.get(sitter_first_name)
+@atomic
+def import_roster(text: str):
+    parsed = parse_roster(text)
+    result = import_sitters(store, parsed.entries, parsed.errors)
+    if result.added:
+        scheduler.call_soon_once(offer_all_pending)
+    return result
+
+
+@atomic
+def remove_sitter(sitter_first_name: Optional[str]) -> str:
+    sitter = sitters.get(sitter_first_name) if sitter_first_name is not None else None
     if sitter is None:
         raise KeyError
     del sitters[sitter_first_name]
-    persist_sitters()
     return sitter_first_name
 
 
-def persist_sitters():
-    pickle.dump(sitters, open('sitters.p', 'wb'))
-
-
-def persist_bookings(bookings_: dict = None):
-    pickle.dump(bookings_ if bookings_ is not None else bookings, open('bookings.p', 'wb'))
-
-
 if __name__ == '__main__':
-    update_client('Hi, this is Babysitter Bot, on the job!  Send me a date with time range and '
-                  'I\'ll try to book one of our sitters!')
-    p = Process(target=book_forever)
-    p.start()
-    app.run(debug=True, port=8000, use_reloader=False)
-    p.join()
+    if BOT_NUM:
+        update_client('Hi, this is Babysitter Bot, on the job!  Send me a date with time range and '
+                      'I\'ll try to book one of our sitters!')
+    Thread(target=book_forever, daemon=True).start()
+    create_app().run(debug=True, port=8000, use_reloader=False)
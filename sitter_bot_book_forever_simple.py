@@ -1,115 +1,123 @@
 import datetime
-from multiprocessing import Process
 import os
-from pprint import pprint
-import time
-from typing import Tuple, Dict
-
-import parsedatetime as pdt
-import pickle
+from threading import Thread
+from typing import Optional, Tuple
 
 from flask import request, Flask
-from twilio.rest import Client as TwilioClient
 from twilio.twiml.messaging_response import MessagingResponse
 
-twilio_client = TwilioClient(os.getenv('TWILIO_SID'), os.getenv('TWILIO_TOKEN'))
+from commands import ADD, BOOK, NO, REMOVE, YES, Command, commands
+from dateparse import calendar, parse_booking_window
+from fanout import cancel_open_offers
+from phones import to_e164
+from records import Booking, Offer, OfferStatus, Sitter
+from retention import FINISHED, archive_reason, next_check
+from scheduler import Scheduler
+from sms import Digest, Dispatcher
+from store import BookingKey, booking_end, open_store
 
 MY_CELL = os.getenv('MY_CELL')
 BOT_NUM = os.getenv('MY_TWILIO_NUM')
-COUNTRY_CODE = f'+{os.getenv("TWILIO_COUNTRY_CODE")}'
 TIMEOUT_MINUTES = 120
+BOOKING_TIMEOUT = datetime.timedelta(minutes=TIMEOUT_MINUTES)
 
 help_add = 'You can add a sitter by giving me their first name and 10-digit phone number'
 help_text = help_add + ', or book a sitter by ' \
                        'specifying a date and time.  You can also remove a sitter from the list ' \
                        'with "delete" or "remove" and then their first name.'
 
-app = Flask(__name__)
-app.config.from_object(__name__)
-
-cal = pdt.Calendar()
+sms = Dispatcher(os.getenv('TWILIO_SID'), os.getenv('TWILIO_TOKEN'), BOT_NUM)
+owner_updates = Digest(sms, MY_CELL)
 
 
 class TheresAlreadyAnActiveBooking(Exception):
     pass
 
 
-def load_from_pickle(var_name: str) -> dict:
-    payload = {}
-    if os.path.exists(f'{var_name}.p'):
-        payload = pickle.load(open(f'{var_name}.p', 'rb'))
-    return payload
+store = open_store()
+sitters, bookings = store.sitters, store.bookings
+
+scheduler = Scheduler()
+
 
+def create_app(prewarm: bool = bool(os.getenv('SITTER_BOT_PREWARM'))) -> Flask:
+    app = Flask(__name__)
+    app.config.from_object(__name__)
+    app.add_url_rule('/bot', view_func=bot, methods=['POST'])
+    if prewarm:
+        warm_up()
+    return app
 
-sitters, bookings = load_from_pickle('sitters'), load_from_pickle('bookings')
-sitters_num_name_lookup = {v['num']: k for k, v in sitters.items()}
+
+def warm_up() -> None:
+    # opens the database and runs any pending migrations
+    store.conn
+    sms.start()
+    calendar()
+    parse_booking_request('tomorrow 6pm to 10pm')
 
 
-@app.route('/bot', methods=['POST'])
 def bot() -> str:
     from_ = request.values.get('From')
-    body = request.values.get('Body').lower()
+    command = commands.classify(request.values.get('Body'))
 
     resp = MessagingResponse()
     response = ''
 
     if from_ == MY_CELL:
 
-        if has_phone_num(body):
-
-            try:
-                sitter_name, sitter_num = add_sitter(body)
-            except (AssertionError, ValueError):
-                response = 'Sorry, did you mean to add a sitter?  Please try again.'
-            else:
-                response = f'Okay, I added {sitter_name.title()} to sitters, with phone # {sitter_num}.  '
-
-        elif any(remove_word in body for remove_word in ['remove', 'delete']):
-
-            try:
-                sitter_name = remove_sitter(body)
-            except KeyError:
-                response = 'No such sitter. Please write "delete [sitter\'s first name]."'
-            else:
-                response = f'Okay, I removed {sitter_name.title()} from the sitters.'
-
-        else:
-            try:
-                start_datetime, end_time = request_booking(body)
-            except ValueError:
-                response = 'Please specify an end time (e.g. "tomorrow 5pm to 10pm").'
-            except TheresAlreadyAnActiveBooking:
-                response = 'Please wait until the current booking is either booked or expires.'
-            else:
-                booking_string = make_booking_string(start_datetime, end_time)
-                response = f'Okay, I will reach out to the sitters about sitting on {booking_string}.'
-
-        if response is None:
+        handler = OWNER_COMMANDS.get(command.intent)
+        if handler is None:
             response = 'I wasn\'t sure what to do with your input. ' + help_text
+        else:
+            response = handler(command)
 
     else:
 
-        sitter_name = sitters_num_name_lookup.get(from_)
+        sitter_name = sitters.name_by_num(from_)
         if sitter_name is not None:
-            response = accept_or_decline(sitter_name, body)
+            response = scheduler.call(accept_or_decline, sitter_name, command)
 
     resp.message(response)
 
     return str(resp)
 
 
-def accept_or_decline(sitter_name: str, body: str) -> str:
-    body = body.strip()
+def on_add(command: Command) -> str:
+    try:
+        sitter_name, sitter_num = scheduler.call(add_sitter, command.args['name'], command.args['num'])
+    except ValueError:
+        return 'Sorry, did you mean to add a sitter?  Please try again.'
+    scheduler.call_soon_once(offer_all_pending)
+    return f'Okay, I added {sitter_name.title()} to sitters, with phone # {sitter_num}.  '
+
+
+def on_remove(command: Command) -> str:
+    try:
+        sitter_name = scheduler.call(remove_sitter, command.args['name'])
+    except KeyError:
+        return 'No such sitter. Please write "delete [sitter\'s first name]."'
+    return f'Okay, I removed {sitter_name.title()} from the sitters.'
+
+
+def on_book(command: Command) -> str:
+    try:
+        start_datetime, end_datetime = scheduler.call(request_booking, command.args['when'])
+    except ValueError:
+        return 'Please specify an end time (e.g. "tomorrow 5pm to 10pm").'
+    except TheresAlreadyAnActiveBooking:
+        return 'Please wait until the current booking is either booked or expires.'
+    scheduler.call_soon(offer_to_everyone, (start_datetime, end_datetime))
+    scheduler.call_soon(retire_booking, (start_datetime, end_datetime))
+    booking_string = make_booking_string(start_datetime, end_datetime)
+    return f'Okay, I will reach out to the sitters about sitting on {booking_string}.'
 
-    global bookings
-    global sitters
 
-    bookings, sitters = load_from_pickle('bookings'), load_from_pickle('sitters')
-    sitter = sitters[sitter_name]
+OWNER_COMMANDS = {ADD: on_add, REMOVE: on_remove, BOOK: on_book}
 
-    sitter_offers = [k for k, v in bookings.items()
-                     if sitter_name in v['offered']
-                     if v['offered'][sitter_name] not in ['yes', 'no']]
+
+def accept_or_decline(sitter_name: str, command: Command) -> str:
+    sitter_offers = bookings.pending_offers(sitter_name)
 
     if len(sitter_offers) == 0:
         update_client(f'there\'s more than one booking on offer, so I\'m confused!')
@@ -121,143 +129,149 @@ def accept_or_decline(sitter_name: str, body: str) -> str:
     offer = sitter_offers[0]
     booking = bookings[offer]
 
-    if body not in ['yes', 'no', 'n', 'y']:
+    if command.intent not in [YES, NO]:
         return f'Hm, I\'m not sure what you meant, {sitter_name.title()}. Please write "yes" or "no".'
 
-    if body in ['yes', 'y']:
+    if command.intent == YES:
 
         booking_string = make_booking_string(*offer)
 
-        if any(booking['offered'][sitter_] == 'yes'
-               for sitter_ in booking['offered'].keys()):
+        if not bookings.claim(offer, sitter_name):
             return f'Sorry, {sitter_name.title()}, it looks like {booking_string} is already booked.'
 
-        booking['offered'][sitter_name] = 'yes'
-        persist_bookings()
+        booking = bookings[offer]
+        # everyone else got the broadcast too, so let them know they can stop thinking about it
+        for other_name in cancel_open_offers(booking):
+            other_sitter = sitters.get(other_name)
+            if other_sitter is not None:
+                cancel_offer(other_sitter, booking_string)
+        bookings[offer] = booking
         update_client(f'{sitter_name.title()} agreed to babysit on {booking_string}!')
         return f'Awesome, {sitter_name.title()}!  See you on {booking_string}.'
 
-    booking['offered'][sitter_name] = 'no'
-    persist_bookings()
+    declined = booking.offers.setdefault(sitter_name, Offer())
+    declined.status, declined.replied_at = OfferStatus.NO, datetime.datetime.now()
+    bookings[offer] = booking
     return f'Okay, no problem, {sitter_name.title()}!  Next time.'
 
 
-def make_booking_string(start_datetime: datetime.datetime, end_time: datetime.time) -> str:
+def make_booking_string(start_datetime: datetime.datetime, end_datetime: datetime.datetime) -> str:
     start_time_and_date_string = start_datetime.strftime('%-m/%-d from %-I:%M%p')
-    end_time_string = end_time.strftime('%-I:%M%p')
+    end_time_string = end_datetime.strftime('%-I:%M%p')
     return f'{start_time_and_date_string} to {end_time_string}'
 
 
-def book_forever():
-    while True:
-
-        sitters_, bookings_ = load_from_pickle('sitters'), load_from_pickle('bookings')
+def offer_to_everyone(booking_key: BookingKey) -> None:
+    booking = bookings.get(booking_key)
+    if booking is None:
+        return
 
-        if sitters_ and bookings_:
+    offers = booking.offers
 
-            for booking_start_and_end, offered_dict in bookings_.items():
+    if booking.accepted_by is not None:
+        return
 
-                booking = bookings_[booking_start_and_end]
-                offers = booking['offered']
+    booking_string = make_booking_string(*booking_key)
 
-                if any(v == 'yes' for k, v in offers.items()):
-                    continue
+    # sitters already booked or blacked out then would only have to say no
+    busy = store.commitments.busy(booking_key[0], booking_end(booking_key))
+    offered = False
+    for sitter_name, sitter in sitters.items():
+        if sitter_name not in offers and sitter_name not in busy:
+            offer_booking(sitter, booking_string)
+            offers[sitter_name] = Offer(datetime.datetime.now())
+            offered = True
+            update_client_offered(booking_string, sitter_name)
+    # one write for the whole broadcast rather than one per sitter
+    if offered:
+        bookings[booking_key] = booking
 
-                if len(sitters_) == len(offers):
-                    continue
 
-                booking_string = make_booking_string(*booking_start_and_end)
+def offer_all_pending() -> None:
+    for booking_key in bookings.open_keys():
+        offer_to_everyone(booking_key)
 
-                for sitter_name, sitter_dict in sitters_.items():
-                    if sitter_name not in offers:
-                        offer_booking(sitter_dict, booking_string)
-                        offers[sitter_name] = datetime.datetime.now()
-                        update_client(
-                            f'Okay, I offered {booking_string} to {sitter_name.title()}.')
 
-                pprint(bookings_)
+def retire_booking(booking_key: BookingKey) -> None:
+    booking = bookings.get(booking_key)
+    if booking is None:
+        return
 
-            persist_bookings(bookings_)
+    reason = archive_reason(booking_key, booking, BOOKING_TIMEOUT)
+    if reason is None:
+        check_at = next_check(booking_key, booking, BOOKING_TIMEOUT)
+        scheduler.call_later((check_at - datetime.datetime.now()).total_seconds(), retire_booking, booking_key)
+        return
 
-        # time.sleep(60)
-        time.sleep(5)
+    store.archive(booking_key, reason)
+    booking_string = make_booking_string(*booking_key)
+    if reason == FINISHED:
+        update_client(f'{booking.accepted_by.title()}\'s gig on {booking_string} is over, so I archived it.')
+    else:
+        update_client(f'No one took {booking_string} ({reason}), so I stopped asking the sitters.')
 
 
-def offer_booking(sitter_dict: dict, booking_string: str) -> None:
-    message = f'{sitter_dict["name"].title()}, are you available to babysit on {booking_string}?'
-    twilio_client.api.account.messages.create(to=sitter_dict['num'],
-                                              from_=BOT_NUM,
-                                              body=message)
+def book_forever():
+    for booking_key in bookings:
+        scheduler.call_soon(retire_booking, booking_key)
+    scheduler.call_soon(offer_all_pending)
+    scheduler.run()
 
-def update_client(string: str) -> None:
-    twilio_client.api.account.messages.create(to=MY_CELL, from_=BOT_NUM, body=string)
 
+def offer_booking(sitter: Sitter, booking_string: str) -> None:
+    message = f'{sitter.name.title()}, are you available to babysit on {booking_string}?'
+    sms.send(sitter.num, message)
 
-def has_phone_num(string):
-    return len([char for char in string if char.isnumeric()]) == 10
+def cancel_offer(sitter: Sitter, booking_string: str) -> None:
+    message = f'Thanks, {sitter.name.title()}, {booking_string} has been filled, so no need to reply.'
+    sms.send(sitter.num, message)
 
 
-def request_booking(body: str) -> Tuple[datetime.datetime, datetime.time]:
-    session_start_datetime, session_end_time = parse_booking_request(body)
-    global bookings
-    bookings = load_from_pickle('bookings')
-    if bookings:
-        raise TheresAlreadyAnActiveBooking
-    bookings[(session_start_datetime, session_end_time)] = {'offered': dict()}
-    persist_bookings()
-    return session_start_datetime, session_end_time
+def update_client(string: str) -> None:
+    owner_updates.send(string)
 
 
-def parse_booking_request(body: str) -> Tuple[datetime.datetime, datetime.time]:
-    start_string, end_string = body.split(' to ')
-    session_start_datetime = cal.parseDT(start_string)[0]
-    session_end_time = datetime.time(cal.parse(end_string)[0].tm_hour)
-    return session_start_datetime, session_end_time
+def update_client_offered(booking_string: str, sitter_name: str) -> None:
+    owner_updates.add(f'Okay, I offered {booking_string}', sitter_name.title())
 
 
-def add_sitter(body: str) -> Tuple[str, str]:
-    name, *num_parts = body.split(' ')
+def request_booking(body: str) -> Tuple[datetime.datetime, datetime.datetime]:
+    session_start_datetime, session_end_datetime = parse_booking_request(body)
+    # sitters reply with a bare yes or no, so only one booking can be waiting on them; booked ones don't count
+    if bookings.open_keys():
+        raise TheresAlreadyAnActiveBooking
+    bookings[(session_start_datetime, session_end_datetime)] = Booking(requested_at=datetime.datetime.now())
+    return session_start_datetime, session_end_datetime
 
-    num_only = ''.join(char
-                       for num in num_parts
-                       for char in num if char.isnumeric())
 
-    lowercase_name = name.lower()
+def parse_booking_request(body: str) -> Tuple[datetime.datetime, datetime.datetime]:
+    return parse_booking_window(body)
 
-    assert len(num_only) == 10
 
-    phone_number = f'{COUNTRY_CODE}{num_only}'
-    sitters[lowercase_name] = {'num': phone_number,
-                               'name': lowercase_name}
+def add_sitter(name: str, num: str) -> Tuple[str, str]:
+    lowercase_name = name.lower()
+    # the same form Twilio gives the From of their replies in, whether or not TWILIO_COUNTRY_CODE is set
+    phone_number = to_e164(num)
+    # replies are routed by number, so a number can only belong to one sitter
+    if sitters.name_by_num(phone_number) not in [None, lowercase_name]:
+        raise ValueError(f'{phone_number} already belongs to another sitter')
+    sitters[lowercase_name] = Sitter(lowercase_name, phone_number)
 
-    persist_sitters()
     return name, phone_number
 
 
-def remove_sitter(body: str) -> str:
-    sitter_first_name = body.split(' ')[1]
-    sitter = sitters.get(sitter_first_name)
+def remove_sitter(sitter_first_name: Optional[str]) -> str:
+    sitter = sitters.get(sitter_first_name) if sitter_first_name is not None else None
     if sitter is None:
         raise KeyError
     del sitters[sitter_first_name]
-    persist_sitters()
     return sitter_first_name
 
 
-def persist_sitters():
-    pickle.dump(sitters, open('sitters.p', 'wb'))
-
-
-def persist_bookings(bookings_: dict = None):
-    pickle.dump(bookings_ if bookings_ is not None else bookings, open('bookings.p', 'wb'))
-
-
 if __name__ == '__main__':
     update_client('Hi, this is Babysitter Bot, on the job!  Send me a date with time range and '
                   'I\'ll try to book one of our sitters!')
     if not sitters:
         update_client('Please add at least one babysitter.')
-    p = Process(target=book_forever)
-    p.start()
-    app.run(debug=True, port=8000, use_reloader=False)
-    p.join()
+    Thread(target=book_forever, daemon=True).start()
+    create_app().run(debug=True, port=8000, use_reloader=False)
@@ -1,10 +1,15 @@
 import os
+from functools import lru_cache
 
 from flask import Flask, request
-from twilio.rest import Client as TwilioClient
 from twilio.twiml.messaging_response import MessagingResponse
 
-twilio_client = TwilioClient(os.getenv("TWILIO_SID"), os.getenv("TWILIO_TOKEN"))
+
+@lru_cache(maxsize=None)
+def twilio_client():
+    from twilio.rest import Client as TwilioClient
+    return TwilioClient(os.getenv("TWILIO_SID"), os.getenv("TWILIO_TOKEN"))
+
 
 app = Flask(__name__)
 app.config.from_object(__name__)
@@ -0,0 +1,152 @@
+import os
+import threading
+import time
+import traceback
+from concurrent.futures import Future, ThreadPoolExecutor
+from contextvars import copy_context
+from typing import Callable, Optional
+
+from metrics import metrics
+
+TWILIO_API_URL = os.getenv('TWILIO_API_URL', 'https://api.twilio.com')
+MESSAGES_PER_SECOND = float(os.getenv('TWILIO_MESSAGES_PER_SECOND', '1'))
+MAX_RATE_LIMITED_ATTEMPTS = 5
+DIGEST_WINDOW_SECONDS = float(os.getenv('OWNER_DIGEST_SECONDS', '10'))
+
+
+class TwilioError(Exception):
+
+    def __init__(self, message: str, status: int = None, retry_after: float = None):
+        super().__init__(message)
+        self.status = status
+        self.retry_after = retry_after
+
+
+class RateLimiter:
+
+    def __init__(self, per_second: float):
+        self.interval = 1 / per_second
+        self._next_slot = 0.0
+        self._lock = threading.Lock()
+
+    def wait(self) -> None:
+        with self._lock:
+            now = time.monotonic()
+            slot = max(now, self._next_slot)
+            self._next_slot = slot + self.interval
+        if slot > now:
+            time.sleep(slot - now)
+
+    def back_off(self, seconds: float) -> None:
+        with self._lock:
+            self._next_slot = max(self._next_slot, time.monotonic() + seconds)
+
+
+class Dispatcher:
+
+    def __init__(self, account_sid: str, auth_token: str, from_: str, max_workers: int = 4,
+                 per_second: float = MESSAGES_PER_SECOND, api_url: str = TWILIO_API_URL):
+        self.from_ = from_
+        self.url = f'{api_url}/2010-04-01/Accounts/{account_sid}/Messages.json'
+        self.auth = (account_sid, auth_token)
+        self.max_workers = max_workers
+        self.limiter = RateLimiter(per_second)
+        self.session = None
+        self.executor = None
+        self._start_lock = threading.Lock()
+
+    def start(self) -> 'Dispatcher':
+        # requests is slow to import, so the session and worker pool wait until the first message
+        with self._start_lock:
+            if self.executor is None:
+                import requests
+                from requests.adapters import HTTPAdapter
+                session = requests.Session()
+                session.auth = self.auth
+                adapter = HTTPAdapter(pool_connections=1, pool_maxsize=self.max_workers)
+                session.mount('http://', adapter)
+                session.mount('https://', adapter)
+                self.session = session
+                self.executor = ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix='sms')
+        return self
+
+    def send(self, to: str, body: str, from_: str = None) -> Future:
+        future = self.submit(self.deliver, to, body, from_)
+        future.add_done_callback(_report_failure)
+        return future
+
+    def submit(self, fn: Callable, *args) -> Future:
+        # runs on the worker pool in the caller's context, so the active tenant carries over
+        return self.start().executor.submit(copy_context().run, fn, *args)
+
+    def deliver(self, to: str, body: str, from_: str = None, attempts: int = MAX_RATE_LIMITED_ATTEMPTS,
+                ready: Callable[[], bool] = None) -> Optional[dict]:
+        # ready() is asked once a send slot comes up; if it says no, nothing is sent and None comes back
+        session, from_, retry_after = self.start().session, from_ or self.from_, None
+        for _ in range(attempts):
+            self.limiter.wait()
+            if ready is not None and not ready():
+                return None
+            with metrics.timer('twilio_http'):
+                response = session.post(self.url, data={'To': to, 'From': from_, 'Body': body}, timeout=10)
+            metrics.inc('twilio_requests_total', status=response.status_code)
+            if response.status_code == 429:
+                retry_after = float(response.headers.get('Retry-After', 1))
+                self.limiter.back_off(retry_after)
+                continue
+            if response.status_code >= 400:
+                raise TwilioError(f'{response.status_code} sending to {to}: {response.text}', response.status_code)
+            return response.json()
+        raise TwilioError(f'still rate limited after {attempts} attempts sending to {to}', 429, retry_after)
+
+    def shutdown(self, wait: bool = True) -> None:
+        if self.executor is not None:
+            self.executor.shutdown(wait=wait)
+            self.session.close()
+
+
+class Digest:
+
+    def __init__(self, dispatcher: Dispatcher, to: str, window_seconds: float = DIGEST_WINDOW_SECONDS,
+                 from_: str = None):
+        self.dispatcher = dispatcher
+        self.to = to
+        self.from_ = from_
+        self.window_seconds = window_seconds
+        self._items = {}
+        self._timer = None
+        self._lock = threading.Lock()
+
+    def add(self, heading: str, item: str) -> None:
+        with self._lock:
+            self._items.setdefault(heading, []).append(item)
+            if self._timer is None:
+                self._timer = threading.Timer(self.window_seconds, self.flush)
+                self._timer.daemon = True
+                self._timer.start()
+
+    def send(self, body: str) -> Future:
+        # urgent messages go out right away, after whatever was already buffered so order is kept
+        self.flush()
+        return self.dispatcher.send(self.to, body, self.from_)
+
+    def flush(self) -> None:
+        with self._lock:
+            items, self._items = self._items, {}
+            if self._timer is not None:
+                self._timer.cancel()
+                self._timer = None
+        if items:
+            self.dispatcher.send(self.to, '\n'.join(f'{heading} to {join_names(names)}.'
+                                                    for heading, names in items.items()), self.from_)
+
+
+def join_names(names: list) -> str:
+    if len(names) == 1:
+        return names[0]
+    return f'{", ".join(names[:-1])} and {names[-1]}'
+
+
+def _report_failure(future: Future) -> None:
+    if future.exception() is not None:
+        traceback.print_exception(type(future.exception()), future.exception(), future.exception().__traceback__)
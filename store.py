@@ -0,0 +1,750 @@
+import datetime
+import itertools
+import os
+import pickle
+import sqlite3
+import threading
+import zlib
+from collections.abc import MutableMapping
+from contextlib import contextmanager
+from typing import Any, Callable, Iterable, Iterator, List, Optional, Set, Tuple
+
+from journal import journal_path, recover
+from metrics import metrics
+from phones import to_e164
+from ranking import new_stats, rescore_at, score
+from records import Booking, Offer, OfferStatus, Record, Sitter, loads
+from recurring import Recurrence
+
+DB_PATH = os.getenv('SITTER_BOT_DB', 'sitter_bot.db')
+
+BookingKey = Tuple[datetime.datetime, datetime.datetime]
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS sitters (
+    name TEXT PRIMARY KEY,
+    num TEXT NOT NULL,
+    record BLOB NOT NULL
+);
+CREATE INDEX IF NOT EXISTS sitters_num ON sitters (num);
+
+CREATE TABLE IF NOT EXISTS bookings (
+    key TEXT PRIMARY KEY,
+    start TEXT NOT NULL,
+    record BLOB NOT NULL
+);
+CREATE INDEX IF NOT EXISTS bookings_start ON bookings (start);
+'''
+
+OFFERS_SCHEMA = '''
+ALTER TABLE bookings ADD COLUMN accepted_by TEXT;
+
+CREATE TABLE offers (
+    booking_key TEXT NOT NULL REFERENCES bookings (key) ON DELETE CASCADE,
+    sitter_name TEXT NOT NULL,
+    status TEXT NOT NULL,
+    PRIMARY KEY (booking_key, sitter_name)
+);
+CREATE INDEX offers_sitter_status ON offers (sitter_name, status);
+'''
+
+
+def reindex_bookings(conn: sqlite3.Connection) -> None:
+    for key, record in conn.execute('SELECT key, record FROM bookings').fetchall():
+        booking = loads(Booking, record)
+        conn.execute('UPDATE bookings SET accepted_by = ?, record = ? WHERE key = ?',
+                     (booking.accepted_by, booking.dumps(), key))
+        BookingTable.write_offers(conn, key, booking)
+
+
+ARCHIVE_SCHEMA = '''
+CREATE TABLE archived_bookings (
+    key TEXT PRIMARY KEY,
+    start TEXT NOT NULL,
+    accepted_by TEXT,
+    reason TEXT NOT NULL,
+    archived_at TEXT NOT NULL,
+    record BLOB NOT NULL
+);
+CREATE INDEX archived_bookings_start ON archived_bookings (start);
+'''
+
+OPEN_BOOKINGS_SCHEMA = '''
+CREATE INDEX bookings_open ON bookings (start) WHERE accepted_by IS NULL;
+'''
+
+INBOUND_SCHEMA = '''
+CREATE TABLE inbound_messages (
+    sid TEXT PRIMARY KEY,
+    received_at TEXT NOT NULL,
+    response TEXT
+);
+CREATE INDEX inbound_messages_received_at ON inbound_messages (received_at);
+'''
+
+
+
+def normalize_sitter_nums(conn: sqlite3.Connection) -> None:
+    for name, record in conn.execute('SELECT name, record FROM sitters').fetchall():
+        sitter = loads(Sitter, record)
+        try:
+            sitter.num = to_e164(sitter.num)
+        except ValueError:
+            continue
+        conn.execute('UPDATE sitters SET num = ?, record = ? WHERE name = ?', (sitter.num, sitter.dumps(), name))
+
+
+SITTER_STATS_SCHEMA = '''
+CREATE TABLE sitter_stats (
+    name TEXT PRIMARY KEY REFERENCES sitters (name) ON DELETE CASCADE,
+    score REAL NOT NULL,
+    record BLOB NOT NULL
+);
+CREATE INDEX sitter_stats_score ON sitter_stats (score DESC);
+'''
+
+
+def seed_sitter_stats(conn: sqlite3.Connection) -> None:
+    for name, in conn.execute('SELECT name FROM sitters ORDER BY rowid').fetchall():
+        SitterTable.seed_stats(conn, name)
+
+
+OUTBOX_SCHEMA = '''
+CREATE TABLE outbox (
+    id INTEGER PRIMARY KEY,
+    to_num TEXT NOT NULL,
+    from_num TEXT,
+    body TEXT NOT NULL,
+    booking_key TEXT,
+    sitter_name TEXT,
+    status TEXT NOT NULL,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    next_attempt_at TEXT NOT NULL,
+    created_at TEXT NOT NULL,
+    sid TEXT,
+    last_error TEXT
+);
+CREATE INDEX outbox_due ON outbox (next_attempt_at) WHERE status IN ('queued', 'sending');
+CREATE INDEX outbox_created_at ON outbox (created_at);
+'''
+
+
+
+def compact_records(conn: sqlite3.Connection) -> None:
+    # sitters and bookings were pickled dicts; they're now rows of the slotted records
+    for name, record in conn.execute('SELECT name, record FROM sitters').fetchall():
+        conn.execute('UPDATE sitters SET record = ? WHERE name = ?', (loads(Sitter, record).dumps(), name))
+    for key, record in conn.execute('SELECT key, record FROM bookings').fetchall():
+        conn.execute('UPDATE bookings SET record = ? WHERE key = ?', (loads(Booking, record).dumps(), key))
+    for key, record in conn.execute('SELECT key, record FROM archived_bookings').fetchall():
+        conn.execute('UPDATE archived_bookings SET record = ? WHERE key = ?',
+                     (zlib.compress(loads(Booking, zlib.decompress(record)).dumps()), key))
+
+
+COMMITMENTS_SCHEMA = '''
+CREATE TABLE commitments (
+    id INTEGER PRIMARY KEY,
+    sitter_name TEXT NOT NULL REFERENCES sitters (name) ON DELETE CASCADE,
+    starts_at TEXT NOT NULL,
+    ends_at TEXT NOT NULL,
+    seconds REAL NOT NULL,
+    booking_key TEXT UNIQUE REFERENCES bookings (key) ON DELETE CASCADE
+);
+CREATE INDEX commitments_starts_at ON commitments (starts_at);
+CREATE INDEX commitments_sitter ON commitments (sitter_name, starts_at);
+CREATE INDEX commitments_seconds ON commitments (seconds);
+'''
+
+
+def seed_commitments(conn: sqlite3.Connection) -> None:
+    for key_text, sitter_name in conn.execute(
+            'SELECT key, accepted_by FROM bookings WHERE accepted_by IS NOT NULL').fetchall():
+        key = text_to_key(key_text)
+        CommitmentIndex.insert(conn, sitter_name, key[0], booking_end(key), key_text)
+
+
+SUMMARIES_SCHEMA = '''
+ALTER TABLE bookings ADD COLUMN asked INTEGER NOT NULL DEFAULT 0;
+ALTER TABLE bookings ADD COLUMN declined INTEGER NOT NULL DEFAULT 0;
+ALTER TABLE bookings ADD COLUMN waiting INTEGER NOT NULL DEFAULT 0;
+CREATE INDEX bookings_booked ON bookings (start) WHERE accepted_by IS NOT NULL;
+
+CREATE TABLE sitter_bookings (
+    name TEXT PRIMARY KEY REFERENCES sitters (name) ON DELETE CASCADE,
+    booked INTEGER NOT NULL
+);
+'''
+
+
+def seed_summaries(conn: sqlite3.Connection) -> None:
+    for key, record in conn.execute('SELECT key, record FROM bookings').fetchall():
+        progress = BookingTable.progress(loads(Booking, record))
+        conn.execute('UPDATE bookings SET asked = ?, declined = ?, waiting = ? WHERE key = ?', progress + (key,))
+    # archived gigs count too; they're the sitter's history
+    conn.execute('INSERT INTO sitter_bookings (name, booked) '
+                 'SELECT accepted_by, COUNT(*) FROM (SELECT accepted_by FROM bookings '
+                 'UNION ALL SELECT accepted_by FROM archived_bookings) '
+                 'WHERE accepted_by IN (SELECT name FROM sitters) GROUP BY accepted_by')
+
+
+RECURRENCES_SCHEMA = '''
+CREATE TABLE recurrences (
+    rule TEXT PRIMARY KEY,
+    next_start TEXT NOT NULL,
+    seconds REAL NOT NULL,
+    every_days INTEGER NOT NULL,
+    created_at TEXT NOT NULL
+);
+CREATE INDEX recurrences_next_start ON recurrences (next_start);
+'''
+
+INBOX_SCHEMA = '''
+CREATE TABLE inbox (
+    id INTEGER PRIMARY KEY,
+    sid TEXT NOT NULL,
+    from_num TEXT NOT NULL,
+    body TEXT NOT NULL,
+    status TEXT NOT NULL,
+    received_at TEXT NOT NULL,
+    lease_until TEXT,
+    last_error TEXT
+);
+CREATE INDEX inbox_pending ON inbox (from_num, id) WHERE status IN ('queued', 'handling');
+CREATE INDEX inbox_received_at ON inbox (received_at);
+'''
+
+
+STATS_RESCORE_SCHEMA = '''
+ALTER TABLE sitter_stats ADD COLUMN rescore_at TEXT;
+CREATE INDEX sitter_stats_rescore_at ON sitter_stats (rescore_at) WHERE rescore_at IS NOT NULL;
+'''
+
+
+def rescore_sitter_stats(conn: sqlite3.Connection) -> None:
+    # scores stored before rescore_at existed still count gigs that have since dropped out of the window
+    for name, record in conn.execute('SELECT name, record FROM sitter_stats').fetchall():
+        conn.execute('UPDATE sitter_stats SET score = ?, rescore_at = ? WHERE name = ?',
+                     tuple(StatsTable.columns(pickle.loads(record)).values()) + (name,))
+
+
+# offers and cancellations are checked against their booking just before they're sent
+OUTBOX_KIND_SCHEMA = '''
+ALTER TABLE outbox ADD COLUMN kind TEXT;
+'''
+
+
+MIGRATIONS = [SCHEMA, OFFERS_SCHEMA, reindex_bookings, ARCHIVE_SCHEMA, OPEN_BOOKINGS_SCHEMA, INBOUND_SCHEMA,
+              normalize_sitter_nums, SITTER_STATS_SCHEMA, seed_sitter_stats, OUTBOX_SCHEMA, compact_records,
+              COMMITMENTS_SCHEMA, seed_commitments, SUMMARIES_SCHEMA, seed_summaries,
+              RECURRENCES_SCHEMA, INBOX_SCHEMA, STATS_RESCORE_SCHEMA, rescore_sitter_stats,
+              OUTBOX_KIND_SCHEMA]
+
+RANKED_PAGE_SIZE = 100
+
+# Twilio gives up retrying a webhook long before this, so older message SIDs can be forgotten
+INBOUND_RETENTION = datetime.timedelta(days=1)
+
+
+def key_to_text(key: BookingKey) -> str:
+    start, end = key
+    return f'{start.isoformat()}|{end.isoformat()}'
+
+
+def text_to_key(text: str) -> BookingKey:
+    start, end = text.split('|')
+    if 'T' not in end:
+        # bookings made before end datetimes were tracked only stored the end time
+        return datetime.datetime.fromisoformat(start), datetime.time.fromisoformat(end)
+    return datetime.datetime.fromisoformat(start), datetime.datetime.fromisoformat(end)
+
+
+def booking_end(key: BookingKey) -> datetime.datetime:
+    start, end = key
+    if isinstance(end, datetime.datetime):
+        return end
+    end = datetime.datetime.combine(start.date(), end)
+    return end if end > start else end + datetime.timedelta(days=1)
+
+
+class Table(MutableMapping):
+    table = ''
+    key_column = ''
+
+    def __init__(self, store: 'Store'):
+        self.store = store
+
+    def _key(self, key) -> str:
+        return key
+
+    def _unkey(self, text: str):
+        return text
+
+    def _columns(self, key, value) -> dict:
+        return {}
+
+    def _after_write(self, key_text: str, value) -> None:
+        pass
+
+    def _dumps(self, value) -> bytes:
+        return pickle.dumps(value, pickle.HIGHEST_PROTOCOL)
+
+    def _loads(self, blob: bytes):
+        return pickle.loads(blob)
+
+    def __getitem__(self, key):
+        with metrics.timer('store_read'):
+            row = self.store.conn.execute(
+                f'SELECT record FROM {self.table} WHERE {self.key_column} = ?', (self._key(key),)).fetchone()
+            if row is None:
+                raise KeyError(key)
+            return self._loads(row[0])
+
+    def __setitem__(self, key, value) -> None:
+        self.put_many([(key, value)])
+
+    def put_many(self, items: Iterable[Tuple[Any, Any]]) -> None:
+        # one statement and one commit for the lot, however many there are
+        items = list(items)
+        if not items:
+            return
+        rows = [{self.key_column: self._key(key), **self._columns(key, value), 'record': self._dumps(value)}
+                for key, value in items]
+        names = ', '.join(rows[0])
+        placeholders = ', '.join('?' for _ in rows[0])
+        updates = ', '.join(f'{name} = excluded.{name}' for name in rows[0] if name != self.key_column)
+        with metrics.timer('store_write'), self.store.transaction():
+            self.store.conn.executemany(
+                f'INSERT INTO {self.table} ({names}) VALUES ({placeholders}) '
+                f'ON CONFLICT ({self.key_column}) DO UPDATE SET {updates}',
+                [tuple(row.values()) for row in rows])
+            for row, (_, value) in zip(rows, items):
+                self._after_write(row[self.key_column], value)
+
+    def __delitem__(self, key) -> None:
+        cursor = self.store.conn.execute(
+            f'DELETE FROM {self.table} WHERE {self.key_column} = ?', (self._key(key),))
+        if cursor.rowcount == 0:
+            raise KeyError(key)
+
+    def __contains__(self, key) -> bool:
+        return self.store.conn.execute(
+            f'SELECT 1 FROM {self.table} WHERE {self.key_column} = ?', (self._key(key),)).fetchone() is not None
+
+    def __iter__(self) -> Iterator:
+        rows = self.store.conn.execute(f'SELECT {self.key_column} FROM {self.table} ORDER BY rowid').fetchall()
+        return (self._unkey(key) for key, in rows)
+
+    def __len__(self) -> int:
+        return self.store.conn.execute(f'SELECT COUNT(*) FROM {self.table}').fetchone()[0]
+
+    def items(self):
+        rows = self.store.conn.execute(
+            f'SELECT {self.key_column}, record FROM {self.table} ORDER BY rowid').fetchall()
+        return [(self._unkey(key), self._loads(record)) for key, record in rows]
+
+    def stream(self) -> Iterator[Tuple[Any, Any]]:
+        # decoded as the rows are read, so exporting a big table doesn't hold all of it in memory
+        rows = self.store.conn.execute(f'SELECT {self.key_column}, record FROM {self.table} ORDER BY rowid')
+        return ((self._unkey(key), self._loads(record)) for key, record in rows)
+
+
+class RecordTable(Table):
+    record_type = Record
+
+    def _dumps(self, value: Record) -> bytes:
+        return value.dumps()
+
+    def _loads(self, blob: bytes) -> Record:
+        return self.record_type.from_row(pickle.loads(blob))
+
+
+class SitterTable(RecordTable):
+    table = 'sitters'
+    key_column = 'name'
+    record_type = Sitter
+
+    def _columns(self, key: str, value: Sitter) -> dict:
+        value.num = to_e164(value.num)
+        return {'num': value.num}
+
+    def _after_write(self, key_text: str, value: Sitter) -> None:
+        self.seed_stats(self.store.conn, key_text)
+
+    @staticmethod
+    def seed_stats(conn: sqlite3.Connection, name: str) -> None:
+        stats = new_stats()
+        conn.execute('INSERT OR IGNORE INTO sitter_stats (name, score, record) VALUES (?, ?, ?)',
+                     (name, score(stats), pickle.dumps(stats, pickle.HIGHEST_PROTOCOL)))
+
+    def by_num(self, num: str) -> Optional[Sitter]:
+        name = self.name_by_num(num)
+        return self[name] if name is not None else None
+
+    def name_by_num(self, num: str) -> Optional[str]:
+        # the num index is updated with every write, so this is current in every process without a reload
+        try:
+            num = to_e164(num)
+        except ValueError:
+            return None
+        row = self.store.conn.execute('SELECT name FROM sitters WHERE num = ?', (num,)).fetchone()
+        return row[0] if row is not None else None
+
+
+    def booking_counts(self, limit: int, offset: int = 0) -> List[Tuple[str, str, int]]:
+        # walks the name index and the counts' primary key, so a page costs the same however long the roster is
+        return self.store.conn.execute(
+            'SELECT sitters.name, sitters.num, COALESCE(sitter_bookings.booked, 0) FROM sitters '
+            'LEFT JOIN sitter_bookings ON sitter_bookings.name = sitters.name '
+            'ORDER BY sitters.name LIMIT ? OFFSET ?', (limit, offset)).fetchall()
+
+
+class StatsTable(Table):
+    table = 'sitter_stats'
+    key_column = 'name'
+
+    def _columns(self, key: str, value: dict) -> dict:
+        return self.columns(value)
+
+    @staticmethod
+    def columns(value: dict) -> dict:
+        changes_at = rescore_at(value)
+        return {'score': score(value), 'rescore_at': changes_at.isoformat() if changes_at is not None else None}
+
+    def update(self, name: str, record: Callable, *args) -> None:
+        with self.store.transaction():
+            stats = self.get(name)
+            if stats is None:
+                return
+            record(stats, *args)
+            self[name] = stats
+
+    def rescore(self) -> None:
+        # the stored score includes recent load, so it's brought up to date once a gig has aged out of it
+        with self.store.transaction():
+            rows = self.store.conn.execute('SELECT name, record FROM sitter_stats WHERE rescore_at <= ?',
+                                           (datetime.datetime.now().isoformat(),)).fetchall()
+            self.put_many((name, pickle.loads(record)) for name, record in rows)
+
+    def ranked(self) -> Iterator[str]:
+        # paged so a caller that stops at the first good candidate doesn't leave a cursor open
+        self.rescore()
+        for offset in itertools.count(0, RANKED_PAGE_SIZE):
+            rows = self.store.conn.execute('SELECT name FROM sitter_stats ORDER BY score DESC, rowid LIMIT ? OFFSET ?',
+                                           (RANKED_PAGE_SIZE, offset)).fetchall()
+            yield from (name for name, in rows)
+            if len(rows) < RANKED_PAGE_SIZE:
+                return
+
+    def ranked_items(self) -> List[Tuple[str, dict]]:
+        self.rescore()
+        rows = self.store.conn.execute('SELECT name, record FROM sitter_stats ORDER BY score DESC, rowid').fetchall()
+        return [(name, pickle.loads(record)) for name, record in rows]
+
+
+class BookingTable(RecordTable):
+    table = 'bookings'
+    key_column = 'key'
+    record_type = Booking
+
+    def _key(self, key: BookingKey) -> str:
+        return key_to_text(key)
+
+    def _unkey(self, text: str) -> BookingKey:
+        return text_to_key(text)
+
+    def _columns(self, key: BookingKey, value: Booking) -> dict:
+        asked, declined, waiting = self.progress(value)
+        return {'start': key[0].isoformat(), 'accepted_by': value.accepted_by,
+                'asked': asked, 'declined': declined, 'waiting': waiting}
+
+    @staticmethod
+    def progress(value: Booking) -> Tuple[int, int, int]:
+        # kept alongside each booking so the owner's status check never has to decode one
+        statuses = [offer.status for offer in value.offers.values()]
+        return len(statuses), statuses.count(OfferStatus.NO), statuses.count(OfferStatus.PENDING)
+
+    def put_many(self, items: Iterable[Tuple[BookingKey, Booking]]) -> None:
+        # a booking can be accepted by claim() or arrive already accepted from an old .p file; either way its
+        # commitment and the sitter's booked count follow from accepted_by changing, so compare against what's stored
+        items = list(items)
+        if not items:
+            return
+        key_texts = [self._key(key) for key, _ in items]
+        with self.store.transaction():
+            accepted = dict(self.store.conn.execute(
+                f'SELECT key, accepted_by FROM bookings WHERE key IN ({", ".join("?" for _ in key_texts)})',
+                key_texts).fetchall())
+            super().put_many(items)
+            for key_text, (key, value) in zip(key_texts, items):
+                if accepted.get(key_text) != value.accepted_by:
+                    self._accepted_changed(key, key_text, accepted.get(key_text), value.accepted_by)
+
+    def _accepted_changed(self, key: BookingKey, key_text: str, before: Optional[str], after: Optional[str]) -> None:
+        if before is not None:
+            self.store.conn.execute('UPDATE sitter_bookings SET booked = booked - 1 WHERE name = ?', (before,))
+        if after is None:
+            self.store.conn.execute('DELETE FROM commitments WHERE booking_key = ?', (key_text,))
+        else:
+            self.store.commitments.add(after, key[0], booking_end(key), key)
+            self.store.conn.execute(
+                'INSERT INTO sitter_bookings (name, booked) SELECT ?, 1 WHERE EXISTS '
+                '(SELECT 1 FROM sitters WHERE name = ?) ON CONFLICT (name) DO UPDATE SET booked = booked + 1',
+                (after, after))
+
+    def _after_write(self, key_text: str, value: Booking) -> None:
+        self.write_offers(self.store.conn, key_text, value)
+
+    @staticmethod
+    def write_offers(conn: sqlite3.Connection, key_text: str, value: Booking) -> None:
+        conn.execute('DELETE FROM offers WHERE booking_key = ?', (key_text,))
+        conn.executemany('INSERT INTO offers (booking_key, sitter_name, status) VALUES (?, ?, ?)',
+                         [(key_text, sitter_name, offer.status.value) for sitter_name, offer in value.offers.items()])
+
+    def open_keys(self) -> List[BookingKey]:
+        rows = self.store.conn.execute('SELECT key FROM bookings WHERE accepted_by IS NULL ORDER BY start').fetchall()
+        return [text_to_key(key) for key, in rows]
+
+    def upcoming(self, since: datetime.datetime, limit: int, offset: int = 0) -> List[Tuple[BookingKey, str]]:
+        rows = self.store.conn.execute(
+            'SELECT key, accepted_by FROM bookings WHERE accepted_by IS NOT NULL AND start >= ? '
+            'ORDER BY start LIMIT ? OFFSET ?', (since.isoformat(), limit, offset)).fetchall()
+        return [(text_to_key(key), accepted_by) for key, accepted_by in rows]
+
+    def pending(self, limit: int, offset: int = 0) -> List[Tuple[BookingKey, int, int, int]]:
+        rows = self.store.conn.execute(
+            'SELECT key, asked, declined, waiting FROM bookings WHERE accepted_by IS NULL '
+            'ORDER BY start LIMIT ? OFFSET ?', (limit, offset)).fetchall()
+        return [(text_to_key(key), asked, declined, waiting) for key, asked, declined, waiting in rows]
+
+    def claim(self, key: BookingKey, sitter_name: str) -> bool:
+        # compare-and-set: the transaction holds the write lock, so only one writer, in any process, finds
+        # accepted_by still NULL
+        with self.store.transaction():
+            row = self.store.conn.execute('SELECT accepted_by FROM bookings WHERE key = ?',
+                                          (self._key(key),)).fetchone()
+            if row is None or row[0] is not None:
+                return False
+            booking = self[key]
+            now = datetime.datetime.now()
+            offer = booking.offers.setdefault(sitter_name, Offer(wave=booking.waves()))
+            offer.status, offer.replied_at = OfferStatus.YES, now
+            booking.accepted_by, booking.accepted_at = sitter_name, now
+            self[key] = booking
+        return True
+
+    def pending_offers(self, sitter_name: str) -> List[BookingKey]:
+        rows = self.store.conn.execute(
+            "SELECT booking_key FROM offers WHERE sitter_name = ? AND status = 'pending' ORDER BY rowid",
+            (sitter_name,)).fetchall()
+        return [text_to_key(key) for key, in rows]
+
+
+class CommitmentIndex:
+    # accepted bookings and blackouts, kept sorted by start so an overlap check is an index range scan
+
+    def __init__(self, store: 'Store'):
+        self.store = store
+
+    @staticmethod
+    def insert(conn: sqlite3.Connection, sitter_name: str, start: datetime.datetime, end: datetime.datetime,
+               key_text: str = None) -> None:
+        conn.execute('INSERT OR REPLACE INTO commitments (sitter_name, starts_at, ends_at, seconds, booking_key) '
+                     'SELECT ?, ?, ?, ?, ? WHERE EXISTS (SELECT 1 FROM sitters WHERE name = ?)',
+                     (sitter_name, start.isoformat(), end.isoformat(), (end - start).total_seconds(), key_text,
+                      sitter_name))
+
+    def add(self, sitter_name: str, start: datetime.datetime, end: datetime.datetime,
+            booking_key: BookingKey = None) -> None:
+        with self.store.transaction():
+            self.store.conn.execute('DELETE FROM commitments WHERE ends_at < ?', (datetime.datetime.now().isoformat(),))
+            self.insert(self.store.conn, sitter_name, start, end,
+                        key_to_text(booking_key) if booking_key is not None else None)
+
+    def clear_blackouts(self, sitter_name: str, start: datetime.datetime, end: datetime.datetime) -> int:
+        cursor = self.store.conn.execute(
+            'DELETE FROM commitments WHERE sitter_name = ? AND booking_key IS NULL AND starts_at < ? AND ends_at > ?',
+            (sitter_name, end.isoformat(), start.isoformat()))
+        return cursor.rowcount
+
+    def _overlap_query(self, start: datetime.datetime, end: datetime.datetime) -> Tuple[str, tuple]:
+        # nothing can overlap the window if it starts more than the longest commitment before it, so the scan over
+        # starts_at is bounded on both sides
+        longest = self.store.conn.execute('SELECT MAX(seconds) FROM commitments').fetchone()[0] or 0
+        earliest = start - datetime.timedelta(seconds=longest)
+        return ('starts_at >= ? AND starts_at < ? AND ends_at > ?',
+                (earliest.isoformat(), end.isoformat(), start.isoformat()))
+
+    def busy(self, start: datetime.datetime, end: datetime.datetime) -> Set[str]:
+        where, params = self._overlap_query(start, end)
+        rows = self.store.conn.execute(f'SELECT DISTINCT sitter_name FROM commitments WHERE {where}', params)
+        return {sitter_name for sitter_name, in rows}
+
+    def overlapping(self, sitter_name: str, start: datetime.datetime,
+                    end: datetime.datetime) -> List[Tuple[datetime.datetime, datetime.datetime, Optional[BookingKey]]]:
+        where, params = self._overlap_query(start, end)
+        rows = self.store.conn.execute(
+            f'SELECT starts_at, ends_at, booking_key FROM commitments WHERE sitter_name = ? AND {where} '
+            f'ORDER BY starts_at', (sitter_name,) + params)
+        return [(datetime.datetime.fromisoformat(starts_at), datetime.datetime.fromisoformat(ends_at),
+                 text_to_key(key_text) if key_text is not None else None) for starts_at, ends_at, key_text in rows]
+
+
+class RecurrenceIndex:
+    # a recurring booking is just its rule and where its next occurrence starts; occurrences become bookings as
+    # they come within the horizon, and the index on next_start finds the rules that are due without a scan
+
+    def __init__(self, store: 'Store'):
+        self.store = store
+
+    def add(self, recurrence: Recurrence) -> bool:
+        cursor = self.store.conn.execute(
+            'INSERT OR IGNORE INTO recurrences (rule, next_start, seconds, every_days, created_at) '
+            'VALUES (?, ?, ?, ?, ?)',
+            (recurrence.rule, recurrence.next_start.isoformat(), recurrence.seconds, recurrence.every.days,
+             datetime.datetime.now().isoformat()))
+        return cursor.rowcount > 0
+
+    def remove(self, rule: str) -> bool:
+        return self.store.conn.execute('DELETE FROM recurrences WHERE rule = ?', (rule,)).rowcount > 0
+
+    def due(self, horizon: datetime.datetime) -> List[Recurrence]:
+        rows = self.store.conn.execute(
+            'SELECT rule, next_start, seconds, every_days FROM recurrences WHERE next_start <= ? ORDER BY next_start',
+            (horizon.isoformat(),)).fetchall()
+        return [Recurrence(rule, datetime.datetime.fromisoformat(next_start), seconds,
+                           datetime.timedelta(days=every_days)) for rule, next_start, seconds, every_days in rows]
+
+    def advance(self, rule: str, next_start: datetime.datetime) -> None:
+        self.store.conn.execute('UPDATE recurrences SET next_start = ? WHERE rule = ?', (next_start.isoformat(), rule))
+
+    def next_start(self) -> Optional[datetime.datetime]:
+        row = self.store.conn.execute('SELECT MIN(next_start) FROM recurrences').fetchone()
+        return datetime.datetime.fromisoformat(row[0]) if row[0] is not None else None
+
+
+class Store:
+
+    def __init__(self, path: str = DB_PATH, migrate_pickles: bool = False):
+        self.path = path
+        self.migrate_pickles = migrate_pickles
+        self._local = threading.local()
+        self.sitters = SitterTable(self)
+        self.bookings = BookingTable(self)
+        self.sitter_stats = StatsTable(self)
+        self.commitments = CommitmentIndex(self)
+        self.recurrences = RecurrenceIndex(self)
+
+    @property
+    def conn(self) -> sqlite3.Connection:
+        # sqlite connections can't be shared across threads or a fork, so each gets its own
+        conn = getattr(self._local, 'conn', None)
+        if conn is None or self._local.pid != os.getpid():
+            conn = sqlite3.connect(self.path, isolation_level=None, timeout=30)
+            conn.execute('PRAGMA journal_mode = WAL')
+            conn.execute('PRAGMA synchronous = NORMAL')
+            conn.execute('PRAGMA foreign_keys = ON')
+            self._upgrade(conn)
+            self._local.conn, self._local.pid = conn, os.getpid()
+            if self.migrate_pickles:
+                self.migrate_pickles = False
+                migrate_from_pickle(self, os.path.dirname(os.path.abspath(self.path)))
+        return conn
+
+    @staticmethod
+    def _upgrade(conn: sqlite3.Connection) -> None:
+        conn.execute('BEGIN IMMEDIATE')
+        version = conn.execute('PRAGMA user_version').fetchone()[0]
+        for version, migration in enumerate(MIGRATIONS[version:], start=version + 1):
+            if callable(migration):
+                migration(conn)
+            else:
+                for statement in migration.split(';'):
+                    if statement.strip():
+                        conn.execute(statement)
+            conn.execute(f'PRAGMA user_version = {version}')
+        conn.execute('COMMIT')
+
+    def archive(self, key: BookingKey, reason: str) -> Booking:
+        with self.transaction():
+            booking = self.bookings[key]
+            self.conn.execute(
+                'INSERT OR REPLACE INTO archived_bookings (key, start, accepted_by, reason, archived_at, record) '
+                'VALUES (?, ?, ?, ?, ?, ?)',
+                (key_to_text(key), key[0].isoformat(), booking.accepted_by, reason,
+                 datetime.datetime.now().isoformat(), zlib.compress(booking.dumps())))
+            del self.bookings[key]
+        return booking
+
+    def archived(self, since: datetime.datetime = datetime.datetime.min) -> Iterator[Tuple[BookingKey, str, Booking]]:
+        rows = self.conn.execute('SELECT key, reason, record FROM archived_bookings WHERE start >= ? ORDER BY start',
+                                 (since.isoformat(),))
+        return ((text_to_key(key), reason, Booking.from_row(pickle.loads(zlib.decompress(record))))
+                for key, reason, record in rows)
+
+    def record_inbound(self, sid: str) -> bool:
+        now = datetime.datetime.now()
+        with self.transaction():
+            self.conn.execute('DELETE FROM inbound_messages WHERE received_at < ?',
+                              ((now - INBOUND_RETENTION).isoformat(),))
+            cursor = self.conn.execute('INSERT OR IGNORE INTO inbound_messages (sid, received_at) VALUES (?, ?)',
+                                       (sid, now.isoformat()))
+        return cursor.rowcount == 1
+
+    def inbound_response(self, sid: str) -> Optional[str]:
+        row = self.conn.execute('SELECT response FROM inbound_messages WHERE sid = ?', (sid,)).fetchone()
+        return row[0] if row is not None else None
+
+    def save_inbound_response(self, sid: str, response: str) -> None:
+        self.conn.execute('UPDATE inbound_messages SET response = ? WHERE sid = ?', (response, sid))
+
+    def forget_inbound(self, sid: str) -> None:
+        self.conn.execute('DELETE FROM inbound_messages WHERE sid = ?', (sid,))
+
+    @contextmanager
+    def transaction(self):
+        conn = self.conn
+        if conn.in_transaction:
+            yield self
+            return
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            yield self
+        except BaseException:
+            conn.execute('ROLLBACK')
+            raise
+        conn.execute('COMMIT')
+
+
+def migrate_from_pickle(store: Store, directory: str = '.') -> bool:
+    migrated = False
+    with store.transaction():
+        for var_name, table in [('sitters', store.sitters), ('bookings', store.bookings)]:
+            path = os.path.join(directory, f'{var_name}.p')
+            if not os.path.exists(path):
+                continue
+            # the pickle bot journals its changes next to the .p file, so they're replayed on top of it
+            payload = recover(path).data
+            for key, value in payload.items():
+                # the .p files hold the dicts the bots used to keep in memory
+                table[key] = table.record_type.from_dict(value)
+            migrated = True
+    if migrated:
+        for var_name in ['sitters', 'bookings']:
+            snapshot_path = os.path.join(directory, f'{var_name}.p')
+            for path in [snapshot_path, journal_path(snapshot_path)]:
+                if os.path.exists(path):
+                    os.rename(path, f'{path}.migrated')
+    return migrated
+
+
+def open_store(path: str = DB_PATH) -> Store:
+    # nothing touches the disk until the first query, which also picks up any old .p files
+    return Store(path, migrate_pickles=True)
+
+
+if __name__ == '__main__':
+    store_ = Store()
+    if migrate_from_pickle(store_):
+        print(f'Migrated {len(store_.sitters)} sitters and {len(store_.bookings)} bookings to {store_.path}.')
+    else:
+        print('Nothing to migrate.')
@@ -0,0 +1,181 @@
+import os
+import sqlite3
+import sys
+import threading
+import weakref
+from collections import OrderedDict
+from contextlib import closing, contextmanager
+from contextvars import ContextVar
+from typing import Iterator, List, Optional
+
+from inbox import Inbox
+from outbox import Outbox
+from sms import Digest, Dispatcher
+from store import DB_PATH, open_store
+
+TENANTS_DB = os.getenv('SITTER_BOT_TENANTS_DB', 'tenants.db')
+TENANTS_DIR = os.getenv('SITTER_BOT_TENANTS_DIR', 'tenants')
+MAX_LOADED_TENANTS = int(os.getenv('SITTER_BOT_MAX_LOADED_TENANTS', '100'))
+
+# the household whose command or scheduled event is being handled; it's the Tenant itself rather than its number,
+# so everything done in one activation goes through the same store even if the household is evicted meanwhile
+current_tenant: ContextVar[Optional['Tenant']] = ContextVar('current_tenant', default=None)
+
+
+class UnknownTenant(Exception):
+    pass
+
+
+class Tenant:
+
+    def __init__(self, bot_num: str, owner: str, db_path: str, sms: Dispatcher):
+        self.bot_num = bot_num
+        self.owner = owner
+        self.store = open_store(db_path)
+        self.sitters, self.bookings = self.store.sitters, self.store.bookings
+        self.owner_updates = Digest(sms, owner, from_=bot_num)
+        self.outbox = Outbox(self.store, sms)
+        self.inbox = Inbox(self.store)
+
+    def unload(self) -> None:
+        self.owner_updates.flush()
+
+
+class TenantRegistry:
+
+    def __init__(self, sms: Dispatcher, default_bot_num: str = None, default_owner: str = None,
+                 path: str = TENANTS_DB, directory: str = TENANTS_DIR, max_loaded: int = MAX_LOADED_TENANTS):
+        self.sms = sms
+        self.default_bot_num = default_bot_num
+        self.default_owner = default_owner
+        self.path = path
+        self.directory = directory
+        self.max_loaded = max_loaded
+        self._loaded = OrderedDict()
+        # evicted households that something still holds on to, so they're picked up again rather than opened twice
+        self._live = weakref.WeakValueDictionary()
+        self._active = {}
+        self._lock = threading.RLock()
+
+    def _connect(self) -> sqlite3.Connection:
+        conn = sqlite3.connect(self.path, isolation_level=None)
+        conn.execute('CREATE TABLE IF NOT EXISTS tenants (bot_num TEXT PRIMARY KEY, owner TEXT NOT NULL)')
+        return conn
+
+    def _lookup(self, bot_num: str) -> Optional[str]:
+        if os.path.exists(self.path):
+            with closing(self._connect()) as conn:
+                row = conn.execute('SELECT owner FROM tenants WHERE bot_num = ?', (bot_num,)).fetchone()
+            if row is not None:
+                return row[0]
+        return self.default_owner if bot_num == self.default_bot_num else None
+
+    def register(self, bot_num: str, owner: str) -> None:
+        with closing(self._connect()) as conn:
+            conn.execute('INSERT INTO tenants (bot_num, owner) VALUES (?, ?) '
+                         'ON CONFLICT (bot_num) DO UPDATE SET owner = excluded.owner', (bot_num, owner))
+        with self._lock:
+            tenant = self._loaded.pop(bot_num, None)
+            self._live.pop(bot_num, None)
+        if tenant is not None:
+            tenant.unload()
+
+    def bot_nums(self) -> List[str]:
+        bot_nums = []
+        if os.path.exists(self.path):
+            with closing(self._connect()) as conn:
+                bot_nums = [bot_num for bot_num, in conn.execute('SELECT bot_num FROM tenants ORDER BY rowid')]
+        if self.default_bot_num is not None and self.default_bot_num not in bot_nums:
+            bot_nums.insert(0, self.default_bot_num)
+        return bot_nums
+
+    def db_path(self, bot_num: str) -> str:
+        if bot_num == self.default_bot_num:
+            return DB_PATH
+        os.makedirs(self.directory, exist_ok=True)
+        return os.path.join(self.directory, f'{bot_num.lstrip("+")}.db')
+
+    def get(self, bot_num: str = None) -> Tenant:
+        if bot_num is None and current_tenant.get() is not None:
+            return current_tenant.get()
+        bot_num = bot_num or self.default_bot_num
+        with self._lock:
+            tenant = self._loaded.get(bot_num)
+            if tenant is not None:
+                self._loaded.move_to_end(bot_num)
+                return tenant
+            tenant = self._live.get(bot_num)
+            if tenant is None:
+                owner = self._lookup(bot_num)
+                if owner is None:
+                    raise UnknownTenant(bot_num)
+                tenant = self._live[bot_num] = Tenant(bot_num, owner, self.db_path(bot_num), self.sms)
+            self._loaded[bot_num] = tenant
+            evicted = self._evict()
+        for idle_tenant in evicted:
+            idle_tenant.unload()
+        return tenant
+
+    def _evict(self) -> List[Tenant]:
+        # least recently used first, skipping any household that's in the middle of something
+        evicted = []
+        for bot_num in list(self._loaded):
+            if len(self._loaded) <= self.max_loaded:
+                break
+            if not self._active.get(bot_num):
+                evicted.append(self._loaded.pop(bot_num))
+        return evicted
+
+    @contextmanager
+    def activate(self, bot_num: str) -> Iterator[Tenant]:
+        with self._lock:
+            tenant = self.get(bot_num)
+            self._active[tenant.bot_num] = self._active.get(tenant.bot_num, 0) + 1
+        token = current_tenant.set(tenant)
+        try:
+            yield tenant
+        finally:
+            current_tenant.reset(token)
+            with self._lock:
+                self._active[tenant.bot_num] -= 1
+                if not self._active[tenant.bot_num]:
+                    del self._active[tenant.bot_num]
+
+
+class Current:
+    # stands in for one attribute of whichever tenant is active, so single-household code reads the same
+
+    def __init__(self, registry: TenantRegistry, attribute: str):
+        self._registry = registry
+        self._attribute = attribute
+
+    def _target(self):
+        return getattr(self._registry.get(), self._attribute)
+
+    def __getattr__(self, name: str):
+        return getattr(self._target(), name)
+
+    def __getitem__(self, key):
+        return self._target()[key]
+
+    def __setitem__(self, key, value) -> None:
+        self._target()[key] = value
+
+    def __delitem__(self, key) -> None:
+        del self._target()[key]
+
+    def __contains__(self, key) -> bool:
+        return key in self._target()
+
+    def __iter__(self):
+        return iter(self._target())
+
+    def __len__(self) -> int:
+        return len(self._target())
+
+
+if __name__ == '__main__':
+    if len(sys.argv) != 3:
+        sys.exit('usage: python tenants.py <bot number> <owner cell>')
+    TenantRegistry(sms=None).register(sys.argv[1], sys.argv[2])
+    print(f'Registered {sys.argv[1]} for {sys.argv[2]}.')
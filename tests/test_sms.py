@@ -0,0 +1,79 @@
+import threading
+import time
+
+import pytest
+
+import fake_twilio
+from sms import Dispatcher, TwilioError
+
+
+@pytest.fixture
+def twilio():
+    fake_twilio.messages.clear()
+    fake_twilio.failures.clear()
+    server = fake_twilio.serve(0)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield f'http://localhost:{server.server_address[1]}'
+    server.shutdown()
+    server.server_close()
+
+
+@pytest.fixture
+def dispatcher(twilio):
+    dispatcher = Dispatcher('AC123', 'token', '+15559999999', max_workers=1, per_second=100, api_url=twilio)
+    yield dispatcher
+    dispatcher.shutdown()
+
+
+def test_deliver_reuses_one_session_and_connection(dispatcher, monkeypatch):
+    clients = []
+    do_post = fake_twilio.FakeTwilioHandler.do_POST
+
+    def record_client(handler):
+        clients.append(handler.client_address)
+        do_post(handler)
+
+    monkeypatch.setattr(fake_twilio.FakeTwilioHandler, 'do_POST', record_client)
+    session = dispatcher.start().session
+    for idx in range(3):
+        assert dispatcher.deliver(f'+1212555000{idx}', 'hi')['to'] == f'+1212555000{idx}'
+    assert dispatcher.session is session
+    assert len(clients) == 3 and len(set(clients)) == 1
+    assert [message['to'] for message in fake_twilio.messages] == ['+12125550000', '+12125550001', '+12125550002']
+
+
+def test_rate_limited_send_waits_for_retry_after_then_retries(dispatcher):
+    fake_twilio.failures.extend([429])
+    start = time.monotonic()
+    message = dispatcher.deliver('+12125550000', 'hi')
+    assert time.monotonic() - start >= 1
+    assert message['status'] == 'queued'
+    assert len(fake_twilio.messages) == 1
+
+
+def test_rate_limited_every_time_gives_up(dispatcher):
+    fake_twilio.failures.extend([429, 429])
+    with pytest.raises(TwilioError) as error:
+        dispatcher.deliver('+12125550000', 'hi', attempts=2)
+    assert error.value.status == 429 and error.value.retry_after == 1
+    assert not fake_twilio.messages
+
+
+def test_server_error_raises_twilio_error(dispatcher):
+    fake_twilio.failures.extend([503])
+    with pytest.raises(TwilioError) as error:
+        dispatcher.deliver('+12125550000', 'hi')
+    assert error.value.status == 503
+    assert not fake_twilio.messages
+
+
+def test_send_returns_a_future_without_waiting(dispatcher):
+    # the 429 holds the delivery up for a second, which send() mustn't wait for
+    fake_twilio.failures.extend([429])
+    start = time.monotonic()
+    future = dispatcher.send('+12125550000', 'hi', '+15558888888')
+    assert time.monotonic() - start < 0.5
+    assert not future.done()
+    assert future.result(timeout=5)['from'] == '+15558888888'
+    assert len(fake_twilio.messages) == 1
@@ -0,0 +1,11 @@
+from threading import Thread
+
+import sitter_bot
+
+# gunicorn --workers 4 --bind 0.0.0.0:8000 wsgi:app
+#
+# Every worker process shares the household databases and runs its own scheduler thread. Scheduled work is
+# idempotent against the store (offers, claims and archiving all happen in transactions), so the workers
+# can re-arm the same deadlines without double-offering or double-booking anyone.
+app = sitter_bot.create_app(prewarm=True)
+Thread(target=sitter_bot.book_forever, daemon=True).start()